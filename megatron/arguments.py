@@ -269,6 +269,20 @@ def parse_args(extra_args_provider=None, defaults={},
             'for distribute-checkpointed-activations to work you '\
             'need to enable checkpoint-activations'
 
+    if args.tp_local_data:
+        assert not args.data_efficiency_curriculum_learning, \
+            '--tp-local-data is not supported with data efficiency ' \
+            'curriculum learning'
+
+    if args.data_impl == 'jsonl':
+        assert not args.shm_data_loader and \
+            args.data_readahead_batches == 0, \
+            '--data-impl jsonl uses its own streaming data loader'
+
+    if args.blocked_attention:
+        assert args.attention_block_size > 0, \
+            '--attention-block-size must be positive'
+
     args.curriculum_learning_legacy = False
     args.compression_training = False
 
@@ -486,6 +500,15 @@ def _add_training_args(parser: argparse.ArgumentParser) -> argparse.ArgumentPars
                        help='Disable fusion of query_key_value scaling, '
                        'masking, and softmax.',
                        dest='masked_softmax_fusion')
+    group.add_argument('--blocked-attention', action='store_true',
+                       help='Compute attention in query and key blocks with '
+                       'an online softmax instead of materializing the '
+                       '[b * np, sq, sk] scores; the backward pass '
+                       'recomputes the blocks. Meant for CPU training and '
+                       'inference at long sequence lengths.')
+    group.add_argument('--attention-block-size', type=int, default=256,
+                       help='Queries and keys per block of '
+                       '--blocked-attention.')
     group.add_argument('--no-bias-gelu-fusion', action='store_false',
                        help='Disable bias and gelu fusion.',
                        dest='bias_gelu_fusion')
@@ -512,6 +535,13 @@ def _add_training_args(parser: argparse.ArgumentParser) -> argparse.ArgumentPars
     group.add_argument('--dataloader-type', type=str, default=None,
                        choices=['single', 'cyclic'],
                        help='Single pass vs multiple pass data loader')
+    group.add_argument('--random-sampler-permutation', type=str,
+                       default='randperm', choices=['randperm', 'feistel'],
+                       help='How the cyclic data loader shuffles each data '
+                       'parallel bucket. randperm materializes a torch '
+                       'permutation every epoch; feistel computes positions '
+                       'on the fly, so resuming skips ahead in constant '
+                       'time and memory.')
     group.add_argument('--ds-inference', action='store_true',
                        help='DeepSpeed inference engine being used')
     group.add_argument('--cpu-optimizer', action='store_true',
@@ -739,6 +769,14 @@ def _add_data_args(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
                        help='Path to the vocab file.')
     group.add_argument('--merge-file', type=str, default=None,
                        help='Path to the BPE merge file.')
+    group.add_argument('--tokenizer-cache-dir', type=str, default=None,
+                       help='Node-local directory (e.g. /dev/shm) for a '
+                       'precompiled tokenizer. The first rank of a node '
+                       'parses the vocabulary files and saves the built '
+                       'lookup tables as a single binary file there '
+                       '(created if missing); the other ranks and later '
+                       'jobs load the tokenizer from that file with one '
+                       'read, without parsing or building anything.')
     group.add_argument('--vocab-extra-ids', type=int, default=0,
                        help='Number of additional vocabulary tokens. '
                             'They are used for span masking in the T5 model')
@@ -771,13 +809,39 @@ def _add_data_args(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
                                 'JapaneseSentencePiece'],
                        help='What type of tokenizer to use.')
     group.add_argument('--data-impl', type=str, default='infer',
-                       choices=['lazy', 'cached', 'mmap', 'infer'],
-                       help='Implementation of indexed datasets.')
+                       choices=['lazy', 'cached', 'mmap', 'sharded',
+                                'compressed', 'infer', 'jsonl'],
+                       help='Implementation of indexed datasets. `sharded` '
+                       'reads a `<data-path>.manifest` listing mmap shards. '
+                       '`compressed` reads block compressed tokens written '
+                       'by tools/compress_dataset.py. '
+                       '`jsonl` streams and tokenizes the raw jsonl files '
+                       '(or glob patterns) given as --data-path; it builds '
+                       'no validation or test set.')
+    group.add_argument('--jsonl-key', type=str, default='text',
+                       help='Key of the document text in --data-impl jsonl '
+                       'files.')
+    group.add_argument('--jsonl-position-dir', type=str, default=None,
+                       help='Directory where --data-impl jsonl records the '
+                       'stream position of every shard, so that resuming '
+                       'does not re-tokenize all consumed samples.')
+    group.add_argument('--jsonl-position-interval', type=int, default=1000,
+                       help='Samples of a jsonl shard between two recorded '
+                       'positions.')
     group.add_argument('--reset-position-ids', action='store_true',
                        help='Reset posistion ids after end-of-document token.')
     group.add_argument('--reset-attention-mask', action='store_true',
                        help='Reset self attention maske after '
                        'end-of-document token.')
+    group.add_argument('--implicit-causal-mask', action='store_true',
+                       help='Do not pass a causal attention mask to the '
+                       'model; causal attention layers mask future tokens '
+                       'themselves. Ignored with --reset-attention-mask.')
+    group.add_argument('--compact-document-mask', action='store_true',
+                       help='With --reset-attention-mask, pass per-token '
+                       'document ids [b, s] as the attention mask instead '
+                       'of a [b, 1, s, s] mask; attention expands them when '
+                       'the mask is applied.')
     group.add_argument('--eod-mask-loss', action='store_true',
                        help='Mask loss for the end of document tokens.')
     group.add_argument('--train-data-exact-num-epochs', type=int, default=None,
@@ -785,8 +849,82 @@ def _add_data_args(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
                        'an exact number of epochs of the raw data')
     group.add_argument('--return-data-index', action='store_true',
                        help='Return the index of data sample.')
+    group.add_argument('--zero-copy-samples', action='store_true',
+                       help='GPTDataset returns samples in their storage '
+                       'dtype without copying them out of the mmap; tokens '
+                       'are widened to int64 once per micro-batch when '
+                       'collating.')
+    group.add_argument('--batched-data-fetch', action='store_true',
+                       help='Fetch each micro-batch with a single dataset '
+                       '`get_batch` call that gathers all samples into one '
+                       'array, instead of one `__getitem__` call per sample.')
     group.add_argument('--data-efficiency-curriculum-learning', action='store_true',
                        help='Use DeepSpeed data efficiency library curriculum learning feature.')
+    group.add_argument('--data-staging-dir', type=str, default=None,
+                       help='Node-local directory into which one rank per '
+                       'node copies the dataset .bin/.idx files before they '
+                       'are memory mapped. Copies are reused across jobs.')
+    group.add_argument('--data-staging-max-gb', type=float, default=None,
+                       help='Size limit of --data-staging-dir; least '
+                       'recently used copies are evicted to stay under it.')
+    group.add_argument('--shm-data-loader', action='store_true',
+                       help='Replace the torch DataLoader with one producer '
+                       'process per node that builds the micro-batches of '
+                       'all local ranks into shared memory.')
+    group.add_argument('--shm-loader-depth', type=int, default=4,
+                       help='Micro-batches the --shm-data-loader producer '
+                       'prepares ahead for each rank.')
+    group.add_argument('--shm-loader-core', type=int, default=None,
+                       help='CPU core the --shm-data-loader producer is '
+                       'pinned to, e.g. a core not used for compute.')
+    group.add_argument('--shm-loader-dir', type=str, default='/dev/shm',
+                       help='Node-local directory for the --shm-data-loader '
+                       'socket and lock files.')
+    group.add_argument('--tp-local-data', action='store_true',
+                       help='Build the datasets and data loaders on every '
+                       'tensor parallel rank so that each rank reads the '
+                       'same micro-batch itself instead of receiving it '
+                       'from tensor parallel rank 0.')
+    group.add_argument('--compact-data-broadcast', action='store_true',
+                       help='Broadcast GPT tokens to the tensor parallel '
+                       'ranks in 16 bits (32 bits for vocabularies larger '
+                       'than 65536) and negotiate the batch shape only '
+                       'when it changes.')
+    group.add_argument('--data-readahead-batches', type=int, default=0,
+                       help='Number of micro-batches whose tokens are paged '
+                       'in by a background thread (madvise WILLNEED on the '
+                       '.bin mmap) before the DataLoader draws them, on top '
+                       'of the DataLoader\'s own prefetch. The share of '
+                       'pages already resident at that point is logged '
+                       'every log interval. 0 disables readahead.')
+    group.add_argument('--parallel-index-build', action='store_true',
+                       help='Build the GPT doc/sample/shuffle index mappings '
+                       'with a thread pool, writing them directly into '
+                       'memory-mapped files. The shuffles differ from the '
+                       'serial build, so the files get a `_par` suffix.')
+    group.add_argument('--index-build-threads', type=int, default=None,
+                       help='Number of threads used by --parallel-index-build. '
+                       'Defaults to the number of usable cores.')
+    group.add_argument('--compact-index-dtypes', action='store_true',
+                       help='Store newly built GPT index mappings in the '
+                       'narrowest dtypes that fit (uint16/uint32, and a '
+                       'packed doc/offset record for sample-idx). Mappings '
+                       'in either layout can be loaded.')
+    group.add_argument('--cache-blending-indices', action='store_true',
+                       help='Save the blending indices of --data-path '
+                       'blends next to the first data prefix and memory '
+                       'map them on this and later runs.')
+    group.add_argument('--index-mapping-sharing', type=str, default='none',
+                       choices=['none', 'shm', 'broadcast'],
+                       help='How ranks load the GPT index mappings. none: '
+                       'every rank maps the files on the shared filesystem; '
+                       'shm: one rank per node copies them to '
+                       '--index-mapping-shm-dir and local ranks map the '
+                       'copy; broadcast: rank 0 reads them and broadcasts '
+                       'them over torch.distributed.')
+    group.add_argument('--index-mapping-shm-dir', type=str, default='/dev/shm',
+                       help='Node-local directory used by '
+                       '--index-mapping-sharing shm and broadcast.')
     group.add_argument('--train-idx-path', type=str, default=None,
                        help='Force to use certain index file.')
     group.add_argument('--train-doc-idx-path', type=str, default=None,
@@ -15,11 +15,15 @@
 
 """Blendable dataset."""
 
+import hashlib
+import os
 import time
 
 import numpy as np
 import torch
 
+from megatron import get_args
+from megatron import is_rank_0
 from megatron import print_rank_0
 from megatron import mpu
 
@@ -27,7 +31,12 @@ from megatron import mpu
 class BlendableDataset(torch.utils.data.Dataset):
 
 
-    def __init__(self, datasets, weights):
+    def __init__(self, datasets, weights, index_cache_prefix=None,
+                 index_cache_key=''):
+        """If `index_cache_prefix` is given, the blending indices are built
+        on rank 0, saved next to that prefix and memory mapped by all ranks
+        on this and later runs. `index_cache_key` must identify the blended
+        datasets, e.g. by their prefixes."""
 
         self.datasets = datasets
         num_datasets = len(datasets)
@@ -46,14 +55,13 @@ class BlendableDataset(torch.utils.data.Dataset):
         # Build indecies.
         start_time = time.time()
         assert num_datasets < 255
-        self.dataset_index = np.zeros(self.size, dtype=np.uint8)
-        self.dataset_sample_index = np.zeros(self.size, dtype=np.int64)
-
-        from megatron.data import helpers
-        helpers.build_blending_indices(self.dataset_index,
-                                       self.dataset_sample_index,
-                                       weights, num_datasets, self.size,
-                                       torch.distributed.get_rank() == 0)
+        if index_cache_prefix is None:
+            self.dataset_index, self.dataset_sample_index = \
+                _build_blending_indices(weights, num_datasets, self.size)
+        else:
+            self.dataset_index, self.dataset_sample_index = \
+                _cached_blending_indices(index_cache_prefix, index_cache_key,
+                                         weights, self.datasets, self.size)
         print_rank_0('> elapsed time for building blendable dataset indices: '
                      '{:.2f} (sec)'.format(time.time() - start_time))
 
@@ -66,3 +74,101 @@ class BlendableDataset(torch.utils.data.Dataset):
         dataset_idx = self.dataset_index[idx]
         sample_idx = self.dataset_sample_index[idx]
         return self.datasets[dataset_idx][sample_idx]
+
+
+    def get_batch(self, indices):
+        """Fetch a micro-batch with one batched call per blended dataset."""
+        indices = np.asarray(indices, dtype=np.int64)
+        dataset_idx = self.dataset_index[indices]
+        sample_idx = self.dataset_sample_index[indices]
+        samples = [None] * len(indices)
+        for i in np.unique(dataset_idx):
+            positions = np.nonzero(dataset_idx == i)[0]
+            dataset = self.datasets[i]
+            if hasattr(dataset, 'get_batch'):
+                fetched = dataset.get_batch(sample_idx[positions].tolist())
+            else:
+                fetched = [dataset[j] for j in sample_idx[positions].tolist()]
+            for position, sample in zip(positions, fetched):
+                samples[position] = sample
+        return samples
+
+    def readahead(self, indices, advise=True):
+        """Forward a readahead hint to the blended datasets and sum their
+        page counts."""
+        indices = np.asarray(indices, dtype=np.int64)
+        dataset_idx = self.dataset_index[indices]
+        sample_idx = self.dataset_sample_index[indices]
+        resident, total = 0, 0
+        for i in np.unique(dataset_idx):
+            dataset = self.datasets[i]
+            if not hasattr(dataset, 'readahead'):
+                resident = None
+                continue
+            counts = dataset.readahead(sample_idx[dataset_idx == i], advise)
+            if resident is not None and counts[0] is not None:
+                resident += counts[0]
+            else:
+                resident = None
+            total += counts[1]
+        return resident, total
+
+
+
+def _build_blending_indices(weights, num_datasets, size):
+    dataset_index = np.zeros(size, dtype=np.uint8)
+    dataset_sample_index = np.zeros(size, dtype=np.int64)
+
+    from megatron.data import helpers
+    helpers.build_blending_indices(dataset_index,
+                                   dataset_sample_index,
+                                   weights, num_datasets, size,
+                                   torch.distributed.get_rank() == 0)
+    return dataset_index, dataset_sample_index
+
+
+def _cached_blending_indices(prefix, datasets_key, weights, datasets, size):
+    """Load the blending indices from disk, building them on rank 0 first
+    if they are missing. Files are keyed by `datasets_key`, the weights, the
+    dataset sizes and the total number of samples."""
+    args = get_args()
+    md5 = hashlib.md5(datasets_key.encode())
+    md5.update(np.concatenate([
+        weights, np.array([len(dataset) for dataset in datasets] + [size],
+                          dtype=np.float64)]).tobytes())
+    key = md5.hexdigest()
+    filename = '{}_blending_{}'.format(prefix, key)
+    dataset_index_filename = filename + '_dataset_index.npy'
+    dataset_sample_index_filename = filename + '_dataset_sample_index.npy'
+
+    if is_rank_0():
+        if (not os.path.isfile(dataset_index_filename)) or \
+           (not os.path.isfile(dataset_sample_index_filename)):
+            print_rank_0(' > WARNING: could not find blending index files, '
+                         'building the indices on rank 0 ...')
+            dataset_index, dataset_sample_index = _build_blending_indices(
+                weights, len(datasets), size)
+            # Samples per dataset usually fit in 32 bits.
+            if dataset_sample_index.max(initial=0) < np.iinfo(np.uint32).max:
+                dataset_sample_index = dataset_sample_index.astype(np.uint32)
+            np.save(dataset_index_filename, dataset_index, allow_pickle=False)
+            np.save(dataset_sample_index_filename, dataset_sample_index,
+                    allow_pickle=False)
+
+    if not args.use_cached_dataset:
+        # This should be a barrier but nccl barrier assumes
+        # device_index=rank which is not the case for model
+        # parallel case
+        counts = torch.LongTensor([1])
+        torch.distributed.all_reduce(counts, group=mpu.get_data_parallel_group())
+        torch.distributed.all_reduce(counts, group=mpu.get_pipeline_model_parallel_group())
+        if args.tp_local_data:
+            torch.distributed.all_reduce(
+                counts, group=mpu.get_tensor_model_parallel_group())
+
+    print_rank_0(' > loading blending indices from {}'.format(filename))
+    dataset_index = np.load(dataset_index_filename, allow_pickle=False,
+                            mmap_mode='r')
+    dataset_sample_index = np.load(dataset_sample_index_filename,
+                                   allow_pickle=False, mmap_mode='r')
+    return dataset_index, dataset_sample_index
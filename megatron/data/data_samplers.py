@@ -16,10 +16,16 @@
 """Dataloaders."""
 
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import torch
 import random
 from megatron import get_args
+from megatron import get_num_microbatches
 from megatron import mpu
+from megatron import print_rank_0
 
 
 def build_pretraining_data_loader(dataset, consumed_samples):
@@ -29,30 +35,190 @@ def build_pretraining_data_loader(dataset, consumed_samples):
         return None
     args = get_args()
 
+    if isinstance(dataset, torch.utils.data.IterableDataset):
+        # Streaming datasets shard and resume themselves.
+        dataset.set_consumed_samples(consumed_samples)
+        return torch.utils.data.DataLoader(dataset,
+                                           batch_size=args.micro_batch_size,
+                                           num_workers=args.num_workers,
+                                           pin_memory=True)
+
+    if args.shm_data_loader:
+        from megatron.data.shm_data_loader import SharedMemoryDataLoader
+        return SharedMemoryDataLoader(dataset, consumed_samples)
+
     # Megatron sampler
+    batch_sampler = build_pretraining_batch_sampler(
+        len(dataset), consumed_samples, mpu.get_data_parallel_rank(),
+        mpu.get_data_parallel_world_size())
+
+    if args.data_readahead_batches > 0:
+        assert hasattr(dataset, 'readahead'), \
+            '{} does not support readahead'.format(type(dataset).__name__)
+        batch_sampler = ReadaheadBatchSampler(
+            batch_sampler, dataset, args.data_readahead_batches,
+            report_interval=args.log_interval * get_num_microbatches())
+
+    collate_fn = None
+    if args.zero_copy_samples:
+        collate_fn = collate_zero_copy_samples
+
+    if args.batched_data_fetch:
+        # Hand the whole micro-batch index list to the dataset at once.
+        assert hasattr(dataset, 'get_batch'), \
+            '{} does not support batched fetch'.format(type(dataset).__name__)
+        return torch.utils.data.DataLoader(BatchedFetchDataset(dataset),
+                                           sampler=batch_sampler,
+                                           batch_size=None,
+                                           num_workers=args.num_workers,
+                                           pin_memory=True,
+                                           collate_fn=collate_zero_copy_samples)
+
+    # Torch dataloader.
+    return torch.utils.data.DataLoader(dataset,
+                                       batch_sampler=batch_sampler,
+                                       num_workers=args.num_workers,
+                                       pin_memory=True,
+                                       collate_fn=collate_fn)
+
+
+class BatchedFetchDataset(torch.utils.data.Dataset):
+    """View of a dataset whose items are micro-batches: the index list of
+    a batch sampler is fetched with one `dataset.get_batch` call."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, indices):
+        return self.dataset.get_batch(indices)
+
+
+def build_pretraining_batch_sampler(total_samples, consumed_samples,
+                                    data_parallel_rank, data_parallel_size):
+    """Build the Megatron batch sampler selected by --dataloader-type."""
+    args = get_args()
     if args.dataloader_type == 'single':
-        batch_sampler = MegatronPretrainingSampler(
-            total_samples=len(dataset),
+        return MegatronPretrainingSampler(
+            total_samples=total_samples,
             consumed_samples=consumed_samples,
             micro_batch_size=args.micro_batch_size,
-            data_parallel_rank=mpu.get_data_parallel_rank(),
-            data_parallel_size=mpu.get_data_parallel_world_size())
+            data_parallel_rank=data_parallel_rank,
+            data_parallel_size=data_parallel_size)
     elif args.dataloader_type == 'cyclic':
-        batch_sampler = MegatronPretrainingRandomSampler(
-            total_samples=len(dataset),
+        return MegatronPretrainingRandomSampler(
+            total_samples=total_samples,
             consumed_samples=consumed_samples,
             micro_batch_size=args.micro_batch_size,
-            data_parallel_rank=mpu.get_data_parallel_rank(),
-            data_parallel_size=mpu.get_data_parallel_world_size())
+            data_parallel_rank=data_parallel_rank,
+            data_parallel_size=data_parallel_size,
+            permutation=args.random_sampler_permutation)
     else:
         raise Exception('{} dataloader type is not supported.'.format(
                 args.dataloader_type))
 
-    # Torch dataloader.
-    return torch.utils.data.DataLoader(dataset,
-                                       batch_sampler=batch_sampler,
-                                       num_workers=args.num_workers,
-                                       pin_memory=True)
+
+def collate_zero_copy_samples(batch):
+    """Collate samples whose `text` is still in the storage dtype.
+
+    The tokens of every sample are written straight into one preallocated
+    int64 `[b, s+1]` array, so widening happens once per micro-batch and
+    the only copy out of the mmap is the one into the batch.
+    """
+    texts = [sample['text'] for sample in batch]
+    text = _rows_base(texts)
+    if text is not None:
+        # Samples from `get_batch` are already rows of one batch array.
+        text = text.astype(np.int64, copy=False)
+    else:
+        text = np.empty((len(texts), len(texts[0])), dtype=np.int64)
+        for i, sample_text in enumerate(texts):
+            text[i] = sample_text
+    ret = torch.utils.data.dataloader.default_collate(
+        [{k: v for k, v in sample.items() if k != 'text'} for sample in batch])
+    ret['text'] = torch.from_numpy(text)
+    return ret
+
+
+def _rows_base(rows):
+    """Return the 2D array whose consecutive rows are `rows`, if any."""
+    base = rows[0].base
+    if not isinstance(base, np.ndarray) or \
+            base.shape != (len(rows),) + rows[0].shape or \
+            not base.flags.c_contiguous:
+        return None
+    for i, row in enumerate(rows):
+        if row.base is not base or \
+                row.ctypes.data != base.ctypes.data + i * base.strides[0]:
+            return None
+    return base
+
+
+class ReadaheadBatchSampler:
+    """Wraps a batch sampler and, on a background thread, pages in the
+    tokens of the next `depth` micro-batches before the DataLoader asks
+    for them.
+
+    The DataLoader itself draws `num_workers * prefetch_factor` batches
+    from its sampler ahead of training, so the readahead of a batch starts
+    `depth` batches before the DataLoader draws it, which is in turn ahead
+    of the step that consumes it.
+
+    When a batch is handed to the DataLoader, its pages that are in the
+    page cache are counted with mincore: a batch is a hit if all of its
+    pages are resident and a miss otherwise, i.e. a miss will read from
+    disk. The counts are printed every `report_interval` batches (0
+    disables the report); nothing is counted where mincore is not
+    available.
+    """
+
+    def __init__(self, batch_sampler, dataset, depth, report_interval=0):
+        self.batch_sampler = batch_sampler
+        self.dataset = dataset
+        self.depth = depth
+        self.report_interval = report_interval
+        self.hits = 0
+        self.misses = 0
+        self.resident_pages = 0
+        self.total_pages = 0
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        pending = collections.deque()
+        for batch in self.batch_sampler:
+            pending.append(
+                (batch, self._executor.submit(self.dataset.readahead, batch)))
+            if len(pending) > self.depth:
+                yield self._next(pending)
+        while pending:
+            yield self._next(pending)
+
+    def _next(self, pending):
+        batch, _ = pending.popleft()
+        resident, total = self.dataset.readahead(batch, advise=False)
+        if resident is None:
+            return batch
+        if resident == total:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.resident_pages += resident
+        self.total_pages += total
+        batches = self.hits + self.misses
+        if self.report_interval > 0 and batches % self.report_interval == 0:
+            print_rank_0(' > data readahead: {} of {} batches ({:.1f}% of '
+                         'pages) resident when handed to the data '
+                         'loader'.format(
+                             self.hits, batches,
+                             100.0 * self.resident_pages /
+                             max(self.total_pages, 1)))
+        return batch
+
 
 class MegatronPretrainingSampler:
 
@@ -103,10 +269,57 @@ class MegatronPretrainingSampler:
             yield batch[start_idx:end_idx]
 
 
+class FeistelPermutation:
+    """Bijective pseudo-random permutation of `range(size)` that maps any
+    position in O(1) time and memory.
+
+    A four round Feistel network permutes the smallest power of four that
+    covers `size`; positions that land outside `range(size)` are mapped
+    again until they fall inside (cycle walking), which keeps the result
+    a permutation of `range(size)`.
+    """
+
+    _NUM_ROUNDS = 4
+
+    def __init__(self, size, seed):
+        assert size > 0
+        self.size = size
+        self.half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+        self.mask = np.uint64((1 << self.half_bits) - 1)
+        self.keys = np.random.SeedSequence(seed).generate_state(
+            self._NUM_ROUNDS, dtype=np.uint64)
+
+    def __call__(self, positions):
+        """Map an array of positions to their permuted values."""
+        values = self._encrypt(np.asarray(positions, dtype=np.uint64))
+        outside = values >= self.size
+        while outside.any():
+            values[outside] = self._encrypt(values[outside])
+            outside = values >= self.size
+        return values.astype(np.int64)
+
+    def _encrypt(self, values):
+        shift = np.uint64(self.half_bits)
+        left = values >> shift
+        right = values & self.mask
+        for key in self.keys:
+            left, right = right, left ^ (_mix64(right ^ key) & self.mask)
+        return (left << shift) | right
+
+
+def _mix64(z):
+    """splitmix64 finalizer, applied elementwise with wrap-around."""
+    with np.errstate(over='ignore'):
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return z ^ (z >> np.uint64(31))
+
+
 class MegatronPretrainingRandomSampler:
 
     def __init__(self, total_samples, consumed_samples, micro_batch_size,
-                 data_parallel_rank, data_parallel_size):
+                 data_parallel_rank, data_parallel_size,
+                 permutation='randperm'):
         # Keep a copy of input params for later use.
         self.total_samples = total_samples
         self.consumed_samples = consumed_samples
@@ -117,6 +330,7 @@ class MegatronPretrainingRandomSampler:
             self.micro_batch_size * data_parallel_size
         self.last_batch_size = \
             self.total_samples % self.micro_batch_times_data_parallel_size
+        self.permutation = permutation
 
         # Sanity checks.
         assert self.total_samples > 0, \
@@ -141,7 +355,20 @@ class MegatronPretrainingRandomSampler:
                        * self.micro_batch_size
         bucket_offset = current_epoch_samples // self.data_parallel_size
         start_idx = self.data_parallel_rank * bucket_size
-        
+
+        if self.permutation == 'feistel':
+            # Jump straight to bucket_offset; nothing is materialized.
+            permutation = FeistelPermutation(
+                bucket_size, (self.epoch, self.data_parallel_rank))
+            for offset in range(bucket_offset,
+                                bucket_size - self.micro_batch_size + 1,
+                                self.micro_batch_size):
+                batch = permutation(np.arange(
+                    offset, offset + self.micro_batch_size)) + start_idx
+                self.consumed_samples += self.micro_batch_times_data_parallel_size
+                yield batch.tolist()
+            return
+
         g = torch.Generator()
         g.manual_seed(self.epoch)
         random_idx = torch.randperm(bucket_size, generator=g).tolist()
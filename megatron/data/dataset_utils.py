@@ -32,6 +32,7 @@ from megatron import (
     mpu,
     print_rank_0
 )
+from megatron.data import node_local_cache
 from megatron.data.blendable_dataset import BlendableDataset
 from megatron.data.indexed_dataset import make_dataset as make_indexed_dataset
 from deepspeed.accelerator import get_accelerator
@@ -588,6 +589,8 @@ def get_indexed_dataset_(data_prefix, data_impl, skip_warmup):
     print_rank_0(' > building dataset index ...')
 
     start_time = time.time()
+    data_prefix = node_local_cache.stage_indexed_dataset(data_prefix,
+                                                         data_impl)
     indexed_dataset = make_indexed_dataset(data_prefix,
                                            data_impl,
                                            skip_warmup)
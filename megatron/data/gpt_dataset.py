@@ -18,17 +18,21 @@
 
 """GPT style dataset."""
 
+import hashlib
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 from deepspeed.accelerator import get_accelerator
 from megatron import mpu, is_rank_0, print_rank_0, get_args, get_timers
+from megatron.data import node_local_cache
 from megatron.data.blendable_dataset import BlendableDataset
 from megatron.data.dataset_utils import get_datasets_weights_and_num_samples
 from megatron.data.dataset_utils import get_train_valid_test_split_
 from megatron.data.indexed_dataset import make_dataset as make_indexed_dataset
+from megatron.data.jsonl_dataset import build_streaming_jsonl_dataset
 
 
 def build_train_valid_test_datasets(data_prefix: list[str], data_impl: str, splits_string: str,
@@ -43,6 +47,11 @@ def build_train_valid_test_datasets(data_prefix: list[str], data_impl: str, spli
         splits_string: str (ex: '969, 30, 1')
     """
 
+    # Streamed raw text, training only.
+    if data_impl == 'jsonl':
+        return (build_streaming_jsonl_dataset(data_prefix, seq_length),
+                None, None)
+
     # Single dataset.
     if len(data_prefix) == 1:
         return _build_train_valid_test_datasets(data_prefix[0],
@@ -73,15 +82,23 @@ def build_train_valid_test_datasets(data_prefix: list[str], data_impl: str, spli
             test_datasets.append(test_ds)
 
     # Blend.
+    def blend(datasets, name):
+        if not get_args().cache_blending_indices:
+            return BlendableDataset(datasets, weights)
+        return BlendableDataset(
+            datasets, weights,
+            index_cache_prefix='{}_{}'.format(prefixes[0], name),
+            index_cache_key='\n'.join(prefixes))
+
     blending_train_dataset = None
     if train_datasets:
-        blending_train_dataset = BlendableDataset(train_datasets, weights)
+        blending_train_dataset = blend(train_datasets, 'train')
     blending_valid_dataset = None
     if valid_datasets:
-        blending_valid_dataset = BlendableDataset(valid_datasets, weights)
+        blending_valid_dataset = blend(valid_datasets, 'valid')
     blending_test_dataset = None
     if test_datasets:
-        blending_test_dataset = BlendableDataset(test_datasets, weights)
+        blending_test_dataset = blend(test_datasets, 'test')
 
     return (blending_train_dataset, blending_valid_dataset,
             blending_test_dataset)
@@ -135,6 +152,8 @@ def get_indexed_dataset_(data_prefix, data_impl, skip_warmup):
     print_rank_0(' > building dataset index ...')
 
     start_time = time.time()
+    data_prefix = node_local_cache.stage_indexed_dataset(data_prefix,
+                                                         data_impl)
     indexed_dataset = make_indexed_dataset(data_prefix,
                                            data_impl,
                                            skip_warmup)
@@ -153,6 +172,7 @@ class GPTDataset(torch.utils.data.Dataset):
 
         self.name = name
         self.indexed_dataset = indexed_dataset
+        self.seq_length = seq_length
 
         # Checks
         assert np.min(documents) >= 0
@@ -175,17 +195,18 @@ class GPTDataset(torch.utils.data.Dataset):
         # Get the shuffled index.
         if args.use_timer:
             timers('gptdataset_shuffle_idx').start()
-        idx = self.shuffle_idx[idx]
+        idx = int(self.shuffle_idx[idx])
         if args.use_timer:
             timers('gptdataset_shuffle_idx').stop()
 
         # Start and end documents and offsets.
         if args.use_timer:
             timers('gptdataset_pre').start()
-        doc_index_f = self.sample_idx[idx][0]
-        doc_index_l = self.sample_idx[idx + 1][0]
-        offset_f = self.sample_idx[idx][1]
-        offset_l = self.sample_idx[idx + 1][1]
+        # int() keeps the arithmetic below safe for compact unsigned dtypes.
+        doc_index_f = int(self.sample_idx[idx][0])
+        doc_index_l = int(self.sample_idx[idx + 1][0])
+        offset_f = int(self.sample_idx[idx][1])
+        offset_l = int(self.sample_idx[idx + 1][1])
         if args.use_timer:
             timers('gptdataset_pre').stop()
         # If we are within the same document, just extract the chunk.
@@ -213,21 +234,99 @@ class GPTDataset(torch.utils.data.Dataset):
             sample = np.concatenate(sample_list)
             if args.use_timer:
                 timers('gptdataset_otherwise').stop()
+        # With --zero-copy-samples the sample stays in the storage dtype
+        # (a view into the mmap for single-document samples) and is widened
+        # to int64 once per micro-batch by `collate_zero_copy_samples`.
+        if not args.zero_copy_samples:
+            sample = np.array(sample, dtype=np.int64)
         if args.return_data_index:
             if args.use_timer:
                 timers('gptdataset_dict1').start()
-            ret = {'text': np.array(sample, dtype=np.int64), 'index': np.array([orig_idx], dtype=np.int64)}
+            ret = {'text': sample, 'index': np.array([orig_idx], dtype=np.int64)}
             if args.use_timer:
                 timers('gptdataset_dict1').stop()
             return ret
 
         if args.use_timer:
             timers('gptdataset_dict2').start()
-        ret = {'text': np.array(sample, dtype=np.int64)}
+        ret = {'text': sample}
         if args.use_timer:
             timers('gptdataset_dict2').stop()
         return ret
 
+    def get_batch(self, indices):
+        """Fetch a whole micro-batch.
+
+        The document spans of all samples are resolved with numpy and the
+        tokens are gathered into one `[b, seq_length + 1]` array; the
+        returned samples hold row views of that array.
+        """
+        timers = get_timers()
+        args = get_args()
+        if args.use_timer:
+            timers('gptdataset_getitems').start()
+        orig_idx = np.asarray(indices, dtype=np.int64)
+        docs, offsets, lengths = self._sample_spans(orig_idx)
+
+        dtype = self.indexed_dataset.dtype if args.zero_copy_samples else np.int64
+        text = np.empty((len(orig_idx), self.seq_length + 1), dtype=dtype)
+        assert lengths.sum() == text.size
+        if hasattr(self.indexed_dataset, 'gather'):
+            self.indexed_dataset.gather(docs, offsets, lengths,
+                                        out=text.reshape(-1))
+        else:
+            flat = text.reshape(-1)
+            pos = 0
+            for doc, offset, length in zip(docs, offsets, lengths):
+                flat[pos:pos + length] = self.indexed_dataset.get(
+                    doc, offset=offset, length=length)
+                pos += length
+        if args.use_timer:
+            timers('gptdataset_getitems').stop()
+
+        if args.return_data_index:
+            return [{'text': text[i], 'index': orig_idx[i:i + 1]}
+                    for i in range(len(orig_idx))]
+        return [{'text': text[i]} for i in range(len(orig_idx))]
+
+    def readahead(self, indices, advise=True):
+        """Start paging in the tokens of the given samples. Returns the
+        number of their pages that were already in the page cache (None
+        if unknown) and the number of their pages; `advise=False` only
+        counts."""
+        if not hasattr(self.indexed_dataset, 'readahead'):
+            return None, 0
+        return self.indexed_dataset.readahead(
+            *self._sample_spans(np.asarray(indices, dtype=np.int64)),
+            advise=advise)
+
+    def _sample_spans(self, orig_idx):
+        """Return the (document, offset, length) spans that make up the
+        given samples, concatenated in sample order."""
+        idx = self.shuffle_idx[orig_idx].astype(np.int64)
+        doc_index_f, offset_f = _sample_idx_columns(self.sample_idx[idx])
+        doc_index_l, offset_l = _sample_idx_columns(self.sample_idx[idx + 1])
+        doc_index_f = doc_index_f.astype(np.int64)
+        doc_index_l = doc_index_l.astype(np.int64)
+
+        # Span j of sample i is document doc_idx[doc_index_f[i] + j].
+        num_spans = doc_index_l - doc_index_f + 1
+        first_span = np.cumsum(num_spans) - num_spans
+        last_span = first_span + num_spans - 1
+        span_sample = np.repeat(np.arange(len(idx)), num_spans)
+        span_doc_index = doc_index_f[span_sample] + \
+            np.arange(num_spans.sum()) - first_span[span_sample]
+        docs = self.doc_idx[span_doc_index]
+
+        # Whole documents, except the start of the first span and the end
+        # of the last span of every sample.
+        offsets = np.zeros(len(docs), dtype=np.int64)
+        offsets[first_span] = offset_f
+        ends = self.indexed_dataset.sizes[docs].astype(np.int64)
+        ends[last_span] = offset_l.astype(np.int64) + 1
+        lengths = ends - offsets
+        return docs, offsets, lengths
+
 
 def _build_index_mappings(name, data_prefix, documents, sizes,
                           num_samples, seq_length, seed):
@@ -254,6 +353,9 @@ def _build_index_mappings(name, data_prefix, documents, sizes,
         _filename += '_{}ns'.format(num_samples)
     _filename += '_{}sl'.format(seq_length)
     _filename += '_{}s'.format(seed)
+    if args.parallel_index_build:
+        # The parallel shuffle produces a different permutation.
+        _filename += '_par'
     doc_idx_filename = _filename + '_doc_idx.npy'
     sample_idx_filename = _filename + '_sample_idx.npy'
     shuffle_idx_filename = _filename + '_shuffle_idx.npy'
@@ -290,6 +392,7 @@ def _build_index_mappings(name, data_prefix, documents, sizes,
             # not mean anything.
             if num_epochs == 1:
                 separate_last_epoch = False
+                num_samples_from_epochs_minus_one = None
                 print(' > only one epoch required, setting '
                       'separate_last_epoch to False', flush=True)
 
@@ -321,40 +424,20 @@ def _build_index_mappings(name, data_prefix, documents, sizes,
                 print(string.format(last_epoch_num_samples,
                                     num_samples_per_epoch), flush=True)
 
-            # doc-idx.
-            start_time = time.time()
-            doc_idx = _build_doc_idx(documents, num_epochs, np_rng,
-                                     separate_last_epoch)
-            np.save(doc_idx_filename, doc_idx, allow_pickle=True)
-            print_rank_0(' > elasped time to build and save doc-idx mapping '
-                         '(seconds): {:4f}'.format(time.time() - start_time))
-            # sample-idx.
-            start_time = time.time()
-            # Use C++ implementation for speed.
-            # First compile and then import.
-            from megatron.data import helpers
-            assert doc_idx.dtype == np.int32
-            assert sizes.dtype == np.int32
-            sample_idx = helpers.build_sample_idx(sizes, doc_idx, seq_length,
-                                                  num_epochs, tokens_per_epoch)
-            # sample_idx = _build_sample_idx(sizes, doc_idx, seq_length,
-            #                               num_epochs, tokens_per_epoch)
-            np.save(sample_idx_filename, sample_idx, allow_pickle=True)
-            print_rank_0(' > elasped time to build and save sample-idx mapping '
-                         '(seconds): {:4f}'.format(time.time() - start_time))
-            # shuffle-idx.
-            start_time = time.time()
-            # -1 is due to data structure used to retieve the index:
-            #    sample i --> [sample_idx[i], sample_idx[i+1])
-            if separate_last_epoch:
-                num_samples_ = num_samples_from_epochs_minus_one
+            if args.parallel_index_build:
+                _build_index_mappings_parallel(
+                    documents, sizes, num_epochs, tokens_per_epoch,
+                    seq_length, seed, separate_last_epoch,
+                    num_samples_from_epochs_minus_one, doc_idx_filename,
+                    sample_idx_filename, shuffle_idx_filename,
+                    args.index_build_threads, args.compact_index_dtypes)
             else:
-                num_samples_ = sample_idx.shape[0] - 1
-            shuffle_idx = _build_shuffle_idx(num_samples_,
-                                             sample_idx.shape[0] - 1, np_rng)
-            np.save(shuffle_idx_filename, shuffle_idx, allow_pickle=True)
-            print_rank_0(' > elasped time to build and save shuffle-idx mapping'
-                         ' (seconds): {:4f}'.format(time.time() - start_time))
+                _build_index_mappings_serial(
+                    documents, sizes, num_epochs, tokens_per_epoch,
+                    seq_length, np_rng, separate_last_epoch,
+                    num_samples_from_epochs_minus_one, doc_idx_filename,
+                    sample_idx_filename, shuffle_idx_filename,
+                    args.compact_index_dtypes)
 
     if not args.use_cached_dataset:
         # This should be a barrier but nccl barrier assumes
@@ -366,18 +449,22 @@ def _build_index_mappings(name, data_prefix, documents, sizes,
         assert counts[0].item() == (
             torch.distributed.get_world_size() //
             torch.distributed.get_world_size(group=mpu.get_tensor_model_parallel_group()))
+        if args.tp_local_data:
+            # Every tensor parallel rank reads the mappings.
+            torch.distributed.all_reduce(
+                counts, group=mpu.get_tensor_model_parallel_group())
 
     # Load mappings.
     start_time = time.time()
     print_rank_0(' > loading doc-idx mapping from {}'.format(
         doc_idx_filename))
-    doc_idx = np.load(doc_idx_filename, allow_pickle=True, mmap_mode='r')
+    doc_idx = _load_index_mapping(doc_idx_filename)
     print_rank_0(' > loading sample-idx mapping from {}'.format(
         sample_idx_filename))
-    sample_idx = np.load(sample_idx_filename, allow_pickle=True, mmap_mode='r')
+    sample_idx = _load_index_mapping(sample_idx_filename)
     print_rank_0(' > loading shuffle-idx mapping from {}'.format(
         shuffle_idx_filename))
-    shuffle_idx = np.load(shuffle_idx_filename, allow_pickle=True, mmap_mode='r')
+    shuffle_idx = _load_index_mapping(shuffle_idx_filename)
     print_rank_0('    loaded indexed file in {:3.3f} seconds'.format(
         time.time() - start_time))
     print_rank_0('    total number of samples: {}'.format(
@@ -387,6 +474,366 @@ def _build_index_mappings(name, data_prefix, documents, sizes,
     return doc_idx, sample_idx, shuffle_idx
 
 
+def _load_index_mapping(filename):
+    """Load an index mapping the way selected by --index-mapping-sharing.
+
+    none:      every rank memory maps the file on the shared filesystem.
+    shm:       the first rank of each node copies the file to a node-local
+               directory and all local ranks memory map that copy.
+    broadcast: rank 0 reads the file and broadcasts it to the other ranks;
+               the first rank of each node saves it to
+               --index-mapping-shm-dir and local ranks map that copy.
+    """
+    args = get_args()
+    if args.index_mapping_sharing == 'broadcast':
+        return _broadcast_index_mapping(filename)
+    if args.index_mapping_sharing == 'shm':
+        filename = node_local_cache.stage_file(filename,
+                                               args.index_mapping_shm_dir)
+    return np.load(filename, allow_pickle=True, mmap_mode='r')
+
+
+# Dtypes of broadcast index mappings and their fields.
+_MAPPING_DTYPES = (np.uint16, np.uint32, np.int32, np.int64)
+# File size, mtime, ndim, shape (at most 2 dims), number of fields and the
+# dtype codes of the array or of its 'doc' and 'offset' fields.
+_MAPPING_HEADER_SIZE = 8
+
+
+def _mapping_header(filename, mapping):
+    """Encode the file stat, shape and dtype of a mapping as int64s."""
+    stat = os.stat(filename)
+    shape = list(mapping.shape) + [0] * (2 - mapping.ndim)
+    if mapping.dtype.names is not None:
+        codes = [_MAPPING_DTYPES.index(mapping.dtype[name])
+                 for name in ('doc', 'offset')]
+    else:
+        codes = [_MAPPING_DTYPES.index(mapping.dtype), 0]
+    return [stat.st_size, stat.st_mtime_ns, mapping.ndim] + shape + \
+        [len(mapping.dtype.names or ())] + codes
+
+
+def _parse_mapping_header(header):
+    """Return `(size, mtime, shape, dtype)` of `_mapping_header`."""
+    size, mtime, ndim, rows, columns, num_fields, code, offset_code = header
+    shape = (rows, columns)[:ndim]
+    if num_fields:
+        dtype = np.dtype([('doc', _MAPPING_DTYPES[code]),
+                          ('offset', _MAPPING_DTYPES[offset_code])])
+    else:
+        dtype = np.dtype(_MAPPING_DTYPES[code])
+    return size, mtime, shape, dtype
+
+
+def _broadcast_index_mapping(filename):
+    """Read `filename` on rank 0 and broadcast it, first along the pipeline
+    group of rank 0, then along every data parallel group. With
+    --tp-local-data it is first broadcast along the tensor parallel group
+    of rank 0.
+
+    The first rank of every node saves the mapping to
+    --index-mapping-shm-dir and all ranks memory map that copy, so a node
+    holds the mapping once.
+    """
+    args = get_args()
+    device = 'cpu' if args.no_cuda else \
+        get_accelerator().current_device_name()
+    is_reader = torch.distributed.get_rank() == 0
+    first_data_parallel_rank = mpu.get_data_parallel_rank() == 0
+
+    def broadcast(tensor):
+        if args.tp_local_data and first_data_parallel_rank and \
+                mpu.is_pipeline_first_stage(ignore_virtual=True):
+            torch.distributed.broadcast(
+                tensor, mpu.get_tensor_model_parallel_src_rank(),
+                group=mpu.get_tensor_model_parallel_group())
+        if first_data_parallel_rank:
+            torch.distributed.broadcast(
+                tensor, mpu.get_pipeline_model_parallel_first_rank(),
+                group=mpu.get_pipeline_model_parallel_group())
+        torch.distributed.broadcast(
+            tensor, mpu.get_data_parallel_src_rank(),
+            group=mpu.get_data_parallel_group())
+
+    # A fixed size header, so every rank posts the same receives.
+    header = torch.zeros(_MAPPING_HEADER_SIZE, dtype=torch.int64)
+    if is_reader:
+        mapping = np.load(filename, allow_pickle=False, mmap_mode='r')
+        header[:] = torch.tensor(_mapping_header(filename, mapping))
+    header = header.to(device)
+    broadcast(header)
+    size, mtime, shape, dtype = _parse_mapping_header(header.tolist())
+
+    if is_reader:
+        payload = torch.from_numpy(
+            np.ascontiguousarray(mapping).reshape(-1).view(np.uint8)).to(device)
+    else:
+        payload = torch.empty(int(np.prod(shape)) * dtype.itemsize,
+                              dtype=torch.uint8, device=device)
+    broadcast(payload)
+
+    # The copy is keyed like node_local_cache.stage_file.
+    key = hashlib.md5('{}:{}:{};'.format(os.path.abspath(filename), size,
+                                         mtime).encode()).hexdigest()
+    local_path = os.path.join(args.index_mapping_shm_dir,
+                              'megatron_{}_{}'.format(
+                                  key, os.path.basename(filename)))
+
+    def save(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            np.save(f, payload.cpu().numpy().view(dtype).reshape(shape),
+                    allow_pickle=False)
+
+    node_local_cache.build_file(local_path, save)
+    del payload
+    return np.load(local_path, allow_pickle=False, mmap_mode='r')
+
+
+def _build_index_mappings_serial(documents, sizes, num_epochs,
+                                 tokens_per_epoch, seq_length, np_rng,
+                                 separate_last_epoch,
+                                 num_samples_from_epochs_minus_one,
+                                 doc_idx_filename, sample_idx_filename,
+                                 shuffle_idx_filename, compact=False):
+    """Build and save doc-idx, sample-idx and shuffle-idx on one thread.
+
+    With `compact`, each mapping is saved in the narrowest dtype that fits
+    (see `_compact_sample_idx`).
+    """
+    # doc-idx.
+    start_time = time.time()
+    doc_idx = _build_doc_idx(documents, num_epochs, np_rng,
+                             separate_last_epoch)
+    if compact:
+        np.save(doc_idx_filename,
+                doc_idx.astype(_index_dtype(np.max(documents))),
+                allow_pickle=True)
+    else:
+        np.save(doc_idx_filename, doc_idx, allow_pickle=True)
+    print_rank_0(' > elasped time to build and save doc-idx mapping '
+                 '(seconds): {:4f}'.format(time.time() - start_time))
+    # sample-idx.
+    start_time = time.time()
+    # Use C++ implementation for speed.
+    # First compile and then import.
+    from megatron.data import helpers
+    assert doc_idx.dtype == np.int32
+    assert sizes.dtype == np.int32
+    sample_idx = helpers.build_sample_idx(sizes, doc_idx, seq_length,
+                                          num_epochs, tokens_per_epoch)
+    # sample_idx = _build_sample_idx(sizes, doc_idx, seq_length,
+    #                               num_epochs, tokens_per_epoch)
+    if compact:
+        np.save(sample_idx_filename,
+                _compact_sample_idx(sample_idx, len(doc_idx),
+                                    np.max(sizes[documents])),
+                allow_pickle=True)
+    else:
+        np.save(sample_idx_filename, sample_idx, allow_pickle=True)
+    print_rank_0(' > elasped time to build and save sample-idx mapping '
+                 '(seconds): {:4f}'.format(time.time() - start_time))
+    # shuffle-idx.
+    start_time = time.time()
+    # -1 is due to data structure used to retieve the index:
+    #    sample i --> [sample_idx[i], sample_idx[i+1])
+    if separate_last_epoch:
+        num_samples_ = num_samples_from_epochs_minus_one
+    else:
+        num_samples_ = sample_idx.shape[0] - 1
+    shuffle_idx = _build_shuffle_idx(num_samples_,
+                                     sample_idx.shape[0] - 1, np_rng,
+                                     compact)
+    np.save(shuffle_idx_filename, shuffle_idx, allow_pickle=True)
+    print_rank_0(' > elasped time to build and save shuffle-idx mapping'
+                 ' (seconds): {:4f}'.format(time.time() - start_time))
+
+
+# Work unit sizes of the parallel builder. They are independent of the number
+# of threads so that the mappings do not depend on the machine they are built on.
+_PARALLEL_CHUNK_SIZE = 1 << 22
+_PARALLEL_SHUFFLE_BUCKETS = 256
+
+
+def _build_index_mappings_parallel(documents, sizes, num_epochs,
+                                   tokens_per_epoch, seq_length, seed,
+                                   separate_last_epoch,
+                                   num_samples_from_epochs_minus_one,
+                                   doc_idx_filename, sample_idx_filename,
+                                   shuffle_idx_filename, num_threads,
+                                   compact=False):
+    """Build doc-idx, sample-idx and shuffle-idx with a thread pool, writing
+    each mapping directly into a memory-mapped `.npy` file.
+
+    sample-idx is identical to `helpers.build_sample_idx` for the same
+    doc-idx. doc-idx and shuffle-idx are uniform permutations like the
+    serial ones, but drawn differently, hence the `_par` filename suffix.
+    """
+    if num_threads is None:
+        num_threads = len(os.sched_getaffinity(0))
+    print_rank_0(' > building index mappings with {} threads ...'.format(
+        num_threads))
+    total_start_time = time.time()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        # doc-idx.
+        start_time = time.time()
+        num_docs = len(documents)
+        doc_idx = np.lib.format.open_memmap(
+            doc_idx_filename, mode='w+',
+            dtype=_index_dtype(np.max(documents)) if compact else np.int32,
+            shape=(num_epochs * num_docs,))
+        documents = np.asarray(documents, dtype=np.int32)
+        make_chunk = lambda lo, hi: documents[np.arange(lo, hi) % num_docs]
+        if separate_last_epoch:
+            first = (num_epochs - 1) * num_docs
+            _parallel_shuffle_into(doc_idx[:first], make_chunk,
+                                   [seed, 0, 0], executor)
+            _parallel_shuffle_into(doc_idx[first:], make_chunk,
+                                   [seed, 0, 1], executor)
+        else:
+            _parallel_shuffle_into(doc_idx, make_chunk, [seed, 0, 0], executor)
+        doc_idx.flush()
+        _print_build_stats('doc-idx', doc_idx, start_time)
+
+        # sample-idx.
+        start_time = time.time()
+        num_samples = (num_epochs * tokens_per_epoch - 1) // seq_length
+        if compact:
+            sample_idx = np.lib.format.open_memmap(
+                sample_idx_filename, mode='w+',
+                dtype=_sample_idx_dtype(len(doc_idx),
+                                        np.max(sizes[documents])),
+                shape=(num_samples + 1,))
+        else:
+            sample_idx = np.lib.format.open_memmap(
+                sample_idx_filename, mode='w+', dtype=np.int32,
+                shape=(num_samples + 1, 2))
+        _parallel_build_sample_idx(sample_idx, sizes, doc_idx, seq_length,
+                                   executor)
+        sample_idx.flush()
+        _print_build_stats('sample-idx', sample_idx, start_time)
+
+        # shuffle-idx.
+        start_time = time.time()
+        # -1 is due to data structure used to retieve the index:
+        #    sample i --> [sample_idx[i], sample_idx[i+1])
+        total_size = sample_idx.shape[0] - 1
+        if separate_last_epoch:
+            num_samples_ = num_samples_from_epochs_minus_one
+        else:
+            num_samples_ = total_size
+        if compact:
+            dtype_ = _index_dtype(total_size)
+        else:
+            dtype_ = np.uint32
+            if total_size >= (np.iinfo(np.uint32).max - 1):
+                dtype_ = np.int64
+        shuffle_idx = np.lib.format.open_memmap(
+            shuffle_idx_filename, mode='w+', dtype=dtype_,
+            shape=(total_size,))
+        make_chunk = lambda lo, hi: np.arange(lo, hi, dtype=dtype_)
+        _parallel_shuffle_into(shuffle_idx[:num_samples_], make_chunk,
+                               [seed, 1, 0], executor)
+        _parallel_shuffle_into(
+            shuffle_idx[num_samples_:],
+            lambda lo, hi: make_chunk(num_samples_ + lo, num_samples_ + hi),
+            [seed, 1, 1], executor)
+        shuffle_idx.flush()
+        _print_build_stats('shuffle-idx', shuffle_idx, start_time)
+    print_rank_0(' > elasped time to build and save all index mappings '
+                 '(seconds): {:4f}'.format(time.time() - total_start_time))
+
+
+def _print_build_stats(name, mapping, start_time):
+    elapsed = time.time() - start_time
+    print_rank_0(' > elasped time to build and save {} mapping (seconds): '
+                 '{:4f}, {} entries of {}, {:.1f} MB, {:.2f} M entries/s'.format(
+                     name, elapsed, mapping.shape[0], mapping.dtype,
+                     mapping.nbytes / 2**20,
+                     mapping.shape[0] / max(elapsed, 1e-9) / 1e6))
+
+
+def _chunk_bounds(size):
+    bounds = list(range(0, size, _PARALLEL_CHUNK_SIZE)) + [size]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _parallel_build_sample_idx(sample_idx, sizes, doc_idx, seq_length,
+                               executor):
+    """Fill `sample_idx` like `helpers.build_sample_idx`, in parallel.
+
+    Sample i starts at token i * seq_length of the flattened doc-idx, so
+    every entry is found independently by a binary search over the
+    cumulative document lengths.
+    """
+    doc_ends = np.cumsum(sizes[doc_idx], dtype=np.int64)
+
+    def fill(lo, hi):
+        positions = np.arange(lo, hi, dtype=np.int64) * seq_length
+        doc_index = np.searchsorted(doc_ends, positions, side='right')
+        doc_starts = doc_ends[doc_index] - sizes[doc_idx[doc_index]]
+        doc_column, offset_column = _sample_idx_columns(sample_idx)
+        doc_column[lo:hi] = doc_index
+        offset_column[lo:hi] = positions - doc_starts
+
+    list(executor.map(lambda bounds: fill(*bounds),
+                      _chunk_bounds(sample_idx.shape[0])))
+    # The first sample starts at the first document even if it is empty.
+    for column in _sample_idx_columns(sample_idx):
+        column[0] = 0
+
+
+def _parallel_shuffle_into(out, make_chunk, seed, executor):
+    """Write a uniform random permutation of the values `make_chunk(0, n)`
+    into `out` (Rao-Sandelius shuffle).
+
+    Each chunk of values is scattered into random buckets, then every bucket
+    is shuffled on its own. Chunks and buckets are processed in parallel and
+    each has its own random stream derived from `seed`.
+    """
+    size = out.shape[0]
+    if size == 0:
+        return
+    chunks = _chunk_bounds(size)
+    seed_sequences = np.random.SeedSequence(seed).spawn(
+        len(chunks) + _PARALLEL_SHUFFLE_BUCKETS)
+
+    def chunk_buckets(c):
+        lo, hi = chunks[c]
+        rng = np.random.Generator(np.random.PCG64(seed_sequences[c]))
+        return rng.integers(0, _PARALLEL_SHUFFLE_BUCKETS, size=hi - lo,
+                            dtype=np.uint8)
+
+    # Bucket sizes per chunk give every (bucket, chunk) its output range.
+    counts = np.stack(list(executor.map(
+        lambda c: np.bincount(chunk_buckets(c),
+                              minlength=_PARALLEL_SHUFFLE_BUCKETS),
+        range(len(chunks)))))
+    bucket_major = counts.T.reshape(-1)
+    starts = (np.cumsum(bucket_major) - bucket_major).reshape(
+        _PARALLEL_SHUFFLE_BUCKETS, len(chunks))
+
+    def scatter(c):
+        # The bucket draws are regenerated rather than kept in memory.
+        buckets = chunk_buckets(c)
+        order = np.argsort(buckets, kind='stable')
+        values = make_chunk(*chunks[c])[order]
+        ends = np.cumsum(counts[c])
+        for b in range(_PARALLEL_SHUFFLE_BUCKETS):
+            out[starts[b, c]:starts[b, c] + counts[c, b]] = \
+                values[ends[b] - counts[c, b]:ends[b]]
+
+    list(executor.map(scatter, range(len(chunks))))
+
+    bucket_bounds = np.concatenate([[0], np.cumsum(counts.sum(axis=0))])
+
+    def shuffle(b):
+        rng = np.random.Generator(np.random.PCG64(
+            seed_sequences[len(chunks) + b]))
+        rng.shuffle(out[bucket_bounds[b]:bucket_bounds[b + 1]])
+
+    list(executor.map(shuffle, range(_PARALLEL_SHUFFLE_BUCKETS)))
+
+
 def _num_tokens(documents, sizes):
     """Total number of tokens in the dataset."""
     return np.sum(sizes[documents])
@@ -472,7 +919,7 @@ def _build_sample_idx(sizes, doc_idx, seq_length,
     return sample_idx
 
 
-def _build_shuffle_idx(num_samples, total_size, np_rng):
+def _build_shuffle_idx(num_samples, total_size, np_rng, compact=False):
     """Build the range [0, size) and shuffle."""
     print(' > building shuffle index with split [0, {}) and [{}, {}) '
           '...'.format(num_samples, num_samples, total_size), flush=True)
@@ -480,6 +927,8 @@ def _build_shuffle_idx(num_samples, total_size, np_rng):
     dtype_ = np.uint32
     if total_size >= (np.iinfo(np.uint32).max - 1):
         dtype_ = np.int64
+    if compact:
+        dtype_ = _index_dtype(total_size)
 
     shuffle_idx_first = np.arange(start=0, stop=num_samples,
                                   step=1, dtype=dtype_)
@@ -492,3 +941,35 @@ def _build_shuffle_idx(num_samples, total_size, np_rng):
     np_rng.shuffle(shuffle_idx_last)
 
     return np.concatenate((shuffle_idx_first, shuffle_idx_last))
+
+
+def _index_dtype(max_value):
+    """Narrowest dtype holding the indices [0, max_value]."""
+    for dtype_ in (np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype_).max:
+            return dtype_
+    return np.int64
+
+
+def _sample_idx_dtype(doc_idx_size, max_doc_length):
+    """Structured dtype of a compact sample-idx. The dtype of each field is
+    stored in the `.npy` header, so loading needs no extra metadata."""
+    return np.dtype([('doc', _index_dtype(doc_idx_size)),
+                     ('offset', _index_dtype(max_doc_length))])
+
+
+def _compact_sample_idx(sample_idx, doc_idx_size, max_doc_length):
+    """Convert a `[n, 2]` sample-idx into the compact structured layout."""
+    compact = np.empty(sample_idx.shape[0],
+                       dtype=_sample_idx_dtype(doc_idx_size, max_doc_length))
+    compact['doc'] = sample_idx[:, 0]
+    compact['offset'] = sample_idx[:, 1]
+    return compact
+
+
+def _sample_idx_columns(sample_idx):
+    """Return the (doc-idx index, offset) columns of sample-idx rows in either
+    the `[n, 2]` or the compact structured layout."""
+    if sample_idx.dtype.names is not None:
+        return sample_idx['doc'], sample_idx['offset']
+    return sample_idx[..., 0], sample_idx[..., 1]
@@ -15,6 +15,10 @@
 
 from functools import lru_cache
 import argparse
+import collections
+import ctypes
+import ctypes.util
+import mmap
 import os
 import shutil
 import struct
@@ -34,10 +38,14 @@ def __best_fitting_dtype(vocab_size=None):
 
 
 def get_available_dataset_impl():
-    return ['lazy', 'cached', 'mmap']
+    return ['lazy', 'cached', 'mmap', 'sharded', 'compressed']
 
 
 def infer_dataset_impl(path):
+    if ShardedMMapIndexedDataset.exists(path):
+        return 'sharded'
+    if CompressedIndexedDataset.exists(path):
+        return 'compressed'
     if IndexedDataset.exists(path):
         with open(index_file_path(path), 'rb') as f:
             magic = f.read(8)
@@ -56,11 +64,16 @@ def infer_dataset_impl(path):
 def make_builder(out_file, impl, vocab_size=None):
     if impl == 'mmap':
         return MMapIndexedDatasetBuilder(out_file, dtype=__best_fitting_dtype(vocab_size))
+    elif impl == 'compressed':
+        return CompressedIndexedDatasetBuilder(out_file,
+                                               dtype=__best_fitting_dtype(vocab_size))
     else:
         return IndexedDatasetBuilder(out_file)
 
 
 def make_dataset(path, impl, skip_warmup=False):
+    if impl in ('sharded', 'infer') and ShardedMMapIndexedDataset.exists(path):
+        return ShardedMMapIndexedDataset(path, skip_warmup)
     if not IndexedDataset.exists(path):
         print(f"Dataset does not exist: {path}")
         print("Path should be a basename that both .idx and .bin can be appended to get full filenames.")
@@ -73,13 +86,19 @@ def make_dataset(path, impl, skip_warmup=False):
         return IndexedCachedDataset(path)
     elif impl == 'mmap' and MMapIndexedDataset.exists(path):
         return MMapIndexedDataset(path, skip_warmup)
+    elif impl == 'compressed' and CompressedIndexedDataset.exists(path):
+        return CompressedIndexedDataset(path, skip_warmup)
     print(f"Unknown dataset implementation: {impl}")
     return None
 
 
 def dataset_exists(path, impl):
+    if impl == 'sharded':
+        return ShardedMMapIndexedDataset.exists(path)
     if impl == 'mmap':
         return MMapIndexedDataset.exists(path)
+    if impl == 'compressed':
+        return CompressedIndexedDataset.exists(path)
     else:
         return IndexedDataset.exists(path)
 
@@ -121,6 +140,41 @@ def data_file_path(prefix_path):
     return prefix_path + '.bin'
 
 
+def manifest_file_path(prefix_path):
+    return prefix_path + '.manifest'
+
+
+def read_manifest(path):
+    """Return the shard prefixes listed in a manifest file.
+
+    One shard prefix per line; blank lines and lines starting with `#` are
+    ignored. Relative prefixes are resolved against the manifest directory.
+    """
+    base_dir = os.path.dirname(os.path.abspath(path))
+    prefixes = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if not os.path.isabs(line):
+                line = os.path.join(base_dir, line)
+            prefixes.append(line)
+    return prefixes
+
+
+def write_manifest(path, prefixes):
+    """Write a manifest listing `prefixes`, stored relative to its directory
+    when they live below it so the dataset can be moved as a whole."""
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, 'w') as f:
+        for prefix in prefixes:
+            prefix = os.path.abspath(prefix)
+            if os.path.commonpath([base_dir, prefix]) == base_dir:
+                prefix = os.path.relpath(prefix, base_dir)
+            f.write(prefix + '\n')
+
+
 def create_doc_idx(sizes):
     doc_idx = [0]
     for i, s in enumerate(sizes):
@@ -340,6 +394,85 @@ def _warmup_mmap_file(path):
             pass
 
 
+def _load_mincore():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        mincore = libc.mincore
+    except (OSError, AttributeError):
+        return None
+    mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+    mincore.restype = ctypes.c_int
+    return mincore
+
+
+_mincore = _load_mincore()
+
+
+def _resident_pages(mmap_obj, start, end):
+    """Return how many pages of the byte range [start, end) of a mapped
+    file are in the page cache, or None if mincore is not available.
+    `start` must be page aligned."""
+    if _mincore is None:
+        return None
+    vec = np.empty((end - start + mmap.PAGESIZE - 1) // mmap.PAGESIZE,
+                   dtype=np.uint8)
+    address = np.frombuffer(mmap_obj, dtype=np.uint8).ctypes.data + start
+    if _mincore(address, end - start, vec.ctypes.data) != 0:
+        return None
+    return int(np.count_nonzero(vec & 1))
+
+
+def _readahead_mmap(mmap_obj, starts, nbytes, advise=True):
+    """Ask the kernel to bring the byte ranges [starts[i], starts[i] +
+    nbytes[i]) of a mapped file into the page cache without blocking.
+
+    Ranges are page aligned and merged so that a shuffled micro-batch
+    costs a handful of madvise calls. Falls back to pread where madvise is
+    not available.
+
+    Returns `(resident, total)`, the number of pages of the ranges that
+    were in the page cache before any advice and the number of pages of
+    the ranges; `resident` is None where mincore is not available. With
+    `advise=False` only the residency is measured.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = starts + np.asarray(nbytes, dtype=np.int64)
+    if len(starts) == 0:
+        return 0, 0
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order] // mmap.PAGESIZE * mmap.PAGESIZE
+    ends = np.maximum.accumulate(ends[order])
+    # A new run starts wherever the previous ranges end before this one.
+    new_run = np.ones(len(starts), dtype=bool)
+    new_run[1:] = starts[1:] > ends[:-1]
+    run_starts = starts[new_run].tolist()
+    run_ends = ends[np.append(np.nonzero(new_run)[0][1:] - 1,
+                              len(ends) - 1)].tolist()
+    resident = 0
+    total = 0
+    for start, end in zip(run_starts, run_ends):
+        total += (end - start + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+        if resident is not None:
+            pages = _resident_pages(mmap_obj, start, end)
+            resident = None if pages is None else resident + pages
+    if not advise:
+        return resident, total
+    if hasattr(mmap_obj, 'madvise') and hasattr(mmap, 'MADV_WILLNEED'):
+        for start, end in zip(run_starts, run_ends):
+            mmap_obj.madvise(mmap.MADV_WILLNEED, start, end - start)
+    else:
+        for start, end in zip(run_starts, run_ends):
+            mmap_obj[start:end]
+    return resident, total
+
+
+def _add_residency(counts, other):
+    """Sum two `(resident, total)` page counts of `_readahead_mmap`."""
+    resident = None if counts[0] is None or other[0] is None \
+        else counts[0] + other[0]
+    return resident, counts[1] + other[1]
+
+
 def exscan_from_cumsum_(arr):
     # given an array holding the result of an inclusive scan (cumsum),
     # convert to an exclusive scan (shift to the right)
@@ -350,6 +483,16 @@ def exscan_from_cumsum_(arr):
         arr[0] = 0
 
 
+def span_positions(starts, lengths):
+    """Return the flat element positions covered by the spans
+    [starts[i], starts[i] + lengths[i]), concatenated in order."""
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    span_offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - span_offsets, lengths) + \
+        np.arange(lengths.sum(), dtype=np.int64)
+
+
 def get_pointers_with_total(sizes, elemsize, dtype):
     """Return a numpy array of type np.dtype giving the byte offsets.
 
@@ -557,6 +700,41 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
             timers('frombuffer').stop()
         return np_array
 
+    def get_batch(self, indices):
+        """Retrieves several items at once as a list of arrays."""
+        indices = np.asarray(indices, dtype=np.int64)
+        pointers = self._index._pointers[indices]
+        sizes = self._index._sizes[indices]
+        return [np.frombuffer(self._bin_buffer, dtype=self._index.dtype,
+                              count=size, offset=ptr)
+                for ptr, size in zip(pointers.tolist(), sizes.tolist())]
+
+    def gather(self, idxs, offsets, lengths, out=None):
+        """Retrieves the portions [offsets[i], offsets[i] + lengths[i]) of
+        items idxs[i] concatenated into one flat array.
+
+        All element positions are computed with numpy and copied out of the
+        mmap in a single gather; `out` may be a preallocated flat array.
+        """
+        itemsize = np.dtype(self._index.dtype).itemsize
+        starts = self._index._pointers[idxs] // itemsize + offsets
+        tokens = np.frombuffer(self._bin_buffer, dtype=self._index.dtype)
+        positions = span_positions(starts, lengths)
+        if out is None or out.dtype == tokens.dtype:
+            return np.take(tokens, positions, out=out)
+        out[:] = tokens[positions]
+        return out
+
+    def readahead(self, idxs, offsets, lengths, advise=True):
+        """Start paging in the spans that `gather` would read. Returns the
+        page counts of `_readahead_mmap`."""
+        itemsize = np.dtype(self._index.dtype).itemsize
+        starts = self._index._pointers[idxs] + \
+            np.asarray(offsets, dtype=np.int64) * itemsize
+        return _readahead_mmap(self._bin_buffer_mmap._mmap, starts,
+                               np.asarray(lengths, dtype=np.int64) * itemsize,
+                               advise)
+
     @property
     def sizes(self):
         return self._index.sizes
@@ -595,6 +773,8 @@ class MMapIndexedDatasetBuilder(object):
         self._dtype = dtype
         self._sizes = []
         self._doc_idx = [0]
+        # Sizes and doc_idx entries already written by `checkpoint`.
+        self._checkpointed = None
 
     def add_item(self, tensor):
         np_array = np.array(tensor.numpy(), dtype=self._dtype)
@@ -625,3 +805,560 @@ class MMapIndexedDatasetBuilder(object):
 
         with MMapIndexedDataset.Index.writer(index_file, self._dtype) as index:
             index.write(self._sizes, self._doc_idx)
+
+    def checkpoint(self, path):
+        """Make the items added so far durable and return the state to
+        pass to `resume`.
+
+        The sizes and document index are appended to `<path>.ckpt_sizes` and
+        `<path>.ckpt_doc_idx`, so a checkpoint only writes what was added
+        since the previous one.
+        """
+        self._data_file.flush()
+        os.fsync(self._data_file.fileno())
+        mode = 'wb' if self._checkpointed is None else 'ab'
+        written = self._checkpointed or (0, 0)
+        for suffix, values, count, dtype in (
+                ('.ckpt_sizes', self._sizes, written[0], np.int32),
+                ('.ckpt_doc_idx', self._doc_idx, written[1], np.int64)):
+            with open(path + suffix, mode) as f:
+                f.write(np.array(values[count:], dtype=dtype).tobytes(order='C'))
+                f.flush()
+                os.fsync(f.fileno())
+        self._checkpointed = (len(self._sizes), len(self._doc_idx))
+        return {'data_size': self._data_file.tell(),
+                'num_sizes': len(self._sizes),
+                'num_doc_idx': len(self._doc_idx),
+                'dtype': code(self._dtype)}
+
+    @classmethod
+    def resume(cls, out_file, path, state):
+        """Reopen `out_file` at a state returned by `checkpoint(path)`,
+        dropping anything written after it."""
+        builder = cls.__new__(cls)
+        builder._data_file = open(out_file, 'r+b')
+        builder._data_file.truncate(state['data_size'])
+        builder._data_file.seek(0, os.SEEK_END)
+        builder._dtype = dtypes[state['dtype']]
+        builder._sizes = np.fromfile(path + '.ckpt_sizes', dtype=np.int32,
+                                     count=state['num_sizes']).tolist()
+        builder._doc_idx = np.fromfile(path + '.ckpt_doc_idx', dtype=np.int64,
+                                       count=state['num_doc_idx']).tolist()
+        for suffix, count, dtype in (('.ckpt_sizes', state['num_sizes'], np.int32),
+                                     ('.ckpt_doc_idx', state['num_doc_idx'], np.int64)):
+            with open(path + suffix, 'r+b') as f:
+                f.truncate(count * np.dtype(dtype).itemsize)
+        builder._checkpointed = (len(builder._sizes), len(builder._doc_idx))
+        return builder
+
+    @staticmethod
+    def remove_checkpoint(path):
+        for suffix in ('.ckpt_sizes', '.ckpt_doc_idx'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+class ShardedMMapIndexedDataset(torch.utils.data.Dataset):
+    """Many `MMapIndexedDataset` shards presented as one dataset.
+
+    The shards are listed in `<path>.manifest` (see `read_manifest`). Only the
+    small `.idx` files are read at construction time to build the global
+    `sizes` and `doc_idx`; the `.bin` of a shard is memory mapped the first
+    time one of its items is accessed. Item and document numbering is the
+    same as if the shards had been concatenated with
+    `MMapIndexedDatasetBuilder.merge_file_` in manifest order.
+    """
+
+    def __init__(self, path, skip_warmup=False):
+        super().__init__()
+
+        self._path = None
+        self._skip_warmup = None
+        self._indexes = None
+        self._bin_buffer_mmaps = None
+
+        self._do_init(path, skip_warmup)
+
+    def __getstate__(self):
+        return self._path, self._skip_warmup
+
+    def __setstate__(self, state):
+        self._do_init(*state)
+
+    def _do_init(self, path, skip_warmup):
+        self._path = path
+        self._skip_warmup = skip_warmup
+        self._shard_paths = read_manifest(manifest_file_path(path))
+        assert len(self._shard_paths) > 0, \
+            'manifest {} does not list any shard'.format(manifest_file_path(path))
+
+        print_rank_0("    reading {} shard indices...".format(
+            len(self._shard_paths)))
+        self._indexes = [MMapIndexedDataset.Index(index_file_path(p), skip_warmup=True)
+                         for p in self._shard_paths]
+        self._bin_buffer_mmaps = [None] * len(self._shard_paths)
+        self._bin_buffers = [None] * len(self._shard_paths)
+
+        self._dtype = self._indexes[0].dtype
+        for p, index in zip(self._shard_paths, self._indexes):
+            assert index.dtype == self._dtype, \
+                'shard {} has dtype {}, expected {}'.format(p, index.dtype, self._dtype)
+
+        # item_offsets[i] is the global index of the first item of shard i.
+        self._item_offsets = np.zeros(len(self._indexes) + 1, dtype=np.int64)
+        np.cumsum([len(index) for index in self._indexes],
+                  out=self._item_offsets[1:])
+        self._sizes = np.concatenate([index.sizes for index in self._indexes])
+
+        doc_idx = [np.zeros(1, dtype=np.int64)]
+        for offset, index in zip(self._item_offsets[:-1], self._indexes):
+            doc_idx.append(offset + index.doc_idx[1:])
+        self._doc_idx = np.concatenate(doc_idx)
+
+    def __del__(self):
+        if self._bin_buffer_mmaps is not None:
+            for bin_buffer_mmap in self._bin_buffer_mmaps:
+                if bin_buffer_mmap is not None:
+                    bin_buffer_mmap._mmap.close()
+        del self._bin_buffer_mmaps
+        del self._indexes
+
+    def _bin_buffer(self, shard):
+        if self._bin_buffers[shard] is None:
+            path = data_file_path(self._shard_paths[shard])
+            if not self._skip_warmup:
+                _warmup_mmap_file(path)
+            self._bin_buffer_mmaps[shard] = np.memmap(path, mode='r', order='C')
+            self._bin_buffers[shard] = memoryview(self._bin_buffer_mmaps[shard])
+        return self._bin_buffers[shard]
+
+    def _locate(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('index out of range')
+        shard = int(np.searchsorted(self._item_offsets, idx, side='right')) - 1
+        return shard, idx - self._item_offsets[shard]
+
+    def __len__(self):
+        return int(self._item_offsets[-1])
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return self.get(idx)
+        elif isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step != 1:
+                raise ValueError("Slices into indexed_dataset must be contiguous")
+            return [self.get(i) for i in range(start, stop)]
+
+    def get(self, idx, offset=0, length=None):
+        """ Retrieves a single item from the dataset with the option to only
+        return a portion of the item.
+
+        get(idx) is the same as [idx] but get() does not support slicing.
+        """
+        shard, local_idx = self._locate(idx)
+        ptr, size = self._indexes[shard][local_idx]
+        if length is None:
+            length = size - offset
+        ptr += offset * np.dtype(self._dtype).itemsize
+        return np.frombuffer(self._bin_buffer(shard), dtype=self._dtype,
+                             count=length, offset=ptr)
+
+    def get_batch(self, indices):
+        """Retrieves several items at once as a list of arrays."""
+        return [self.get(i) for i in indices]
+
+    def gather(self, idxs, offsets, lengths, out=None):
+        """Same as `MMapIndexedDataset.gather`, one gather per touched shard."""
+        idxs = np.asarray(idxs, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if out is None:
+            out = np.empty(lengths.sum(), dtype=self._dtype)
+
+        itemsize = np.dtype(self._dtype).itemsize
+        shards = np.searchsorted(self._item_offsets, idxs, side='right') - 1
+        span_offsets = np.cumsum(lengths) - lengths
+        for shard in np.unique(shards):
+            selected = shards == shard
+            pointers = self._indexes[shard]._pointers[
+                idxs[selected] - self._item_offsets[shard]]
+            starts = pointers // itemsize + offsets[selected]
+            tokens = np.frombuffer(self._bin_buffer(shard), dtype=self._dtype)
+            out[span_positions(span_offsets[selected], lengths[selected])] = \
+                tokens[span_positions(starts, lengths[selected])]
+        return out
+
+    def readahead(self, idxs, offsets, lengths, advise=True):
+        """Same as `MMapIndexedDataset.readahead`, per touched shard."""
+        idxs = np.asarray(idxs, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        itemsize = np.dtype(self._dtype).itemsize
+        shards = np.searchsorted(self._item_offsets, idxs, side='right') - 1
+        counts = (0, 0)
+        for shard in np.unique(shards):
+            selected = shards == shard
+            pointers = self._indexes[shard]._pointers[
+                idxs[selected] - self._item_offsets[shard]]
+            self._bin_buffer(shard)
+            counts = _add_residency(counts, _readahead_mmap(
+                self._bin_buffer_mmaps[shard]._mmap,
+                pointers + offsets[selected] * itemsize,
+                lengths[selected] * itemsize, advise))
+        return counts
+
+    @property
+    def sizes(self):
+        return self._sizes
+
+    def size(self, index):
+        return self._sizes[index]
+
+    @property
+    def doc_idx(self):
+        return self._doc_idx
+
+    def get_doc_idx(self):
+        return self._doc_idx
+
+    def set_doc_idx(self, doc_idx_):
+        self._doc_idx = doc_idx_
+
+    @property
+    def supports_prefetch(self):
+        return False
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(manifest_file_path(path))
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def _bitpack_encode(tokens):
+    """Frame of reference bit-packing: the minimum of the block followed by
+    every token minus it in just as many bits as the range needs."""
+    values = tokens.astype(np.int64)
+    low = int(values.min())
+    bits = int(values.max() - low).bit_length()
+    header = struct.pack('<qB', low, bits)
+    if bits == 0:
+        return header
+    offsets = (values - low).astype('<u8')
+    bit_matrix = np.unpackbits(offsets.view(np.uint8).reshape(-1, 8), axis=1,
+                               bitorder='little')[:, :bits]
+    return header + np.packbits(bit_matrix.reshape(-1),
+                                bitorder='little').tobytes()
+
+
+def _bitpack_decode(data, count, dtype):
+    low, bits = struct.unpack_from('<qB', data)
+    if bits == 0:
+        return np.full(count, low, dtype=dtype)
+    # Widen to the smallest unsigned type holding `bits` bits.
+    width = 1 << max(0, (bits - 1) // 8).bit_length()
+    bit_matrix = np.zeros((count, 8 * width), dtype=np.uint8)
+    bit_matrix[:, :bits] = np.unpackbits(
+        np.frombuffer(data, dtype=np.uint8, offset=9), count=count * bits,
+        bitorder='little').reshape(count, bits)
+    offsets = np.packbits(bit_matrix, axis=1,
+                          bitorder='little').view('<u{}'.format(width))
+    return (offsets.reshape(count).astype(np.int64) + low).astype(dtype)
+
+
+def _zstd_encode(tokens):
+    return zstandard.ZstdCompressor(level=COMPRESSED_ZSTD_LEVEL).compress(
+        tokens.tobytes(order='C'))
+
+
+def _zstd_decode(data, count, dtype):
+    return np.frombuffer(zstandard.ZstdDecompressor().decompress(data),
+                         dtype=dtype, count=count)
+
+
+# Codec code -> (name, encode, decode).
+_CODECS = {
+    1: ('bitpack', _bitpack_encode, _bitpack_decode),
+    2: ('zstd', _zstd_encode, _zstd_decode),
+}
+COMPRESSED_ZSTD_LEVEL = 3
+# Decoded blocks kept per dataset.
+COMPRESSED_CACHE_BLOCKS = 64
+
+
+def _codec_code(name):
+    for codec, (codec_name, _, _) in _CODECS.items():
+        if codec_name == name:
+            return codec
+    raise ValueError(name)
+
+
+class CompressedIndexedDataset(torch.utils.data.Dataset):
+    """Tokens stored in independently compressed blocks.
+
+    The token stream of all items is cut into blocks of `block_tokens`
+    tokens; the `.idx` holds the usual sizes and document index, the token
+    offset of every item and the byte offset of every block in the `.bin`.
+    `get` decodes only the blocks it touches and keeps the last
+    `COMPRESSED_CACHE_BLOCKS` decoded blocks, so consecutive reads of one
+    region decode it once. `bytes_read` and `blocks_decoded` count the
+    compressed bytes and blocks decoded so far.
+    """
+
+    _HDR_MAGIC = b'CMPIDX\x00\x00\x00'
+
+    def __init__(self, path, skip_warmup=False):
+        super().__init__()
+        self._path = None
+        self._skip_warmup = None
+        self._bin_buffer_mmap = None
+        self._do_init(path, skip_warmup)
+
+    def __getstate__(self):
+        return self._path, self._skip_warmup
+
+    def __setstate__(self, state):
+        self._do_init(*state)
+
+    def _do_init(self, path, skip_warmup):
+        self._path = path
+        self._skip_warmup = skip_warmup
+        with open(index_file_path(path), 'rb') as stream:
+            magic_test = stream.read(9)
+            assert self._HDR_MAGIC == magic_test, (
+                'Index file doesn\'t match expected format. '
+                'Make sure that --data-impl is configured properly.'
+            )
+            version, dtype_code, codec, self._block_tokens, length, \
+                doc_count, num_blocks = struct.unpack('<QBBQQQQ',
+                                                      stream.read(42))
+            assert version == 1
+            self._dtype = dtypes[dtype_code]
+            _, _, self._decode = _CODECS[codec]
+            if _CODECS[codec][0] == 'zstd':
+                assert zstandard is not None, \
+                    'reading {} requires the zstandard package'.format(path)
+            self._sizes = read_longs(stream, length).astype(np.int32)
+            self._pointers = read_longs(stream, length)
+            self._doc_idx = read_longs(stream, doc_count)
+            self._block_offsets = read_longs(stream, num_blocks + 1)
+        self._num_tokens = int(self._pointers[-1] + self._sizes[-1]) \
+            if length > 0 else 0
+
+        if not skip_warmup:
+            print_rank_0("    warming up data mmap file...")
+            _warmup_mmap_file(data_file_path(path))
+        self._bin_buffer_mmap = np.memmap(data_file_path(path), mode='r',
+                                          order='C')
+        self._bin_buffer = memoryview(self._bin_buffer_mmap)
+        # Only the thread fetching samples decodes; `readahead` just pages
+        # in the compressed bytes.
+        self._cache = collections.OrderedDict()
+        self.bytes_read = 0
+        self.blocks_decoded = 0
+
+    def __del__(self):
+        if self._bin_buffer_mmap is not None:
+            self._bin_buffer_mmap._mmap.close()
+        del self._bin_buffer_mmap
+
+    def _block(self, block):
+        tokens = self._cache.get(block)
+        if tokens is not None:
+            self._cache.move_to_end(block)
+            return tokens
+        start, end = self._block_offsets[block:block + 2].tolist()
+        count = min(self._block_tokens,
+                    self._num_tokens - block * self._block_tokens)
+        tokens = self._decode(self._bin_buffer[start:end], count, self._dtype)
+        self.bytes_read += end - start
+        self.blocks_decoded += 1
+        self._cache[block] = tokens
+        if len(self._cache) > COMPRESSED_CACHE_BLOCKS:
+            self._cache.popitem(last=False)
+        return tokens
+
+    def _tokens(self, start, length):
+        """Tokens [start, start + length) of the concatenated items."""
+        if length <= 0:
+            return np.empty(0, dtype=self._dtype)
+        first = start // self._block_tokens
+        last = (start + length - 1) // self._block_tokens
+        if first == last:
+            offset = start - first * self._block_tokens
+            return self._block(first)[offset:offset + length]
+        tokens = np.concatenate([self._block(block)
+                                 for block in range(first, last + 1)])
+        offset = start - first * self._block_tokens
+        return tokens[offset:offset + length]
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return self.get(idx)
+        elif isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step != 1:
+                raise ValueError("Slices into indexed_dataset must be contiguous")
+            return [self.get(i) for i in range(start, stop)]
+
+    def get(self, idx, offset=0, length=None):
+        """ Retrieves a single item from the dataset with the option to only
+        return a portion of the item.
+
+        get(idx) is the same as [idx] but get() does not support slicing.
+        """
+        size = int(self._sizes[idx])
+        if length is None:
+            length = size - offset
+        return self._tokens(int(self._pointers[idx]) + offset, length)
+
+    def get_batch(self, indices):
+        """Retrieves several items at once as a list of arrays."""
+        return [self.get(i) for i in indices]
+
+    def gather(self, idxs, offsets, lengths, out=None):
+        """Same as `MMapIndexedDataset.gather`."""
+        lengths = np.asarray(lengths, dtype=np.int64)
+        starts = self._pointers[idxs] + np.asarray(offsets, dtype=np.int64)
+        if out is None:
+            out = np.empty(lengths.sum(), dtype=self._dtype)
+        position = 0
+        for start, length in zip(starts.tolist(), lengths.tolist()):
+            out[position:position + length] = self._tokens(start, length)
+            position += length
+        return out
+
+    def readahead(self, idxs, offsets, lengths, advise=True):
+        """Page in the compressed blocks that `gather` would decode."""
+        lengths = np.asarray(lengths, dtype=np.int64)
+        starts = self._pointers[idxs] + np.asarray(offsets, dtype=np.int64)
+        first = starts // self._block_tokens
+        last = (starts + np.maximum(lengths, 1) - 1) // self._block_tokens
+        return _readahead_mmap(
+            self._bin_buffer_mmap._mmap, self._block_offsets[first],
+            self._block_offsets[last + 1] - self._block_offsets[first],
+            advise)
+
+    @property
+    def sizes(self):
+        return self._sizes
+
+    def size(self, index):
+        return self._sizes[index]
+
+    @property
+    def doc_idx(self):
+        return self._doc_idx
+
+    def get_doc_idx(self):
+        return self._doc_idx
+
+    def set_doc_idx(self, doc_idx_):
+        self._doc_idx = doc_idx_
+
+    @property
+    def supports_prefetch(self):
+        return False
+
+    @staticmethod
+    def exists(path):
+        if not (os.path.exists(index_file_path(path)) and
+                os.path.exists(data_file_path(path))):
+            return False
+        with open(index_file_path(path), 'rb') as f:
+            return f.read(9) == CompressedIndexedDataset._HDR_MAGIC
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+
+class CompressedIndexedDatasetBuilder(object):
+    def __init__(self, out_file, dtype=np.int64, codec='bitpack',
+                 block_tokens=8192):
+        if codec == 'zstd':
+            assert zstandard is not None, \
+                'the zstd codec requires the zstandard package'
+        self._data_file = open(out_file, 'wb')
+        self._dtype = dtype
+        self._codec = _codec_code(codec)
+        _, self._encode, _ = _CODECS[self._codec]
+        self._block_tokens = block_tokens
+        self._sizes = []
+        self._doc_idx = [0]
+        self._block_offsets = [0]
+        self._pending = []
+        self._num_pending = 0
+
+    def add_item(self, tensor):
+        self._add_tokens(np.array(tensor.numpy(), dtype=self._dtype))
+
+    def _add_tokens(self, np_array):
+        self._sizes.append(np_array.size)
+        self._pending.append(np_array)
+        self._num_pending += np_array.size
+        if self._num_pending >= self._block_tokens:
+            self._write_blocks(final=False)
+
+    def end_document(self):
+        self._doc_idx.append(len(self._sizes))
+
+    def _write_blocks(self, final):
+        tokens = np.concatenate(self._pending) if self._pending \
+            else np.empty(0, dtype=self._dtype)
+        num_full = len(tokens) // self._block_tokens
+        for block in range(num_full):
+            self._write_block(tokens[block * self._block_tokens:
+                                     (block + 1) * self._block_tokens])
+        rest = tokens[num_full * self._block_tokens:]
+        if final and len(rest) > 0:
+            self._write_block(rest)
+            rest = rest[:0]
+        self._pending = [rest]
+        self._num_pending = len(rest)
+
+    def _write_block(self, tokens):
+        self._data_file.write(self._encode(tokens))
+        self._block_offsets.append(self._data_file.tell())
+
+    def merge_file_(self, another_file):
+        """Append the items and documents of a mmap or compressed dataset."""
+        if CompressedIndexedDataset.exists(another_file):
+            dataset = CompressedIndexedDataset(another_file, skip_warmup=True)
+        else:
+            dataset = MMapIndexedDataset(another_file, skip_warmup=True)
+        offset = len(self._sizes)
+        for i in range(len(dataset)):
+            self._add_tokens(np.array(dataset[i], dtype=self._dtype))
+        self._doc_idx.extend((offset + dataset.doc_idx)[1:])
+
+    def finalize(self, index_file):
+        self._write_blocks(final=True)
+        self._data_file.close()
+
+        sizes = np.array(self._sizes, dtype=np.int64)
+        pointers = np.cumsum(sizes) - sizes
+        with open(index_file, 'wb') as f:
+            f.write(CompressedIndexedDataset._HDR_MAGIC)
+            f.write(struct.pack('<QBBQQQQ', 1, code(self._dtype), self._codec,
+                                self._block_tokens, len(sizes),
+                                len(self._doc_idx),
+                                len(self._block_offsets) - 1))
+            write_longs(f, sizes)
+            write_longs(f, pointers)
+            write_longs(f, self._doc_idx)
+            write_longs(f, self._block_offsets)
@@ -0,0 +1,243 @@
+# coding=utf-8
+# Copyright (c) 2023, Tokyo Institute of Technology.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""GPT style dataset streamed from raw jsonl files.
+
+Documents are tokenized in the DataLoader workers, terminated with EOD
+and packed into `seq_length + 1` token windows that overlap by one token,
+like the samples of GPTDataset. Every file is split into
+`data_parallel_size * num_workers` byte ranges, one per shard, whose
+boundaries are moved forward to the next line start; a shard reads only
+the lines that start in its ranges. Every shard thus reads a fixed,
+reproducible stream as long as --num-workers is not changed. The files
+are cycled over without shuffling.
+
+The position of a window is `(epoch, file, byte offset, line, token
+offset)` of the document it starts in, where `line` counts the documents
+of the shard in the epoch; the carry-over tokens are rebuilt
+by tokenizing that single document again. With --jsonl-position-dir each
+shard appends the position of every `--jsonl-position-interval`-th sample
+to a small file, so that resuming from `consumed_samples` seeks to the
+last position before it and only re-tokenizes the remainder.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+from megatron import get_args
+from megatron import get_tokenizer
+from megatron import mpu
+from megatron import print_rank_0
+
+
+def build_streaming_jsonl_dataset(paths, seq_length):
+    """Build the train dataset from jsonl files or glob patterns."""
+    args = get_args()
+    files = []
+    for path in paths:
+        matches = sorted(glob.glob(path))
+        assert matches, 'no jsonl file matches {}'.format(path)
+        files.extend(matches)
+    print_rank_0(' > streaming {} jsonl files:'.format(len(files)))
+    for path in files:
+        print_rank_0('    {}'.format(path))
+    return StreamingJSONLDataset(files, seq_length, args.jsonl_key,
+                                 args.jsonl_position_dir,
+                                 args.jsonl_position_interval)
+
+
+class StreamingJSONLDataset(torch.utils.data.IterableDataset):
+
+    def __init__(self, files, seq_length, json_key='text',
+                 position_dir=None, position_interval=1000):
+        self.files = files
+        self.seq_length = seq_length
+        self.json_key = json_key
+        self.position_dir = position_dir
+        self.position_interval = position_interval
+        self.micro_batch_size = get_args().micro_batch_size
+        self.data_parallel_rank = mpu.get_data_parallel_rank()
+        self.data_parallel_size = mpu.get_data_parallel_world_size()
+        # The other ranks of the model parallel group read the same shard.
+        self.write_positions = position_dir is not None and \
+            mpu.get_tensor_model_parallel_rank() == 0 and \
+            mpu.is_pipeline_first_stage()
+        self.rank = torch.distributed.get_rank()
+        self.consumed_samples = 0
+
+        # Positions are only valid for the same files and packing.
+        md5 = hashlib.md5('byte-range:{}:{}:{}'.format(
+            seq_length, json_key, get_tokenizer().vocab_size).encode())
+        for path in files:
+            stat = os.stat(path)
+            md5.update('{}:{}:{};'.format(os.path.abspath(path), stat.st_size,
+                                          stat.st_mtime_ns).encode())
+        self.key = md5.hexdigest()
+        if position_dir is not None:
+            os.makedirs(position_dir, exist_ok=True)
+
+    def set_consumed_samples(self, consumed_samples):
+        """Resume after `consumed_samples` samples of all data parallel
+        ranks."""
+        self.consumed_samples = consumed_samples
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = 0, 1
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+
+        # The DataLoader takes micro-batches from its workers round robin,
+        # starting with worker 0 on every start, so after `batches` batches
+        # worker i continues the stream of worker `(i + batches) %
+        # num_workers` of the first run.
+        batches = self.consumed_samples // \
+            (self.micro_batch_size * self.data_parallel_size)
+        stream = (worker_id + batches) % num_workers
+        shard = self.data_parallel_rank * num_workers + stream
+        num_shards = self.data_parallel_size * num_workers
+        skip = max(0, (batches - stream + num_workers - 1) // num_workers) \
+            * self.micro_batch_size
+
+        start_time = time.time()
+        num_samples, position = self._find_position(shard, num_shards, skip)
+        for sample_position, tokens in self._windows(shard, num_shards,
+                                                     position):
+            if num_samples >= skip:
+                if num_samples == skip and skip > 0 and self.rank == 0:
+                    print(' > shard {} of jsonl stream resumed at sample {} '
+                          'in {:.3f} seconds'.format(shard, skip,
+                                                     time.time() - start_time),
+                          flush=True)
+                if self.write_positions and \
+                        num_samples % self.position_interval == 0:
+                    self._write_position(shard, num_shards, num_samples,
+                                         sample_position)
+                yield {'text': tokens}
+            num_samples += 1
+
+    def _position_file(self, shard, num_shards):
+        return os.path.join(self.position_dir, 'jsonl_{}_{}_of_{}.pos'.format(
+            self.key, shard, num_shards))
+
+    def _write_position(self, shard, num_shards, num_samples, position):
+        with open(self._position_file(shard, num_shards), 'a') as f:
+            f.write('{} {} {} {} {} {}\n'.format(num_samples, *position))
+
+    def _find_position(self, shard, num_shards, num_samples):
+        """Latest recorded `(samples, position)` not after `num_samples`."""
+        best = (0, (0, 0, 0, 0, 0))
+        if self.position_dir is None:
+            return best
+        path = self._position_file(shard, num_shards)
+        if not os.path.exists(path):
+            return best
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                # Skip a line torn by a killed job.
+                if not line.endswith('\n') or len(fields) != 6:
+                    continue
+                samples = int(fields[0])
+                if best[0] < samples <= num_samples:
+                    best = (samples, tuple(int(x) for x in fields[1:]))
+        return best
+
+    def _documents(self, shard, num_shards, position):
+        """Yield `(position, tokens)` of the documents of a shard, starting
+        with the one at `position`."""
+        tokenizer = get_tokenizer()
+        epoch, file_index, offset, line, _ = position
+        while True:
+            full_pass = file_index == 0 and offset == 0
+            found = False
+            for file_index in range(file_index, len(self.files)):
+                with open(self.files[file_index], 'rb') as f:
+                    start, end = _byte_range(f, shard, num_shards)
+                    offset = max(offset, start)
+                    f.seek(offset)
+                    while offset < end:
+                        data = f.readline()
+                        # Blank lines, e.g. a trailing one, are no documents.
+                        if data.strip():
+                            found = True
+                            text = json.loads(data)[self.json_key]
+                            tokens = tokenizer.tokenize(text)
+                            tokens.append(tokenizer.eod)
+                            yield ((epoch, file_index, offset, line),
+                                   np.array(tokens, dtype=np.int64))
+                        offset += len(data)
+                        line += 1
+                offset = 0
+            assert found or not full_pass, \
+                'jsonl shard {} of {} has no documents'.format(shard,
+                                                               num_shards)
+            epoch += 1
+            file_index = 0
+            line = 0
+
+    def _windows(self, shard, num_shards, position):
+        """Yield `(position, tokens)` of the packed windows of a shard."""
+        window = self.seq_length + 1
+        documents = self._documents(shard, num_shards, position)
+        # Documents holding the tokens that are not emitted yet; the first
+        # one is consumed up to `token_offset`.
+        pending = []
+        token_offset = position[4]
+        available = -token_offset
+        while True:
+            while available < window:
+                document = next(documents)
+                pending.append(document)
+                available += len(document[1])
+            parts = []
+            offset = token_offset
+            needed = window
+            for _, tokens in pending:
+                parts.append(tokens[offset:offset + needed])
+                needed -= len(parts[-1])
+                offset = 0
+                if needed == 0:
+                    break
+            yield pending[0][0] + (token_offset,), np.concatenate(parts)
+            # Consecutive windows share one token.
+            token_offset += self.seq_length
+            available -= self.seq_length
+            while token_offset >= len(pending[0][1]):
+                token_offset -= len(pending[0][1])
+                pending.pop(0)
+
+
+def _byte_range(f, shard, num_shards):
+    """Return the `[start, end)` byte range of the lines of a shard in the
+    binary file `f`: the lines that start in its share of the bytes."""
+    size = os.fstat(f.fileno()).st_size
+    return (_line_start(f, size * shard // num_shards),
+            _line_start(f, size * (shard + 1) // num_shards))
+
+
+def _line_start(f, offset):
+    """Offset of the first line that starts at or after `offset`."""
+    if offset == 0:
+        return 0
+    f.seek(offset - 1)
+    f.readline()
+    return f.tell()
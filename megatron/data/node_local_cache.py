@@ -0,0 +1,282 @@
+# coding=utf-8
+# Copyright (c) 2023, Tokyo Institute of Technology.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Node-local copies of files that live on a shared filesystem.
+
+Files are copied into a local directory under a name keyed by the path,
+size and mtime of the source, so copies are reused by later jobs on the
+same node. The processes of a node coordinate through flock()ed lock
+files next to the copies: the first process to lock a file copies it
+while the others wait for it. Locks of processes that died are released
+by the kernel, and a lock file records the pid of its holder.
+
+Processes that use a copy hold a shared lock on it until they exit. When
+a size limit is given, the least recently used copies that no process
+holds are evicted to make room.
+"""
+
+import fcntl
+import hashlib
+import os
+import shutil
+import time
+
+from megatron import get_args
+from megatron import print_rank_0
+from megatron.data import indexed_dataset
+
+
+# Seconds to wait for another process of the node to finish a copy.
+STAGING_TIMEOUT = 3600
+
+_CACHE_FILE_PREFIX = 'megatron_'
+
+# Descriptors holding a shared lock on the copies used by this process,
+# by path.
+_held = {}
+
+
+def cache_key(*paths):
+    """Hash of the location, size and mtime of the given files."""
+    md5 = hashlib.md5()
+    for path in paths:
+        stat = os.stat(path)
+        md5.update('{}:{}:{};'.format(os.path.abspath(path), stat.st_size,
+                                      stat.st_mtime_ns).encode())
+    return md5.hexdigest()
+
+
+def stage_file(path, local_dir, local_name=None, max_bytes=None):
+    """Return a node-local copy of `path` in `local_dir`.
+
+    Returns `path` itself if the file alone does not fit in `max_bytes`.
+    """
+    if local_name is None:
+        local_name = '{}{}_{}'.format(_CACHE_FILE_PREFIX, cache_key(path),
+                                      os.path.basename(path))
+    local_path = os.path.join(local_dir, local_name)
+    size = os.path.getsize(path)
+    if max_bytes is not None and size > max_bytes:
+        print_rank_0(' > WARNING: {} ({} bytes) is larger than the staging '
+                     'limit, reading it in place'.format(path, size))
+        return path
+
+    def copy(tmp_path):
+        if max_bytes is not None:
+            _evict(local_dir, max_bytes - size)
+        shutil.copyfile(path, tmp_path)
+
+    build_file(local_path, copy, hold=True)
+    return local_path
+
+
+def build_file(local_path, build, hold=False):
+    """Create `local_path` once per node.
+
+    The first process to lock the file calls `build(tmp_path)` and renames
+    the result into place; the others wait for it. With `hold`, the file
+    is also marked as used and held by this process, so that `_evict`
+    leaves it in place.
+    """
+    lock = _lock(local_path + '.lock', STAGING_TIMEOUT)
+    if lock is None:
+        raise RuntimeError('timed out waiting for process {} to create '
+                           '{}'.format(_lock_holder(local_path + '.lock'),
+                                       local_path))
+    try:
+        if not os.path.exists(local_path):
+            tmp_path = local_path + '.tmp'
+            build(tmp_path)
+            os.rename(tmp_path, local_path)
+        if hold:
+            _hold(local_path)
+    finally:
+        # Waiting processes lock the file at the path again, see _lock.
+        os.remove(local_path + '.lock')
+        os.close(lock)
+
+
+def _lock(lock_path, timeout):
+    """Exclusively lock `lock_path`, creating it if needed, and record the
+    pid of this process in it. Returns the locked descriptor, or None if
+    the lock is still held by another process after `timeout` seconds.
+    """
+    start_time = time.time()
+    while True:
+        fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.time() - start_time >= timeout:
+                        os.close(fd)
+                        return None
+                    time.sleep(0.1)
+            # An eviction may have removed the file while this process
+            # waited; the lock is only valid on the file at the path.
+            try:
+                locked = os.stat(lock_path).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                locked = False
+            if locked:
+                os.ftruncate(fd, 0)
+                os.write(fd, str(os.getpid()).encode())
+                return fd
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
+
+
+def _lock_holder(lock_path):
+    """The pid recorded in a lock file, or None."""
+    try:
+        with open(lock_path) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _hold(local_path):
+    """Take a shared lock on a copy for the lifetime of this process and
+    record the use in its mtime, for LRU eviction."""
+    local_path = os.path.abspath(local_path)
+    if local_path not in _held:
+        fd = os.open(local_path, os.O_RDONLY)
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        _held[local_path] = fd
+    os.utime(local_path)
+
+
+def stage_indexed_dataset(data_prefix, data_impl):
+    """Return the prefix to read the dataset from, staging it in the
+    node-local --data-staging-dir first if one is given."""
+    args = get_args()
+    if args.data_staging_dir is None:
+        return data_prefix
+    start_time = time.time()
+    max_bytes = None
+    if args.data_staging_max_gb is not None:
+        max_bytes = int(args.data_staging_max_gb * 1024 ** 3)
+    data_prefix = stage_dataset(data_prefix, data_impl,
+                                args.data_staging_dir, max_bytes)
+    print_rank_0(' > staged dataset to {} in {:4f} seconds'.format(
+        data_prefix, time.time() - start_time))
+    return data_prefix
+
+
+def stage_dataset(data_prefix, data_impl, local_dir, max_bytes=None):
+    """Stage the files of an indexed dataset and return the local prefix.
+
+    For sharded datasets every shard is staged and a manifest listing the
+    local shards is written next to them.
+    """
+    manifest = indexed_dataset.manifest_file_path(data_prefix)
+    if data_impl in ('sharded', 'infer') and os.path.exists(manifest):
+        shard_prefixes = [
+            stage_dataset(prefix, 'mmap', local_dir, max_bytes)
+            for prefix in indexed_dataset.read_manifest(manifest)]
+        local_prefix = os.path.join(local_dir, '{}{}_{}'.format(
+            _CACHE_FILE_PREFIX, cache_key(manifest),
+            os.path.basename(data_prefix)))
+        # Every rank writes the same content, the rename is atomic.
+        tmp_manifest = '{}.{}.tmp'.format(
+            indexed_dataset.manifest_file_path(local_prefix), os.getpid())
+        indexed_dataset.write_manifest(tmp_manifest, shard_prefixes)
+        os.rename(tmp_manifest,
+                  indexed_dataset.manifest_file_path(local_prefix))
+        return local_prefix
+
+    index_file = indexed_dataset.index_file_path(data_prefix)
+    data_file = indexed_dataset.data_file_path(data_prefix)
+    if max_bytes is not None and \
+            os.path.getsize(index_file) + os.path.getsize(data_file) > max_bytes:
+        print_rank_0(' > WARNING: {} is larger than the staging limit, '
+                     'reading it in place'.format(data_prefix))
+        return data_prefix
+    local_prefix = '{}{}_{}'.format(_CACHE_FILE_PREFIX,
+                                    cache_key(index_file, data_file),
+                                    os.path.basename(data_prefix))
+    # Data first, so that the limit never leaves an index without its data.
+    stage_file(data_file, local_dir,
+               os.path.basename(indexed_dataset.data_file_path(local_prefix)),
+               max_bytes)
+    stage_file(index_file, local_dir,
+               os.path.basename(indexed_dataset.index_file_path(local_prefix)),
+               max_bytes)
+    return os.path.join(local_dir, local_prefix)
+
+
+def _evict(local_dir, max_bytes):
+    """Remove least recently used copies until at most `max_bytes` remain.
+
+    The .bin and .idx copies of a dataset are removed together. Copies
+    that are being created or that some process holds are kept, so the
+    limit may be exceeded. Open memory maps of removed copies stay valid.
+    """
+    groups = {}
+    for name in os.listdir(local_dir):
+        path = os.path.join(local_dir, name)
+        if not name.startswith(_CACHE_FILE_PREFIX) or \
+                name.endswith(('.lock', '.tmp')) or \
+                name.endswith(indexed_dataset.manifest_file_path('')):
+            continue
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        last_use, size, paths = groups.get(os.path.splitext(path)[0],
+                                           (0, 0, []))
+        groups[os.path.splitext(path)[0]] = (
+            max(last_use, stat.st_mtime), size + stat.st_size, paths + [path])
+    total = sum(size for _, size, _ in groups.values())
+    for _, size, paths in sorted(groups.values()):
+        if total <= max_bytes:
+            break
+        if _remove_unused(paths):
+            total -= size
+
+
+def _remove_unused(paths):
+    """Remove the copies `paths` and their lock files unless one of them
+    is locked by some process. Returns whether they were removed."""
+    fds = []
+    try:
+        for path in paths:
+            lock = _lock(path + '.lock', 0)
+            if lock is None:
+                return False
+            fds.append(lock)
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            fds.append(fd)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+        for path in paths:
+            for name in (path, path + '.lock'):
+                try:
+                    os.remove(name)
+                except FileNotFoundError:
+                    pass
+        return True
+    finally:
+        for fd in fds:
+            os.close(fd)
@@ -0,0 +1,341 @@
+# coding=utf-8
+# Copyright (c) 2023, Tokyo Institute of Technology.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Node-level shared-memory data loader.
+
+One producer process per node and dataset builds the micro-batches of
+every local rank, so DataLoader worker processes do not compete with the
+compute threads. The first local rank to take the flock of a lock file
+forks the producer, which keeps holding the lock; every rank connects to
+it over a unix socket. A producer that died releases the lock with its
+last file descriptor, and the next rank that fails to connect forks a new
+one. For each rank the
+producer allocates a ring of `--shm-loader-depth` batch slots in shared
+memory, fills free slots ahead of time and announces them on the socket.
+The rank hands out a slot without copying and releases it with a message
+back when the next batch is requested, so the socket also orders the
+shared memory accesses.
+
+The producer is forked from a rank that has initialized torch, OpenMP
+and the process groups. It only runs the numpy code of the dataset and
+the batch sampler: it takes the data parallel layout and batch shape from
+the requests of the ranks instead of the process groups, uses a single
+torch thread and, like any multiprocessing child, exits without running
+the exit handlers of the rank.
+"""
+
+import collections
+import fcntl
+import hashlib
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch
+
+from megatron import get_args
+from megatron import mpu
+from megatron import print_rank_0
+from megatron.data.data_samplers import build_pretraining_batch_sampler
+
+
+# Seconds to wait for the producer of the node to come up.
+CONNECT_TIMEOUT = 600
+# Seconds the producer keeps running without any connected rank.
+PRODUCER_IDLE_TIMEOUT = 600
+
+# Loaders created by this process; train, valid and test get distinct
+# producers because every rank builds them in the same order.
+_num_loaders = 0
+
+
+class SharedMemoryDataLoader:
+    """Iterable over `{'text': [b, s+1] int64}` micro-batches (plus
+    `'index'` with --return-data-index) served by the node producer.
+
+    The tensors of a batch are views of shared memory that stay valid
+    until the next batch is requested; copy them to keep them longer.
+
+    Statistics: `batches`, `stalls` (batches that were not ready when
+    requested), `stall_time` (seconds spent waiting) and `mean_depth`
+    (ready batches found per request).
+    """
+
+    def __init__(self, dataset, consumed_samples):
+        global _num_loaders
+        args = get_args()
+        self.dataset = dataset
+        self.consumed_samples = consumed_samples
+        self.data_parallel_rank = mpu.get_data_parallel_rank()
+        self.data_parallel_size = mpu.get_data_parallel_world_size()
+        self.samples_per_batch = args.micro_batch_size * \
+            self.data_parallel_size
+        self.text_shape = (args.micro_batch_size, args.seq_length + 1)
+        self.cyclic = args.dataloader_type == 'cyclic'
+        self.return_data_index = args.return_data_index
+        self.log_interval = args.log_interval
+        self.batches = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self._depth_sum = 0
+
+        self.address = os.path.join(
+            args.shm_loader_dir, 'megatron_loader_{}.sock'.format(
+                _producer_key(dataset, _num_loaders, self.text_shape,
+                              self.data_parallel_size)))
+        _num_loaders += 1
+        self.depth = args.shm_loader_depth
+        self.core = args.shm_loader_core
+        self._forked_producer = False
+        self._start_producer()
+
+    @property
+    def mean_depth(self):
+        return self._depth_sum / max(self.batches, 1)
+
+    def __len__(self):
+        """Number of micro-batches left in the pass, as yielded by the
+        batch sampler."""
+        total_samples = len(self.dataset)
+        consumed_samples = self.consumed_samples
+        if self.cyclic:
+            # The random sampler drops the last partial batch of an epoch.
+            total_samples -= total_samples % self.samples_per_batch
+            consumed_samples %= total_samples
+        return (total_samples - consumed_samples) // self.samples_per_batch
+
+    def _start_producer(self):
+        self._forked_producer |= _start_producer(
+            self.address, self.dataset, self.depth, self.core)
+
+    def __iter__(self):
+        conn = _connect(self.address, self._start_producer)
+        conn.send({'data_parallel_rank': self.data_parallel_rank,
+                   'data_parallel_size': self.data_parallel_size,
+                   'consumed_samples': self.consumed_samples,
+                   'num_samples': len(self.dataset),
+                   'text_shape': self.text_shape})
+        shm_name, text_shape, depth = conn.recv()
+        shm = shared_memory.SharedMemory(name=shm_name)
+        if not self._forked_producer:
+            # The producer unlinks the segment; only the rank that forked it
+            # shares its resource tracker.
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        texts, indexes = _ring_views(shm.buf, text_shape, depth)
+        ready = collections.deque()
+        # The slot of the batch handed out last.
+        held = None
+        try:
+            while True:
+                while conn.poll():
+                    ready.append(conn.recv())
+                self._depth_sum += len(ready)
+                if not ready:
+                    start_time = time.time()
+                    ready.append(conn.recv())
+                    self.stalls += 1
+                    self.stall_time += time.time() - start_time
+                slot = ready.popleft()
+                if held is not None:
+                    conn.send(held)
+                    held = None
+                if slot is None:
+                    break
+                batch = {'text': torch.from_numpy(texts[slot])}
+                if self.return_data_index:
+                    batch['index'] = torch.from_numpy(indexes[slot])
+                held = slot
+                self.batches += 1
+                if self.cyclic:
+                    self.consumed_samples += self.samples_per_batch
+                if self.batches % self.log_interval == 0:
+                    print_rank_0(' shm data loader: batches {} | stalls {} | '
+                                 'stall time {:.3f}s | mean depth {:.2f}'.format(
+                                     self.batches, self.stalls,
+                                     self.stall_time, self.mean_depth))
+                yield batch
+        finally:
+            del texts, indexes
+            try:
+                shm.close()
+            except BufferError:
+                # Batches still in use keep the mapping alive.
+                pass
+            conn.close()
+
+
+def _producer_key(dataset, loader_index, text_shape, data_parallel_size):
+    """Name of the producer of a loader, shared by the local ranks of a
+    job. It covers the job, the loader and the batches it serves, so that
+    other jobs on the node or an idle producer of an earlier job never
+    serve a rank."""
+    md5 = hashlib.md5()
+    # The local ranks of a launcher are its children.
+    for name in ('SLURM_JOB_ID', 'TORCHELASTIC_RUN_ID', 'MASTER_ADDR',
+                 'MASTER_PORT'):
+        md5.update('{}={};'.format(name, os.environ.get(name)).encode())
+    md5.update('{}:{}:{}:{}:{}:{};'.format(
+        os.getppid(), loader_index, type(dataset).__name__, len(dataset),
+        text_shape, data_parallel_size).encode())
+    if len(dataset) > 0:
+        md5.update(np.ascontiguousarray(dataset[0]['text']).tobytes())
+    return md5.hexdigest()
+
+
+def _ring_views(buf, text_shape, depth):
+    """Text `[depth, b, s+1]` and index `[depth, b, 1]` int64 views of a
+    ring, shaped like collated samples."""
+    text_numel = depth * int(np.prod(text_shape))
+    texts = np.ndarray((depth,) + tuple(text_shape), dtype=np.int64,
+                       buffer=buf)
+    indexes = np.ndarray((depth, text_shape[0], 1), dtype=np.int64,
+                         buffer=buf, offset=text_numel * 8)
+    return texts, indexes
+
+
+def _ring_nbytes(text_shape, depth):
+    return depth * (int(np.prod(text_shape)) + text_shape[0]) * 8
+
+
+def _start_producer(address, dataset, depth, core):
+    """Fork the producer unless a live one (or a rank starting one) holds
+    the lock, and return whether this rank did."""
+    fd = os.open(address + '.lock', os.O_CREAT | os.O_RDWR, 0o600)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        # A producer that was killed leaves its socket behind.
+        try:
+            os.remove(address)
+        except FileNotFoundError:
+            pass
+        # The producer inherits the locked descriptor and holds the lock
+        # until it exits.
+        context = multiprocessing.get_context('fork')
+        context.Process(target=_produce,
+                        args=(address, dataset, depth, core),
+                        daemon=True).start()
+        return True
+    finally:
+        os.close(fd)
+
+
+def _connect(address, start_producer):
+    """Connect to the producer at `address`, calling `start_producer` to
+    replace it while nobody holds its lock."""
+    start_time = time.time()
+    while True:
+        try:
+            return multiprocessing.connection.Client(address, family='AF_UNIX')
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.time() - start_time > CONNECT_TIMEOUT:
+                raise RuntimeError('no data producer at {}'.format(address))
+            start_producer()
+            time.sleep(0.1)
+
+
+class _Client:
+    """Producer side state of one connected rank."""
+
+    def __init__(self, conn, request, dataset, depth):
+        self.conn = conn
+        self.dataset = dataset
+        assert request['num_samples'] == len(dataset), \
+            'local ranks built different datasets'
+        self.batches = iter(build_pretraining_batch_sampler(
+            len(dataset), request['consumed_samples'],
+            request['data_parallel_rank'], request['data_parallel_size']))
+        text_shape = request['text_shape']
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=_ring_nbytes(text_shape, depth))
+        self.texts, self.indexes = _ring_views(self.shm.buf, text_shape,
+                                               depth)
+        self.free = collections.deque(range(depth))
+        self.exhausted = False
+        conn.send((self.shm.name, text_shape, depth))
+
+    def fill(self):
+        """Fill one free slot; return whether any work was done."""
+        if self.exhausted or not self.free:
+            return False
+        indices = next(self.batches, None)
+        if indices is None:
+            self.exhausted = True
+            self.conn.send(None)
+            return True
+        slot = self.free.popleft()
+        if hasattr(self.dataset, 'get_batch'):
+            samples = self.dataset.get_batch(indices)
+        else:
+            samples = [self.dataset[i] for i in indices]
+        for i, sample in enumerate(samples):
+            self.texts[slot, i] = sample['text']
+        self.indexes[slot, :, 0] = indices
+        self.conn.send(slot)
+        return True
+
+    def close(self):
+        self.conn.close()
+        del self.texts, self.indexes
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _produce(address, dataset, depth, core):
+    # Clean up the socket when the parent rank terminates us.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if core is not None:
+        os.sched_setaffinity(0, {core})
+    torch.set_num_threads(1)
+    listener = multiprocessing.connection.Listener(address, family='AF_UNIX')
+    accepted = queue.Queue()
+
+    def accept():
+        while True:
+            accepted.put(listener.accept())
+
+    threading.Thread(target=accept, daemon=True).start()
+    clients = {}
+    idle_since = time.time()
+    try:
+        while clients or time.time() - idle_since < PRODUCER_IDLE_TIMEOUT:
+            while not accepted.empty():
+                conn = accepted.get()
+                clients[conn] = _Client(conn, conn.recv(), dataset, depth)
+            progress = False
+            for client in clients.values():
+                progress |= client.fill()
+            for conn in multiprocessing.connection.wait(
+                    list(clients), timeout=0 if progress else 0.01):
+                try:
+                    clients[conn].free.append(conn.recv())
+                except EOFError:
+                    clients.pop(conn).close()
+                    if not clients:
+                        idle_since = time.time()
+    finally:
+        for client in clients.values():
+            client.close()
+        listener.close()
@@ -0,0 +1,240 @@
+# coding=utf-8
+# Copyright (c) 2023, Tokyo Institute of Technology.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Blocked (flash style) attention.
+
+Attention is computed over `[block, block]` tiles of queries and keys
+with an online softmax: every query block keeps a running maximum, sum
+of exponentials and output accumulator in (at least) fp32, so the
+`[sq, sk]` score matrix is never materialized. The backward pass
+recomputes the tiles from the saved log-sum-exp instead of storing
+probabilities; dropout masks are regenerated from a per-call seed and
+the tile position.
+
+Masked scores are filled with -10000.0 like `attention_mask_func`.
+Causal layers skip the key blocks after the last query of a block.
+Queries whose keys are all masked therefore cannot be normalized over the
+visited keys; like the dense softmax, they attend uniformly to all keys
+and pass no gradient to the scores. Dropout is not applied to these rows.
+"""
+
+import torch
+
+
+# Masked score value, as in attention_mask_func.
+MASK_VALUE = -10000.0
+
+
+def _tile_mask(attention_mask, causal, q0, q1, k0, k1, key_offset,
+               device):
+    """Bool mask of the `[q0:q1, k0:k1]` tile, broadcastable to
+    `[b, np, tq, tk]` and True where a query may not attend to a key, or
+    None. Queries are at key positions `key_offset + q`."""
+    mask = None
+    if attention_mask is not None:
+        if attention_mask.dim() == 2:
+            # Compact [b, s] document ids; they imply the causal mask.
+            query_ids = attention_mask[:, key_offset + q0:key_offset + q1]
+            key_ids = attention_mask[:, k0:k1]
+            mask = (query_ids.unsqueeze(2) !=
+                    key_ids.unsqueeze(1)).unsqueeze(1)
+            causal = True
+        else:
+            mask = attention_mask[..., q0:q1, k0:k1]
+    # Only tiles crossing the diagonal have future keys.
+    if causal and k1 - 1 > key_offset + q0:
+        future = torch.arange(k0, k1, device=device).view(1, -1) > \
+            torch.arange(key_offset + q0, key_offset + q1,
+                         device=device).view(-1, 1)
+        future = future.view(1, 1, q1 - q0, k1 - k0)
+        mask = future if mask is None else mask | future
+    return mask
+
+
+def _key_end(causal, q1, key_offset, key_length):
+    return min(key_length, key_offset + q1) if causal else key_length
+
+
+def _dropout_keep(seed, tile, shape, dropout_p, device):
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed + tile)
+    return torch.rand(shape, generator=generator, device=device) >= dropout_p
+
+
+class BlockedAttentionFunction(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, query, key, value, attention_mask, causal, scale,
+                dropout_p, seed, block_size):
+        # query: [b, np, sq, hn], key and value: [b, np, sk, hn]
+        query_length, key_length = query.size(2), key.size(2)
+        key_offset = key_length - query_length
+        causal = causal or (attention_mask is not None and
+                            attention_mask.dim() == 2)
+        num_key_blocks = (key_length + block_size - 1) // block_size
+        dtype = torch.promote_types(query.dtype, torch.float32)
+        output = torch.empty_like(query)
+        logsumexp = torch.empty(query.size()[:-1] + (1,),
+                                dtype=dtype, device=query.device)
+        value_mean = None
+
+        for q0 in range(0, query_length, block_size):
+            q1 = min(q0 + block_size, query_length)
+            query_block = query[:, :, q0:q1]
+            row_max = torch.full(query_block.size()[:-1] + (1,),
+                                 float('-inf'), dtype=dtype,
+                                 device=query.device)
+            row_sum = torch.zeros_like(row_max)
+            accumulator = torch.zeros(query_block.size(),
+                                      dtype=dtype,
+                                      device=query.device)
+            for k0 in range(0, _key_end(causal, q1, key_offset, key_length),
+                            block_size):
+                k1 = min(k0 + block_size, key_length)
+                scores = torch.matmul(
+                    query_block, key[:, :, k0:k1].transpose(-1, -2)).to(dtype)
+                scores.mul_(scale)
+                mask = _tile_mask(attention_mask, causal, q0, q1, k0, k1,
+                                  key_offset, query.device)
+                if mask is not None:
+                    scores.masked_fill_(mask, MASK_VALUE)
+                new_max = torch.maximum(row_max,
+                                        scores.amax(dim=-1, keepdim=True))
+                correction = torch.exp(row_max - new_max)
+                probs = torch.exp(scores.sub_(new_max))
+                row_sum.mul_(correction).add_(probs.sum(dim=-1, keepdim=True))
+                if dropout_p > 0.0:
+                    tile = q0 // block_size * num_key_blocks + k0 // block_size
+                    keep = _dropout_keep(seed, tile, probs.size(), dropout_p,
+                                         query.device)
+                    probs.mul_(keep).div_(1.0 - dropout_p)
+                accumulator.mul_(correction).add_(torch.matmul(
+                    probs.to(value.dtype), value[:, :, k0:k1]).to(dtype))
+                row_max = new_max
+            accumulator.div_(row_sum)
+            row_logsumexp = row_max + torch.log(row_sum)
+            masked_rows = row_max == MASK_VALUE
+            if masked_rows.any():
+                # Fully masked: the mean of all values, whatever keys were
+                # skipped. An infinite log-sum-exp zeroes the tile probs in
+                # the backward pass.
+                if value_mean is None:
+                    value_mean = value.to(dtype).mean(dim=2, keepdim=True)
+                accumulator = torch.where(masked_rows, value_mean,
+                                          accumulator)
+                row_logsumexp.masked_fill_(masked_rows, float('inf'))
+            output[:, :, q0:q1] = accumulator
+            logsumexp[:, :, q0:q1] = row_logsumexp
+
+        ctx.save_for_backward(query, key, value, output, logsumexp,
+                              attention_mask)
+        ctx.causal = causal
+        ctx.scale = scale
+        ctx.dropout_p = dropout_p
+        ctx.seed = seed
+        ctx.block_size = block_size
+        return output
+
+    @staticmethod
+    def backward(ctx, output_grad):
+        query, key, value, output, logsumexp, attention_mask = \
+            ctx.saved_tensors
+        causal, scale, dropout_p = ctx.causal, ctx.scale, ctx.dropout_p
+        block_size = ctx.block_size
+        query_length, key_length = query.size(2), key.size(2)
+        key_offset = key_length - query_length
+        num_key_blocks = (key_length + block_size - 1) // block_size
+        dtype = torch.promote_types(query.dtype, torch.float32)
+
+        query_grad = torch.zeros(query.size(), dtype=dtype,
+                                 device=query.device)
+        key_grad = torch.zeros(key.size(), dtype=dtype,
+                               device=key.device)
+        value_grad = torch.zeros(value.size(), dtype=dtype,
+                                 device=value.device)
+        # Row-wise sum of probs * probs_grad, i.e. of output * output_grad.
+        delta = (output_grad.to(dtype) * output.to(dtype)).sum(dim=-1,
+                                                           keepdim=True)
+        # Fully masked rows spread their gradient evenly over all values.
+        masked_rows = torch.isinf(logsumexp)
+        if masked_rows.any():
+            value_grad += (output_grad.to(dtype) * masked_rows).sum(
+                dim=2, keepdim=True) / key_length
+
+        for q0 in range(0, query_length, block_size):
+            q1 = min(q0 + block_size, query_length)
+            query_block = query[:, :, q0:q1]
+            output_grad_block = output_grad[:, :, q0:q1]
+            for k0 in range(0, _key_end(causal, q1, key_offset, key_length),
+                            block_size):
+                k1 = min(k0 + block_size, key_length)
+                key_block = key[:, :, k0:k1]
+                value_block = value[:, :, k0:k1]
+                scores = torch.matmul(
+                    query_block, key_block.transpose(-1, -2)).to(dtype)
+                scores.mul_(scale)
+                mask = _tile_mask(attention_mask, causal, q0, q1, k0, k1,
+                                  key_offset, query.device)
+                if mask is not None:
+                    scores.masked_fill_(mask, MASK_VALUE)
+                probs = torch.exp(scores.sub_(logsumexp[:, :, q0:q1]))
+                probs_grad = torch.matmul(
+                    output_grad_block, value_block.transpose(-1, -2)).to(dtype)
+                if dropout_p > 0.0:
+                    tile = q0 // block_size * num_key_blocks + k0 // block_size
+                    keep = _dropout_keep(ctx.seed, tile, probs.size(),
+                                         dropout_p, query.device)
+                    dropped_probs = probs * keep / (1.0 - dropout_p)
+                    probs_grad.mul_(keep).div_(1.0 - dropout_p)
+                else:
+                    dropped_probs = probs
+                value_grad[:, :, k0:k1] += torch.matmul(
+                    dropped_probs.to(output_grad.dtype).transpose(-1, -2),
+                    output_grad_block).to(dtype)
+                scores_grad = probs.mul_(
+                    probs_grad.sub_(delta[:, :, q0:q1])).mul_(scale)
+                if mask is not None:
+                    # masked_fill_ cuts the gradient of masked scores.
+                    scores_grad.masked_fill_(mask, 0.0)
+                scores_grad = scores_grad.to(query.dtype)
+                query_grad[:, :, q0:q1] += torch.matmul(scores_grad,
+                                                        key_block).to(dtype)
+                key_grad[:, :, k0:k1] += torch.matmul(
+                    scores_grad.transpose(-1, -2), query_block).to(dtype)
+
+        return (query_grad.to(query.dtype), key_grad.to(key.dtype),
+                value_grad.to(value.dtype), None, None, None, None, None,
+                None)
+
+
+def blocked_attention(query, key, value, attention_mask=None, causal=False,
+                      scale=1.0, dropout_p=0.0, seed=0, block_size=256):
+    """Return `softmax(scale * query @ key^T, masked) @ value` computed in
+    `block_size` tiles.
+
+    Arguments:
+        query: [b, np, sq, hn]; key, value: [b, np, sk, hn]. Queries are the
+            last `sq` positions of the keys, as when decoding with a key
+            cache.
+        attention_mask: None, a bool mask broadcastable to [b, np, sq, sk]
+            that is True where a query may not attend to a key, or compact
+            [b, s] document ids (which imply `causal`).
+        causal: mask keys after each query.
+        dropout_p: dropout probability applied to the attention probs; the
+            masks are a function of `seed`.
+    """
+    return BlockedAttentionFunction.apply(query, key, value, attention_mask,
+                                          causal, scale, dropout_p, seed,
+                                          block_size)
@@ -15,6 +15,8 @@
 
 import torch
 from megatron.model.enums import AttnMaskType
+from megatron.model.utils import get_causal_attention_mask
+from megatron.model.utils import get_document_attention_mask
 
 
 class ScaledUpperTriangMaskedSoftmax(torch.autograd.Function):
@@ -86,7 +88,8 @@ class FusedScaleMaskSoftmax(torch.nn.Module):
     fused operation: scaling + mask + softmax
     Arguments:
         input_in_fp16: flag to indicate if input in fp16 data format.
-        attn_mask_type: attention mask type (pad or causal)
+        attn_mask_type: attention mask type (pad or causal); causal
+            layers called without a mask apply the causal mask implicitly.
         mask_func: mask function to be applied.
         softmax_in_fp32: if true, softmax in performed at fp32 precision.
         scale: scaling factor used in input tensor scaling.
@@ -132,8 +135,13 @@ class FusedScaleMaskSoftmax(torch.nn.Module):
         custom_kernel_constraint = key_seq_len > 16 and key_seq_len <= 2048 and \
             query_seq_len % 4 == 0 and attn_batch_size % 4 == 0
 
+        # A causal layer given no mask applies the causal mask implicitly.
+        implicit_causal = mask is None and \
+            self.attn_mask_type == AttnMaskType.causal
+
         # invoke custom kernel
-        if self.input_in_float16 and mask is not None and \
+        if self.input_in_float16 and \
+            (mask is not None or implicit_causal) and \
             custom_kernel_constraint and self.scaled_masked_softmax_fusion:
             scale = self.scale if self.scale is not None else 1.0
 
@@ -145,6 +153,10 @@ class FusedScaleMaskSoftmax(torch.nn.Module):
                 probs = probs.view(*data_size)
             else:
                 assert self.attn_mask_type == AttnMaskType.padding
+                if mask.dim() == 2:
+                    # Compact [b, s] document ids.
+                    mask = get_document_attention_mask(
+                        mask, query_seq_len, key_seq_len)
                 probs = ScaledMaskedSoftmax.apply(input, mask, scale)
         else:
             if self.input_in_float16 and self.softmax_in_fp32:
@@ -152,6 +164,9 @@ class FusedScaleMaskSoftmax(torch.nn.Module):
 
             if self.scale is not None:
                 input = input * self.scale
+            if implicit_causal:
+                mask = get_causal_attention_mask(query_seq_len, key_seq_len,
+                                                 input.device)
             mask_output = self.mask_func(input, mask) if mask is not None else input
             probs = torch.nn.Softmax(dim=-1)(mask_output)
             if self.input_in_float16 and self.softmax_in_fp32:
@@ -27,6 +27,7 @@ from .language_model import parallel_lm_logits
 from .language_model import get_language_model
 from .utils import init_method_normal
 from .utils import scaled_init_method_normal
+from .utils import truncate_attention_mask
 
 from deepspeed.pipe import PipelineModule, LayerSpec, TiedLayerSpec
 from megatron.model import LayerNorm
@@ -111,8 +112,11 @@ class GPTModel(MegatronModule):
                 if labels is not None:
                     labels = labels[:, :curriculum_seqlen].contiguous()
 
-                # attention_mask has size [1, 1, seqlen, seqlen]
-                attention_mask = attention_mask[:, :, :curriculum_seqlen, :curriculum_seqlen].contiguous()
+                # attention_mask has size [1, 1, seqlen, seqlen] or, with
+                # --compact-document-mask, [batch size, seqlen]
+                if attention_mask is not None:
+                    attention_mask = truncate_attention_mask(
+                        attention_mask, curriculum_seqlen)
         else:
             if args.curriculum_learning_legacy:
                 # If got a None input, need to reset curriculum_seqlen on user side
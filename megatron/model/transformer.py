@@ -30,6 +30,7 @@ from megatron.model.enums import AttnMaskType, LayerType, AttnType
 #from megatron.model import LayerNorm
 from torch.nn import LayerNorm
 from megatron.model.fused_softmax import FusedScaleMaskSoftmax
+from megatron.model.blocked_attention import blocked_attention
 from megatron.model.fused_bias_gelu import bias_gelu_impl
 from megatron.model.utils import attention_mask_func, openai_gelu, erf_gelu
 from torch import distributed as dist
@@ -203,6 +204,9 @@ class ParallelAttention(MegatronModule):
         # on average it should not be partition dependent.
         self.attention_dropout = torch.nn.Dropout(args.attention_dropout)
 
+        self.blocked_attention = args.blocked_attention
+        self.attention_block_size = args.attention_block_size
+
         # Output.
         self.dense = mpu.RowParallelLinear(
             projection_size,
@@ -284,6 +288,37 @@ class ParallelAttention(MegatronModule):
         if args.use_timer:
             timers('adjust_key_value').stop()
 
+        if self.blocked_attention:
+            context_layer = self.blocked_core_attention(
+                query_layer, key_layer, value_layer, attention_mask)
+        else:
+            context_layer = self.core_attention(
+                query_layer, key_layer, value_layer, attention_mask,
+                layer_past, get_key_value)
+
+        # =================
+        # Output. [sq, b, h]
+        # =================
+
+        if args.use_timer:
+            timers('dense').start()
+        output, bias = self.dense(context_layer)
+        if args.use_timer:
+            timers('dense').stop()
+
+        if get_key_value:
+            output = [output, present]
+
+        return output, bias
+
+    def core_attention(self, query_layer, key_layer, value_layer,
+                       attention_mask, layer_past, get_key_value):
+        """Attention of [sq, b, np, hn] queries to [sk, b, np, hn] keys and
+        values through the full [b, np, sq, sk] scores; returns the
+        [sq, b, hp] context layer."""
+        args = get_args()
+        timers = get_timers()
+
         # ===================================
         # Raw attention scores. [b, np, s, s]
         # ===================================
@@ -334,7 +369,10 @@ class ParallelAttention(MegatronModule):
 
         if args.use_timer:
             timers('update_attention_mask').start()
-        if get_key_value:
+        # Compact document id masks are expanded to [sq, sk] when applied,
+        # a missing mask means an implicit causal mask.
+        if get_key_value and attention_mask is not None and \
+                attention_mask.dim() == 4:
             with torch.no_grad():
                 if layer_past is not None:
                     attention_mask = attention_mask[
@@ -417,20 +455,59 @@ class ParallelAttention(MegatronModule):
         if args.use_timer:
             timers('context_layer').stop()
 
-        # =================
-        # Output. [sq, b, h]
-        # =================
+        return context_layer
+
+    def blocked_core_attention(self, query_layer, key_layer, value_layer,
+                               attention_mask):
+        """`core_attention` computed in query and key blocks, see
+        megatron/model/blocked_attention.py."""
+        args = get_args()
+        timers = get_timers()
 
         if args.use_timer:
-            timers('dense').start()
-        output, bias = self.dense(context_layer)
+            timers('blocked_attention').start()
+        # [s, b, np, hn] --> [b, np, s, hn]
+        query_layer, key_layer, value_layer = [
+            layer.permute(1, 2, 0, 3).contiguous()
+            for layer in (query_layer, key_layer, value_layer)]
+        query_length, key_length = query_layer.size(2), key_layer.size(2)
+        if attention_mask is not None and attention_mask.dim() == 4:
+            # The mask may cover the full sequence when decoding with a key
+            # cache or during curriculum learning; queries are the last
+            # positions.
+            attention_mask = attention_mask[
+                ..., key_length - query_length:key_length, :key_length]
+
+        # The scaling by 1 / layer number of the query key layer scaling
+        # cancels with the softmax scale.
+        scale = 1.0 / math.sqrt(self.hidden_size_per_attention_head)
+        dropout_p, seed = 0.0, 0
+        if self.training and self.attention_dropout.p > 0.0:
+            dropout_p = self.attention_dropout.p
+            # Draw the dropout seed like the dropout masks of core_attention.
+            if not args.no_cuda:
+                rng_tracker = mpu.get_cuda_rng_tracker()
+            else:
+                rng_tracker = mpu.get_cpus_rng_tracker()
+            with rng_tracker.fork():
+                seed = torch.randint(2 ** 62, (1,),
+                                     device=query_layer.device).item()
+
+        context_layer = blocked_attention(
+            query_layer, key_layer, value_layer, attention_mask,
+            causal=self.attn_mask_type == AttnMaskType.causal, scale=scale,
+            dropout_p=dropout_p, seed=seed,
+            block_size=self.attention_block_size)
+
+        # [b, np, sq, hn] --> [sq, b, hp]
+        context_layer = context_layer.permute(2, 0, 1, 3).contiguous()
+        new_context_layer_shape = context_layer.size()[:-2] + \
+            (self.hidden_size_per_partition,)
+        context_layer = context_layer.view(*new_context_layer_shape)
         if args.use_timer:
-            timers('dense').stop()
+            timers('blocked_attention').stop()
 
-        if get_key_value:
-            output = [output, present]
-
-        return output, bias
+        return context_layer
 
 
 def bias_dropout_add(x, bias, residual, prob, training):
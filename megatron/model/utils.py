@@ -41,6 +41,12 @@ def scaled_init_method_normal(sigma, num_layers):
 
 def attention_mask_func(attention_scores, attention_mask):
     args = get_args()
+    if attention_mask.dim() == 2:
+        # Compact [b, s] document ids.
+        attention_mask = get_document_attention_mask(
+            attention_mask, attention_scores.size(2), attention_scores.size(3))
+        attention_scores.masked_fill_(attention_mask, -10000.0)
+        return attention_scores
     if args.curriculum_learning_legacy or args.data_efficiency_curriculum_learning:
         attention_mask_ = attention_mask
         actual_seqlen = attention_scores.size()[2]
@@ -53,6 +59,67 @@ def attention_mask_func(attention_scores, attention_mask):
     return attention_scores
 
 
+# Constant mask and position tensors keyed by (name, size, device, dtype).
+_CONSTANT_TENSOR_CACHE = {}
+
+
+def _cached_constant(name, size, device, dtype, factory):
+    key = (name, size, torch.device(device), dtype)
+    tensor = _CONSTANT_TENSOR_CACHE.get(key)
+    if tensor is None:
+        tensor = factory()
+        _CONSTANT_TENSOR_CACHE[key] = tensor
+    return tensor
+
+
+def get_causal_attention_mask(query_seq_length, key_seq_length, device):
+    """Return a cached `[1, 1, sq, sk]` bool mask that is True for future
+    keys. Callers must not modify it in place."""
+    return _cached_constant(
+        'causal_mask', (query_seq_length, key_seq_length), device, torch.bool,
+        lambda: torch.ones(
+            (query_seq_length, key_seq_length), dtype=torch.bool,
+            device=device).triu_(key_seq_length - query_seq_length + 1).view(
+                1, 1, query_seq_length, key_seq_length))
+
+
+def get_position_ids(seq_length, device):
+    """Return cached `[1, s]` position ids. Callers must not modify them in
+    place."""
+    return _cached_constant(
+        'position_ids', seq_length, device, torch.long,
+        lambda: torch.arange(seq_length, dtype=torch.long,
+                             device=device).unsqueeze(0))
+
+
+def get_document_attention_mask(document_ids, query_seq_length=None,
+                                key_seq_length=None):
+    """Expand `[b, s]` document ids into a `[b, 1, sq, sk]` bool mask that
+    is True where a query may not attend to a key: keys in the future or
+    in another document."""
+    if query_seq_length is None:
+        query_seq_length = document_ids.size(1)
+    if key_seq_length is None:
+        key_seq_length = document_ids.size(1)
+    # Queries are the last positions when decoding with a key cache.
+    query_ids = document_ids[:, key_seq_length - query_seq_length:
+                             key_seq_length]
+    key_ids = document_ids[:, :key_seq_length]
+    future = get_causal_attention_mask(query_seq_length, key_seq_length,
+                                       document_ids.device)
+    return (query_ids.unsqueeze(2) != key_ids.unsqueeze(1)).unsqueeze(1) | \
+        future
+
+
+def truncate_attention_mask(attention_mask, seq_length):
+    """Cut an attention mask down to the first `seq_length` tokens, as for
+    seqlen-based curriculum learning. Handles both `[b, 1, s, s]` masks and
+    compact `[b, s]` document ids."""
+    if attention_mask.dim() == 2:
+        return attention_mask[:, :seq_length].contiguous()
+    return attention_mask[:, :, :seq_length, :seq_length].contiguous()
+
+
 def get_linear_layer(rows, columns, init_method):
     """Simple linear layer with weight initialization."""
     layer = torch.nn.Linear(rows, columns)
@@ -19,11 +19,13 @@
 from .cross_entropy import vocab_parallel_cross_entropy
 
 from .data import broadcast_data
+from .data import get_data_device
 
 from .initialize import is_unitialized
 from .initialize import destroy_model_parallel
 from .initialize import get_data_parallel_group
 from .initialize import get_data_parallel_rank
+from .initialize import get_data_parallel_src_rank
 from .initialize import get_data_parallel_world_size
 from .initialize import get_embedding_group
 from .initialize import get_model_parallel_group
@@ -26,6 +26,15 @@ from megatron import get_timers, get_args
 
 _MAX_DATA_DIM = 5
 
+# Sizes negotiated by `broadcast_data(..., cache_sizes=True)`, by keys.
+# Identical on the ranks of a tensor parallel group.
+_KEY_SIZE_NUMEL_CACHE = {}
+
+
+def get_data_device():
+    """The device that `broadcast_data` returns the data on."""
+    return torch.cuda.current_device() if torch.cuda.is_available() else 'cpu'
+
 
 def _check_data_types(keys, data, target_dtype):
     """Check that all the keys have the same target data type."""
@@ -77,7 +86,8 @@ def _build_key_size_numel_dictionaries(keys, data):
     return key_size, key_numel, total_numel
 
 
-def broadcast_data(keys, data, datatype):
+def broadcast_data(keys, data, datatype, transfer_dtype=None,
+                   cache_sizes=False):
     """Broadcast data from rank zero of each model parallel group to the
     members of the same model parallel group.
 
@@ -86,6 +96,13 @@ def broadcast_data(keys, data, datatype):
         data: data dictionary of string keys and cpu tensor values.
         datatype: torch data type of all tensors in data associated
                   with keys.
+        transfer_dtype: narrower integer type to send the data in. Values
+                  must be non-negative and fit in its bits; int16 is read
+                  back as unsigned. The output is widened to `datatype`.
+        cache_sizes: negotiate the sizes on the first call only and reuse
+                  them for later calls with the same keys. Tensor parallel
+                  rank 0 sends a flag with the data that makes all ranks
+                  negotiate again when the sizes of a batch differ.
     """
     args: argparse.Namespace = get_args()
     timers = get_timers()
@@ -93,47 +110,102 @@ def broadcast_data(keys, data, datatype):
     # with the total number of elements on all ranks.
     if args.use_timer:
         timers('_build_key_size_numel_dictionaries').start()
-    key_size, key_numel, total_numel = _build_key_size_numel_dictionaries(keys,
-                                                                          data)
+    cached = _KEY_SIZE_NUMEL_CACHE.get(tuple(keys)) if cache_sizes else None
+    if cached is not None:
+        key_size, key_numel, total_numel = cached
+    else:
+        key_size, key_numel, total_numel = \
+            _build_key_size_numel_dictionaries(keys, data)
+        if cache_sizes:
+            _KEY_SIZE_NUMEL_CACHE[tuple(keys)] = \
+                (key_size, key_numel, total_numel)
     if args.use_timer:
         timers('_build_key_size_numel_dictionaries').stop()
 
+    if cached is None:
+        header = 0
+        flatten_data = _broadcast_flatten_data(keys, data, datatype,
+                                               transfer_dtype, total_numel)
+    else:
+        header = 1
+        flatten_data = _broadcast_flatten_data(keys, data, datatype,
+                                               transfer_dtype, total_numel,
+                                               cached_sizes=key_size)
+        if flatten_data[0] != 0:
+            # The batch has other sizes than the cached ones.
+            header = 0
+            key_size, key_numel, total_numel = \
+                _build_key_size_numel_dictionaries(keys, data)
+            _KEY_SIZE_NUMEL_CACHE[tuple(keys)] = \
+                (key_size, key_numel, total_numel)
+            flatten_data = _broadcast_flatten_data(
+                keys, data, datatype, transfer_dtype, total_numel)
+
+    # Unpack
+    output = {}
+    offset = header
+    if args.use_timer:
+        timers('unpack').start()
+    if transfer_dtype is not None:
+        flatten_data = flatten_data.to(datatype)
+        if transfer_dtype == torch.int16:
+            flatten_data &= 0xFFFF
+    for key in keys:
+        size = key_size[key]
+        numel = key_numel[key]
+        output[key] = flatten_data.narrow(0, offset, numel).view(size)
+        offset += numel
+    if args.use_timer:
+        timers('unpack').stop()
+
+    return output
+
+
+def _broadcast_flatten_data(keys, data, datatype, transfer_dtype,
+                            total_numel, cached_sizes=None):
+    """Broadcast the data of `keys` flattened into one tensor. With
+    `cached_sizes`, the first element is a flag that is 1 if the data on
+    rank zero has other sizes, in which case nothing else is sent."""
+    args = get_args()
+    timers = get_timers()
+    header = 0 if cached_sizes is None else 1
+
     # Pack on rank zero.
-    device = torch.cuda.current_device() if torch.cuda.is_available() else 'cpu'
+    device = get_data_device()
     if args.use_timer:
         timers('pack').start()
     if get_tensor_model_parallel_rank() == 0:
         # Check that all keys have the same data type.
         _check_data_types(keys, data, datatype)
-        # Flatten the data associated with the keys
-        flatten_data = torch.cat(
-            [data[key].contiguous().view(-1) for key in keys], dim=0).to(device)
+        if cached_sizes is not None and any(
+                list(data[key].size()) != [int(s) for s in cached_sizes[key]]
+                for key in keys):
+            flatten_data = torch.ones(header + total_numel, dtype=datatype)
+        else:
+            # Flatten the data associated with the keys
+            flatten_data = torch.cat(
+                [torch.zeros(header, dtype=datatype)] +
+                [data[key].contiguous().view(-1) for key in keys], dim=0)
+        if transfer_dtype is not None:
+            flatten_data = flatten_data.to(transfer_dtype)
+        flatten_data = flatten_data.to(device)
     else:
-        flatten_data = torch.empty(total_numel,
+        flatten_data = torch.empty(header + total_numel,
                                    device=device,
-                                   dtype=datatype)
+                                   dtype=transfer_dtype or datatype)
     if args.use_timer:
         timers('pack').stop()
 
     # Broadcast
     if args.use_timer:
         timers('broadcast').start()
-    torch.distributed.broadcast(flatten_data, get_tensor_model_parallel_src_rank(),
-                                group=get_tensor_model_parallel_group())
+    # Narrow types go over the wire as bytes, which every backend supports.
+    torch.distributed.broadcast(
+        flatten_data if transfer_dtype is None
+        else flatten_data.view(torch.uint8),
+        get_tensor_model_parallel_src_rank(),
+        group=get_tensor_model_parallel_group())
     if args.use_timer:
         timers('broadcast').stop()
 
-    # Unpack
-    output = {}
-    offset = 0
-    if args.use_timer:
-        timers('unpack').start()
-    for key in keys:
-        size = key_size[key]
-        numel = key_numel[key]
-        output[key] = flatten_data.narrow(0, offset, numel).view(size)
-        offset += numel
-    if args.use_timer:
-        timers('unpack').stop()
-
-    return output
+    return flatten_data
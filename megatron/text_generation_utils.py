@@ -84,6 +84,14 @@ def top_k_logits(logits, top_k=0, top_p=0.0, filter_value=-float('Inf')):
     return logits
 
 
+def detokenize_new_tokens(detokenizer, tokens, num_decoded):
+    """Feed the ids of the first sample of `tokens` after the first
+    `num_decoded` to `detokenizer`; return the text they complete and the
+    new number of decoded ids."""
+    new_tokens = tokens[0, num_decoded:].tolist()
+    return detokenizer.add(new_tokens), num_decoded + len(new_tokens)
+
+
 def generate_samples_input_from_file(model):
 
     args = get_args()
@@ -164,6 +172,8 @@ def generate_samples_input_from_file(model):
                     torch.distributed.broadcast(context_tokens_tensor, src, group)
                     context_tokens = context_tokens_tensor.cpu().numpy().tolist()
 
+            # get_token_stream pads context_tokens in place.
+            detokenizer = tokenizer.incremental_detokenizer(context_tokens)
             token_stream = get_token_stream(model, [context_tokens])
             for _, decode_tokens in enumerate(token_stream):
                 pass
@@ -177,9 +187,9 @@ def generate_samples_input_from_file(model):
                     fname_out.write(raw_text)
 
                     decode_tokens, _ = decode_tokens
-                    decode_tokens = decode_tokens[0].cpu().numpy().tolist()
-                    trim_decode_tokens = tokenizer.detokenize(
-                        decode_tokens)[raw_text_len:]
+                    trim_decode_tokens, _ = detokenize_new_tokens(
+                        detokenizer, decode_tokens, context_length)
+                    trim_decode_tokens += detokenizer.finish()
                     print("\nMegatron-LM:", trim_decode_tokens, flush=True)
 
                     fname_out.write("\n\nMegatron-LM:")
@@ -286,9 +296,14 @@ def generate_samples_interactive(model, print_frequency=24):
                     torch.distributed.broadcast(context_tokens_tensor, src, group)
                     context_tokens = context_tokens_tensor.cpu().numpy().tolist()
 
+            # Only the tokens generated since the last print are
+            # detokenized; get_token_stream pads context_tokens in place.
+            detokenizer = tokenizer.incremental_detokenizer(context_tokens)
+            num_decoded = context_length
+            trim_decode_tokens = ''
             token_stream = get_token_stream(model, [context_tokens])
 
-            for counter, decode_tokens in enumerate(token_stream):
+            for counter, (decode_tokens, _) in enumerate(token_stream):
                 if counter % print_frequency != 0 \
                    or mpu.get_tensor_model_parallel_rank() != 0 \
                    or not mpu.is_pipeline_first_stage():
@@ -297,10 +312,9 @@ def generate_samples_interactive(model, print_frequency=24):
                 os.system('clear')
                 print("\nContext:", raw_text, flush=True)
 
-                decode_tokens, _ = decode_tokens
-                decode_tokens = decode_tokens[0].cpu().numpy().tolist()
-                trim_decode_tokens = tokenizer.detokenize(
-                    decode_tokens)[raw_text_len:]
+                text, num_decoded = detokenize_new_tokens(
+                    detokenizer, decode_tokens, num_decoded)
+                trim_decode_tokens += text
                 print("\nMegatron-LM:", trim_decode_tokens, flush=True)
 
             if mpu.is_pipeline_first_stage() \
@@ -308,11 +322,9 @@ def generate_samples_interactive(model, print_frequency=24):
                 os.system('clear')
                 print("\nContext:", raw_text, flush=True)
 
-                if not isinstance(decode_tokens, list):
-                    decode_tokens, _ = decode_tokens
-                    decode_tokens = decode_tokens[0].cpu().numpy().tolist()
-                trim_decode_tokens = tokenizer.detokenize(
-                    decode_tokens)[raw_text_len:]
+                text, num_decoded = detokenize_new_tokens(
+                    detokenizer, decode_tokens, num_decoded)
+                trim_decode_tokens += text + detokenizer.finish()
                 print("\nMegatron-LM:", trim_decode_tokens, flush=True)
 
                 input("\nPress Enter to continue >>>")
@@ -29,6 +29,7 @@ TIMER_PROFILE_TARGET_NAMES: list[str] = [
     "gptdataset_otherwise",
     "gptdataset_dict1",
     "gptdataset_dict2",
+    "gptdataset_getitems",
     "broadcast_data",
     "_build_key_size_numel_dictionaries",
     "pack",
@@ -56,6 +57,7 @@ TIMER_PROFILE_TARGET_NAMES: list[str] = [
     "attention_dropout",
     "context_layer",
     "bmm",
+    "blocked_attention",
     "dense",
     "row_par_lin_mm",
     "row_par_lin_allreduce",
@@ -161,11 +161,20 @@ def whitespace_tokenize(text):
 class FullTokenizer(object):
     """Runs end-to-end tokenziation."""
 
-    def __init__(self, vocab_file, do_lower_case=True):
-        self.vocab = load_vocab(vocab_file)
-        self.inv_vocab = {v: k for k, v in self.vocab.items()}
+    def __init__(self, vocab_file, do_lower_case=True, use_trie=True,
+                 vocab=None, inv_vocab=None, tries=None):
+        # `vocab` (a token to id mapping), `inv_vocab` and `tries` as built
+        # by an earlier instance replace the file.
+        self.vocab = load_vocab(vocab_file) if vocab is None else vocab
+        if inv_vocab is None:
+            inv_vocab = {v: k for k, v in self.vocab.items()}
+        self.inv_vocab = inv_vocab
         self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
-        self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+        if use_trie:
+            self.wordpiece_tokenizer = TrieWordpieceTokenizer(
+                vocab=self.vocab, tries=tries)
+        else:
+            self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
 
     def tokenize(self, text):
         split_tokens = []
@@ -362,6 +371,73 @@ class WordpieceTokenizer(object):
         return output_tokens
 
 
+class TrieWordpieceTokenizer(WordpieceTokenizer):
+    """WordPiece tokenization with the longest matches found by walking a
+    prefix trie of the vocabulary instead of testing ever shorter
+    substrings. Gives the same output as `WordpieceTokenizer`."""
+
+    # Key marking the nodes that end a vocabulary entry.
+    _END = None
+
+    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=200,
+                 tries=None):
+        super(TrieWordpieceTokenizer, self).__init__(
+            vocab, unk_token, max_input_chars_per_word)
+        if tries is not None:
+            # `(prefix_trie, suffix_trie)` of an earlier instance.
+            self.prefix_trie, self.suffix_trie = tries
+            return
+        # Every piece may start a word, "##" pieces without the "##"
+        # continue one.
+        self.prefix_trie = {}
+        self.suffix_trie = {}
+        for piece in vocab:
+            self._insert(self.prefix_trie, piece)
+            if piece.startswith("##"):
+                self._insert(self.suffix_trie, piece[2:])
+
+    def _insert(self, trie, piece):
+        node = trie
+        for char in piece:
+            node = node.setdefault(char, {})
+        node[self._END] = True
+
+    def tokenize(self, text):
+        """Same as `WordpieceTokenizer.tokenize`."""
+
+        text = convert_to_unicode(text)
+
+        output_tokens = []
+        for token in whitespace_tokenize(text):
+            if len(token) > self.max_input_chars_per_word:
+                output_tokens.append(self.unk_token)
+                continue
+
+            sub_tokens = []
+            start = 0
+            trie = self.prefix_trie
+            while start < len(token):
+                node = trie
+                end = None
+                for i in range(start, len(token)):
+                    node = node.get(token[i])
+                    if node is None:
+                        break
+                    if self._END in node:
+                        end = i + 1
+                if end is None:
+                    sub_tokens = [self.unk_token]
+                    break
+                if start > 0:
+                    sub_tokens.append("##" + token[start:end])
+                else:
+                    sub_tokens.append(token[start:end])
+                start = end
+                trie = self.suffix_trie
+            output_tokens.extend(sub_tokens)
+        return output_tokens
+
+
 def _is_whitespace(char):
     """Checks whether `chars` is a whitespace character."""
     # \t, \n, and \r are technically contorl characters but we treat them
@@ -23,6 +23,7 @@ import json
 import logging
 import os
 import regex as re
+from collections import OrderedDict
 from io import open
 
 try:
@@ -49,6 +50,9 @@ PRETRAINED_VOCAB_POSITIONAL_EMBEDDINGS_SIZE_MAP = {
 VOCAB_NAME = 'vocab.json'
 MERGES_NAME = 'merges.txt'
 SPECIAL_TOKENS_NAME = 'special_tokens.txt'
+# Words whose BPE result is memoized; the least recently used are dropped.
+# Enough for the frequent words of a corpus at a few MB per process.
+DEFAULT_BPE_CACHE_SIZE = 1 << 16
 
 
 @lru_cache()
@@ -154,17 +158,32 @@ class GPT2Tokenizer(object):
         return tokenizer
 
     def __init__(self, vocab_file, merges_file, errors='replace',
-                 special_tokens=None, max_len=None):
+                 special_tokens=None, max_len=None,
+                 cache_size=DEFAULT_BPE_CACHE_SIZE, encoder=None,
+                 decoder=None, bpe_ranks=None):
+        # `encoder`, `decoder` and `bpe_ranks` (merge pairs to their rank)
+        # as built by an earlier instance replace the files.
         self.max_len = max_len if max_len is not None else int(1e12)
-        self.encoder = json.load(open(vocab_file))
-        self.decoder = {v: k for k, v in self.encoder.items()}
+        if encoder is None:
+            encoder = json.load(open(vocab_file))
+        self.encoder = encoder
+        if decoder is None:
+            decoder = {v: k for k, v in self.encoder.items()}
+        self.decoder = decoder
         self.errors = errors  # how to handle errors in decoding
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
-        bpe_data = open(merges_file, encoding='utf-8').read().split('\n')[1:-1]
-        bpe_merges = [tuple(merge.split()) for merge in bpe_data]
-        self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        if bpe_ranks is None:
+            bpe_data = open(merges_file, encoding='utf-8').read().split('\n')[1:-1]
+            bpe_merges = [tuple(merge.split()) for merge in bpe_data]
+            bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
+        self.bpe_ranks = bpe_ranks
+        # LRU of `bpe` results bounded to `cache_size` words (None for no
+        # bound).
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
 
         # Should haved added re.IGNORECASE so BPE merges can happen for
         # capitalized versions of contractions
@@ -192,9 +211,17 @@ class GPT2Tokenizer(object):
         self.special_tokens_decoder = {v: k for k, v in self.special_tokens.items()}
         logger.info("Special tokens {}".format(self.special_tokens))
 
+    @property
+    def cache_hit_rate(self):
+        return self.cache_hits / max(self.cache_hits + self.cache_misses, 1)
+
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
+        word = self.cache.get(token)
+        if word is not None:
+            self.cache_hits += 1
+            self.cache.move_to_end(token)
+            return word
+        self.cache_misses += 1
         word = tuple(token)
         pairs = get_pairs(word)
 
@@ -230,7 +257,10 @@ class GPT2Tokenizer(object):
             else:
                 pairs = get_pairs(word)
         word = ' '.join(word)
-        self.cache[token] = word
+        if self.cache_size is None or self.cache_size > 0:
+            self.cache[token] = word
+            if self.cache_size is not None and len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
         return word
 
     def tokenize(self, text):
@@ -246,17 +276,25 @@ class GPT2Tokenizer(object):
 
     def convert_tokens_to_ids(self, tokens):
         """ Converts a sequence of tokens into ids using the vocab. """
-        ids = []
         if isinstance(tokens, str) or (sys.version_info[0] == 2 and isinstance(tokens, unicode)):
             if tokens in self.special_tokens:
                 return self.special_tokens[tokens]
             else:
                 return self.encoder.get(tokens, 0)
+        ids = self._convert_tokens_to_ids(tokens)
+        self._check_length(ids)
+        return ids
+
+    def _convert_tokens_to_ids(self, tokens):
+        ids = []
         for token in tokens:
             if token in self.special_tokens:
                 ids.append(self.special_tokens[token])
             else:
                 ids.append(self.encoder.get(token, 0))
+        return ids
+
+    def _check_length(self, ids):
         if len(ids) > self.max_len:
             logger.warning(
                 "Token indices sequence length is longer than the specified maximum "
@@ -264,7 +302,6 @@ class GPT2Tokenizer(object):
                 " sequence through the model will result in indexing errors".format(
                     len(ids), self.max_len)
             )
-        return ids
 
     def convert_ids_to_tokens(self, ids, skip_special_tokens=False):
         """Converts a sequence of ids in BPE tokens using the vocab."""
@@ -280,6 +317,23 @@ class GPT2Tokenizer(object):
     def encode(self, text):
         return self.convert_tokens_to_ids(self.tokenize(text))
 
+    def encode_batch(self, texts):
+        """ Encode a list of strings; every distinct word of the batch is
+            byte encoded and merged only once. """
+        words = [re.findall(self.pat, text) for text in texts]
+        word_ids = {}
+        for doc_words in words:
+            for word in doc_words:
+                if word not in word_ids:
+                    token = ''.join(self.byte_encoder[b] for b in word.encode('utf-8'))
+                    word_ids[word] = self._convert_tokens_to_ids(self.bpe(token).split(' '))
+        batch_ids = []
+        for doc_words in words:
+            ids = [i for word in doc_words for i in word_ids[word]]
+            self._check_length(ids)
+            batch_ids.append(ids)
+        return batch_ids
+
     def decode(self, tokens):
         text = ''.join([self.decoder[token] for token in tokens])
         text = bytearray([self.byte_decoder[c] for c in text]).decode('utf-8', errors=self.errors)
@@ -17,6 +17,11 @@
 """Megatron tokenizers."""
 import sentencepiece as spm
 
+import codecs
+import hashlib
+import marshal
+import os
+import sys
 from abc import ABC
 from abc import abstractmethod
 
@@ -24,13 +29,90 @@ from .bert_tokenization import FullTokenizer as FullBertTokenizer
 from .gpt2_tokenization import GPT2Tokenizer
 
 
+# Bump when the contents of the tokenizer artifact change incompatibly.
+TOKENIZER_ARTIFACT_VERSION = 3
+
+
 def build_tokenizer(args):
     """Initialize tokenizer."""
     if args.rank == 0:
         print('> building {} tokenizer ...'.format(args.tokenizer_type),
               flush=True)
 
-    # Select and instantiate the tokenizer.
+    if getattr(args, 'tokenizer_cache_dir', None) is not None:
+        tokenizer = _build_or_load_tokenizer_artifact(args)
+    else:
+        tokenizer = _new_tokenizer(args)
+
+    # Add vocab size.
+    args.padded_vocab_size = _vocab_size_with_padding(tokenizer.vocab_size,
+                                                      args)
+
+    return tokenizer
+
+
+def tokenizer_artifact_path(args):
+    """Path of the artifact for the tokenizer files in --tokenizer-cache-dir,
+    keyed by their location, size and mtime and by the marshal format of
+    this Python."""
+    from megatron.data.node_local_cache import cache_key
+    files = [path for path in (args.vocab_file, args.merge_file)
+             if path is not None]
+    key = hashlib.md5('{}:{}:{}:{}:{}:{}'.format(
+        TOKENIZER_ARTIFACT_VERSION, sys.version_info[:2], marshal.version,
+        args.tokenizer_type, args.vocab_extra_ids,
+        cache_key(*files)).encode()).hexdigest()
+    return os.path.join(args.tokenizer_cache_dir,
+                        'megatron_tokenizer_{}.bin'.format(key))
+
+
+def save_tokenizer_artifact(tokenizer, path):
+    """Write the lookup tables of a tokenizer as built (see
+    `artifact_data`) to a single binary file.
+
+    The file is a marshal dump: it holds only dicts, tuples, strings,
+    bytes and numbers, and loading it restores the tables without parsing
+    the vocabulary files or building any table again.
+    """
+    with open(path, 'wb') as f:
+        f.write(marshal.dumps({'version': TOKENIZER_ARTIFACT_VERSION,
+                               'class': type(tokenizer).__name__,
+                               'data': tokenizer.artifact_data()}))
+
+
+def load_tokenizer_artifact(path):
+    """Rebuild a tokenizer from a file written by `save_tokenizer_artifact`,
+    read with one read."""
+    with open(path, 'rb') as f:
+        artifact = marshal.loads(f.read())
+    assert artifact['version'] == TOKENIZER_ARTIFACT_VERSION, \
+        'tokenizer artifact {} has version {}, expected {}'.format(
+            path, artifact['version'], TOKENIZER_ARTIFACT_VERSION)
+    classes = {cls.__name__: cls for cls in (
+        _BertWordPieceTokenizer, _GPT2BPETokenizer, _JapaneseSentencePiece)}
+    return classes[artifact['class']].from_artifact_data(artifact['data'])
+
+
+def _build_or_load_tokenizer_artifact(args):
+    """The first rank of a node parses the tokenizer files and writes the
+    artifact; the other ranks wait for it and load it."""
+    from megatron.data.node_local_cache import build_file
+    os.makedirs(args.tokenizer_cache_dir, exist_ok=True)
+    path = tokenizer_artifact_path(args)
+    tokenizer = None
+    if not os.path.exists(path):
+        def build(tmp_path):
+            nonlocal tokenizer
+            tokenizer = _new_tokenizer(args)
+            save_tokenizer_artifact(tokenizer, tmp_path)
+        build_file(path, build)
+    if tokenizer is None:
+        tokenizer = load_tokenizer_artifact(path)
+    return tokenizer
+
+
+def _new_tokenizer(args):
+    """Build the tokenizer from its vocabulary files."""
     assert args.vocab_file is not None
     if args.tokenizer_type == 'BertWordPieceLowerCase':
         tokenizer = _BertWordPieceTokenizer(vocab_file=args.vocab_file,
@@ -49,11 +131,6 @@ def build_tokenizer(args):
     else:
         raise NotImplementedError('{} tokenizer is not '
                                   'implemented.'.format(args.tokenizer_type))
-
-    # Add vocab size.
-    args.padded_vocab_size = _vocab_size_with_padding(tokenizer.vocab_size,
-                                                      args)
-
     return tokenizer
 
 
@@ -101,10 +178,20 @@ class AbstractTokenizer(ABC):
     def tokenize(self, text):
         pass
 
+    def tokenize_batch(self, texts):
+        """Tokenize a list of texts; tokenizers with a native batch encode
+        override this."""
+        return [self.tokenize(text) for text in texts]
+
     def detokenize(self, token_ids):
         raise NotImplementedError('detokenizer is not implemented for {} '
                                   'tokenizer'.format(self.name))
 
+    def incremental_detokenizer(self, token_ids=()):
+        """Return an `IncrementalDetokenizer` continuing after `token_ids`,
+        whose text it does not emit."""
+        return IncrementalDetokenizer(self.detokenize, token_ids)
+
     @property
     def cls(self):
         raise NotImplementedError('CLS is not provided for {} '
@@ -131,16 +218,86 @@ class AbstractTokenizer(ABC):
                                   'tokenizer'.format(self.name))
 
 
+class IncrementalDetokenizer(object):
+    """Turns a stream of token ids into the text they complete.
+
+    `add(token_ids)` returns only the text that the new ids complete, at a
+    cost independent of the number of ids seen before: the ids since the
+    last emitted text are detokenized together with a few ids before them,
+    so that tokenizers that drop leading spaces or merge characters across
+    ids still produce the right text. Text ending in an incomplete UTF-8
+    sequence (U+FFFD) is held back until more ids arrive or `finish` is
+    called.
+    """
+
+    # Ids kept in front of the unemitted ones as context.
+    CONTEXT_IDS = 5
+
+    def __init__(self, detokenize, token_ids=()):
+        self._detokenize = detokenize
+        token_ids = list(token_ids)
+        self._ids = token_ids[-self.CONTEXT_IDS:]
+        # The text of `_ids[:_read_offset]` has been emitted.
+        self._read_offset = len(self._ids)
+
+    def add(self, token_ids):
+        self._ids.extend(token_ids)
+        prefix_text = self._detokenize(self._ids[:self._read_offset])
+        text = self._detokenize(self._ids)
+        if len(text) <= len(prefix_text) or text.endswith('\ufffd'):
+            return ''
+        self._ids = self._ids[max(self._read_offset, len(self._ids) -
+                                  self.CONTEXT_IDS):]
+        self._read_offset = len(self._ids)
+        return text[len(prefix_text):]
+
+    def finish(self):
+        """Return the text held back at the end of the stream."""
+        prefix_text = self._detokenize(self._ids[:self._read_offset])
+        text = self._detokenize(self._ids)
+        self._ids = self._ids[len(self._ids):]
+        self._read_offset = 0
+        return text[len(prefix_text):]
+
+
+class _ByteLevelIncrementalDetokenizer(object):
+    """`IncrementalDetokenizer` for byte-level BPE: every id maps to fixed
+    bytes, so only the UTF-8 decoding carries state."""
+
+    def __init__(self, tokenizer, token_ids=()):
+        self._tokenizer = tokenizer
+        self._decoder = codecs.getincrementaldecoder('utf-8')(
+            errors=tokenizer.errors)
+        # Bytes of a character the context ids leave incomplete.
+        self._decoder.decode(self._bytes(token_ids))
+
+    def _bytes(self, token_ids):
+        byte_decoder = self._tokenizer.byte_decoder
+        return bytes(byte_decoder[c] for token in token_ids
+                     for c in self._tokenizer.decoder[token])
+
+    def add(self, token_ids):
+        return self._decoder.decode(self._bytes(token_ids))
+
+    def finish(self):
+        return self._decoder.decode(b'', final=True)
+
+
 class _BertWordPieceTokenizer(AbstractTokenizer):
     """Original BERT wordpiece tokenizer."""
 
-    def __init__(self, vocab_file, lower_case=True, vocab_extra_ids=0):
+    def __init__(self, vocab_file, lower_case=True, vocab_extra_ids=0,
+                 vocab=None, inv_vocab=None, tries=None):
         if lower_case:
             name = 'BERT Lower Case'
         else:
             name = 'BERT Upper Case'
         super().__init__(name)
-        self.tokenizer = FullBertTokenizer(vocab_file, do_lower_case=lower_case)
+        self.lower_case = lower_case
+        self.vocab_extra_ids = vocab_extra_ids
+        self.tokenizer = FullBertTokenizer(vocab_file, do_lower_case=lower_case,
+                                           vocab=vocab, inv_vocab=inv_vocab,
+                                           tries=tries)
         self.cls_id = self.tokenizer.vocab['[CLS]']
         self.sep_id = self.tokenizer.vocab['[SEP]']
         self.pad_id = self.tokenizer.vocab['[PAD]']
@@ -165,6 +322,24 @@ class _BertWordPieceTokenizer(AbstractTokenizer):
             ["<extra_id_{}>".format(i) for i in range(vocab_extra_ids)])
         self.add_additional_special_tokens(additional_special_tokens)
 
+    def artifact_data(self):
+        """Tables `from_artifact_data` restores the tokenizer from."""
+        # The special tokens are in the vocabulary already, so adding them
+        # again keeps their ids. marshal takes plain dicts only; they keep
+        # the order of the OrderedDict `load_vocab` returns.
+        wordpiece = self.tokenizer.wordpiece_tokenizer
+        return {'vocab': dict(self.vocab), 'inv_vocab': self.inv_vocab,
+                'tries': (wordpiece.prefix_trie, wordpiece.suffix_trie),
+                'lower_case': self.lower_case,
+                'vocab_extra_ids': self.vocab_extra_ids}
+
+    @classmethod
+    def from_artifact_data(cls, data):
+        return cls(None, lower_case=data['lower_case'],
+                   vocab_extra_ids=data['vocab_extra_ids'],
+                   vocab=data['vocab'], inv_vocab=data['inv_vocab'],
+                   tries=data['tries'])
+
     def add_token(self, token):
         if token not in self.vocab:
             self.inv_vocab[self.vocab_size] = token
@@ -265,14 +440,28 @@ class _BertWordPieceTokenizer(AbstractTokenizer):
 class _GPT2BPETokenizer(AbstractTokenizer):
     """Original GPT2 BPE tokenizer."""
 
-    def __init__(self, vocab_file, merge_file):
+    def __init__(self, vocab_file, merge_file, encoder=None, decoder=None,
+                 bpe_ranks=None):
         name = 'GPT2 BPE'
         super().__init__(name)
 
         self.tokenizer = GPT2Tokenizer(vocab_file, merge_file, errors='replace',
-                                       special_tokens=[], max_len=None)
+                                       special_tokens=[], max_len=None,
+                                       encoder=encoder, decoder=decoder,
+                                       bpe_ranks=bpe_ranks)
         self.eod_id = self.tokenizer.encoder['<|endoftext|>']
 
+    def artifact_data(self):
+        """Tables `from_artifact_data` restores the tokenizer from."""
+        return {'encoder': self.tokenizer.encoder,
+                'decoder': self.tokenizer.decoder,
+                'bpe_ranks': self.tokenizer.bpe_ranks}
+
+    @classmethod
+    def from_artifact_data(cls, data):
+        return cls(None, None, encoder=data['encoder'],
+                   decoder=data['decoder'], bpe_ranks=data['bpe_ranks'])
+
     @property
     def vocab_size(self):
         return len(self.tokenizer.encoder)
@@ -288,19 +477,29 @@ class _GPT2BPETokenizer(AbstractTokenizer):
     def tokenize(self, text):
         return self.tokenizer.encode(text)
 
+    def tokenize_batch(self, texts):
+        return self.tokenizer.encode_batch(texts)
+
     def detokenize(self, token_ids):
         return self.tokenizer.decode(token_ids)
 
+    def incremental_detokenizer(self, token_ids=()):
+        return _ByteLevelIncrementalDetokenizer(self.tokenizer, token_ids)
+
     @property
     def eod(self):
         return self.eod_id
 
 
 class _JapaneseSentencePiece(AbstractTokenizer):
-    def __init__(self, vocab_file):
+    def __init__(self, vocab_file, model_proto=None):
         name = 'Japanese Sentencepiece'
         super().__init__(name)
-        self.tokenizer = spm.SentencePieceProcessor(model_file=vocab_file)
+        # `model_proto`, a serialized model, replaces the file.
+        if model_proto is None:
+            self.tokenizer = spm.SentencePieceProcessor(model_file=vocab_file)
+        else:
+            self.tokenizer = spm.SentencePieceProcessor(model_proto=model_proto)
         # TODO: make sure eod and pad ids are included in the pre-trained tokenizer
         self.eod_id = self.tokenizer.piece_to_id("</s>")
         self.pad_id = self.tokenizer.piece_to_id("<pad>")
@@ -325,11 +524,24 @@ class _JapaneseSentencePiece(AbstractTokenizer):
         text = text.replace("\r\n", self.eol_symbol)
         return self.tokenizer.encode(text)
 
+    def tokenize_batch(self, texts):
+        texts = [text.replace("\n", self.eol_symbol).replace("\r\n", self.eol_symbol)
+                 for text in texts]
+        return self.tokenizer.encode(texts)
+
     def detokenize(self, token_ids):
         text = self.tokenizer.decode(token_ids)
         text = text.replace(self.eol_symbol, "\n")
         return text
 
+    def artifact_data(self):
+        """Data `from_artifact_data` restores the tokenizer from."""
+        return {'model_proto': self.tokenizer.serialized_model_proto()}
+
+    @classmethod
+    def from_artifact_data(cls, data):
+        return cls(None, model_proto=data['model_proto'])
+
     @property
     def eod(self):
         return self.eod_id
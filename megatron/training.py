@@ -1584,8 +1584,9 @@ def build_train_valid_test_data_iterators(build_train_valid_test_datasets_provid
             (args.iteration // args.eval_interval) * args.eval_iters * args.global_batch_size
         )
 
-    # Data loader only on rank 0 of each model parallel group.
-    if mpu.get_tensor_model_parallel_rank() == 0:
+    # Data loader only on rank 0 of each model parallel group, or on every
+    # tensor parallel rank with --tp-local-data.
+    if mpu.get_tensor_model_parallel_rank() == 0 or args.tp_local_data:
         # Number of train/valid/test samples.
         if args.train_samples:
             train_samples = args.train_samples
@@ -1609,15 +1610,26 @@ def build_train_valid_test_data_iterators(build_train_valid_test_datasets_provid
             train_val_test_num_samples
         )
 
-        # Build dataloders.
-        train_dataloader = build_pretraining_data_loader(train_ds, args.consumed_train_samples)
-        valid_dataloader = build_pretraining_data_loader(valid_ds, args.consumed_valid_samples)
-        test_dataloader = build_pretraining_data_loader(test_ds, 0)
+        # Build dataloders. With --tp-local-data, skip them on the middle
+        # stages: the DeepSpeed pipeline engine only reads data on the first
+        # and last stages.
+        if not (args.tp_local_data and args.deepspeed and
+                args.ds_pipeline_enabled) or \
+                mpu.is_pipeline_first_stage() or mpu.is_pipeline_last_stage():
+            train_dataloader = build_pretraining_data_loader(train_ds, args.consumed_train_samples)
+            valid_dataloader = build_pretraining_data_loader(valid_ds, args.consumed_valid_samples)
+            test_dataloader = build_pretraining_data_loader(test_ds, 0)
 
         # Flags to know if we need to do training/validation/testing.
-        do_train = train_dataloader is not None and args.train_iters > 0
-        do_valid = valid_dataloader is not None and args.eval_iters > 0
-        do_test = test_dataloader is not None and args.eval_iters > 0
+        if args.tp_local_data:
+            # Middle stages may have skipped their dataloaders.
+            do_train = train_ds is not None and args.train_iters > 0
+            do_valid = valid_ds is not None and args.eval_iters > 0
+            do_test = test_ds is not None and args.eval_iters > 0
+        else:
+            do_train = train_dataloader is not None and args.train_iters > 0
+            do_valid = valid_dataloader is not None and args.eval_iters > 0
+            do_test = test_dataloader is not None and args.eval_iters > 0
         # Need to broadcast num_tokens and num_type_tokens.
         flags = torch.LongTensor([int(do_train), int(do_valid), int(do_test)])
     else:
@@ -36,6 +36,9 @@ from megatron import print_rank_0
 from megatron import get_adlr_autoresume
 from megatron import mpu
 from megatron.model.module import param_is_not_shared
+from megatron.model.utils import get_causal_attention_mask
+from megatron.model.utils import get_document_attention_mask
+from megatron.model.utils import get_position_ids
 from megatron.mpu.layers import param_is_not_tensor_parallel_duplicate
 from megatron import get_num_microbatches
 from deepspeed.accelerator import get_accelerator
@@ -178,62 +181,61 @@ def get_ltor_masks_and_position_ids(data,
                                     eod_token,
                                     reset_position_ids,
                                     reset_attention_mask,
-                                    eod_mask_loss):
-    """Build masks and position id for left to right model."""
+                                    eod_mask_loss,
+                                    compact_attention_mask=False):
+    """Build masks and position id for left to right model.
+
+    Document resets are computed for the whole batch at once from per
+    token document ids (see `get_ltor_document_ids`). With
+    `compact_attention_mask` and `reset_attention_mask`, the returned
+    attention mask is the `[b, s]` document id tensor itself, which
+    `attention_mask_func` expands when it is applied.
+
+    The causal mask and the position ids without resets are cached per
+    sequence length and device and must not be modified in place.
+    """
 
     # Extract batch size and sequence length.
     micro_batch_size, seq_length = data.size()
 
-    # Attention mask (lower triangular).
-    if reset_attention_mask:
-        att_mask_batch = micro_batch_size
-    else:
-        att_mask_batch = 1
-    attention_mask = torch.tril(torch.ones(
-        (att_mask_batch, seq_length, seq_length), device=data.device)).view(
-            att_mask_batch, 1, seq_length, seq_length)
-
     # Loss mask.
     loss_mask = torch.ones(data.size(), dtype=torch.float, device=data.device)
     if eod_mask_loss:
         loss_mask[data == eod_token] = 0.0
 
     # Position ids.
-    position_ids = torch.arange(seq_length, dtype=torch.long,
-                                device=data.device)
-    position_ids = position_ids.unsqueeze(0).expand_as(data)
-    # We need to clone as the ids will be modifed based on batch index.
+    position_ids = get_position_ids(seq_length, data.device).expand_as(data)
+
     if reset_position_ids:
-        position_ids = position_ids.clone()
-
-    if reset_position_ids or reset_attention_mask:
-        # Loop through the batches:
-        for b in range(micro_batch_size):
-
-            # Find indecies where EOD token is.
-            eod_index = position_ids[b, data[b] == eod_token]
-            # Detach indecies from positions if going to modify positions.
-            if reset_position_ids:
-                eod_index = eod_index.clone()
-
-            # Loop through EOD indecies:
-            prev_index = 0
-            for j in range(eod_index.size()[0]):
-                i = eod_index[j]
-                # Mask attention loss.
-                if reset_attention_mask:
-                    attention_mask[b, 0, (i + 1):, :(i + 1)] = 0
-                # Reset positions.
-                if reset_position_ids:
-                    position_ids[b, (i + 1):] -= (i + 1 - prev_index)
-                    prev_index = i + 1
-
-    # Convert attention mask to binary:
-    attention_mask = (attention_mask < 0.5)
+        # A document starts right after each EOD token.
+        eod = data == eod_token
+        doc_start = torch.zeros_like(position_ids)
+        doc_start[:, 1:] = (position_ids[:, :-1] + 1) * eod[:, :-1]
+        doc_start = torch.cummax(doc_start, dim=1)[0]
+        position_ids = position_ids - doc_start
+
+    if reset_attention_mask:
+        document_ids = get_ltor_document_ids(data, eod_token)
+        if compact_attention_mask:
+            return document_ids, loss_mask, position_ids
+        attention_mask = get_document_attention_mask(document_ids)
+    else:
+        # Attention mask (upper triangular is masked), cached across calls.
+        attention_mask = get_causal_attention_mask(seq_length, seq_length,
+                                                   data.device)
 
     return attention_mask, loss_mask, position_ids
 
 
+def get_ltor_document_ids(data, eod_token):
+    """Return the `[b, s]` index of the document every token belongs to.
+
+    An EOD token belongs to the document it terminates.
+    """
+    eod = (data == eod_token).long()
+    return torch.cumsum(eod, dim=1) - eod
+
+
 def get_parameters_in_billions(model):
     gpus_per_model = torch.distributed.get_world_size(group=mpu.get_model_parallel_group())
 
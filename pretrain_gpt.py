@@ -29,6 +29,8 @@ from megatron import mpu
 from megatron.data.gpt_dataset import build_train_valid_test_datasets
 from megatron.model import GPTModel, GPTModelPipe
 from megatron.training import pretrain
+from megatron.model.utils import get_causal_attention_mask
+from megatron.model.utils import truncate_attention_mask
 from megatron.utils import get_ltor_masks_and_position_ids
 from megatron.utils import average_losses_across_data_parallel_group
 
@@ -64,21 +66,14 @@ def model_provider(pre_process=True, post_process=True):
 
             # Predompute the attention mask and store it in args. This avoids having to
             # pipeline it as an activation during training. The mask is constant, and thus
-            # we can reuse it.
-            device = torch.cuda.current_device() if torch.cuda.is_available() else 'cpu'
-            attention_mask = torch.tril(torch.ones(
-                (1, args.seq_length, args.seq_length), device=device)).view(
-                    1, 1, args.seq_length, args.seq_length)
-
-            # Convert attention mask to binary:
-            attention_mask = (attention_mask < 0.5)
-            if args.fp16:
-                attention_mask = attention_mask.half()
-            elif args.bf16:
-                attention_mask = attention_mask.bfloat16()
-
-            # Attention mask must be bool.
-            args.attn_mask = attention_mask.to(torch.bool)
+            # we can reuse it. With --implicit-causal-mask no mask is needed at all.
+            if args.implicit_causal_mask:
+                args.attn_mask = None
+            else:
+                device = torch.cuda.current_device() if torch.cuda.is_available() else 'cpu'
+                # Attention mask must be bool.
+                args.attn_mask = get_causal_attention_mask(
+                    args.seq_length, args.seq_length, device)
 
         else:
             model = GPTModel(
@@ -123,7 +118,7 @@ def get_batch(data_iterator):
     if args.use_timer:
         timers('broadcast_data').start()
     # timer start
-    data_b = mpu.broadcast_data(keys, data, datatype)
+    data_b = broadcast_data(keys, data, datatype)
     # timer end
     if args.use_timer:
         timers('broadcast_data').stop()
@@ -162,13 +157,40 @@ def get_batch(data_iterator):
         tokenizer.eod,
         args.reset_position_ids,
         args.reset_attention_mask,
-        args.eod_mask_loss)
+        args.eod_mask_loss,
+        compact_attention_mask=args.compact_document_mask)
     # timer end
     if args.use_timer:
         timers('get_ltor_masks_and_position_ids').stop()
+    if args.implicit_causal_mask and not args.reset_attention_mask:
+        # Causal attention layers mask future tokens themselves.
+        attention_mask = None
 
     return tokens, labels, loss_mask, attention_mask, position_ids
 
+def broadcast_data(keys, data, datatype):
+    """Return the batch on the current device. With --tp-local-data every
+    tensor parallel rank has read the same batch itself, otherwise it is
+    broadcast from tensor parallel rank 0."""
+    args = get_args()
+    if args.tp_local_data:
+        device = mpu.get_data_device()
+        return {key: data[key].to(device) for key in keys}
+    return mpu.broadcast_data(keys, data, datatype, **get_broadcast_options())
+
+def get_broadcast_options():
+    """Options for `mpu.broadcast_data` with --compact-data-broadcast: send
+    tokens in 16 or 32 bits and negotiate the batch shape only once."""
+    args = get_args()
+    if not args.compact_data_broadcast:
+        return {}
+    transfer_dtype = torch.int16 if args.padded_vocab_size <= 2 ** 16 \
+        else torch.int32
+    # Curriculum learning changes the sequence length between steps.
+    cache_sizes = not (args.curriculum_learning_legacy or
+                       args.data_efficiency_curriculum_learning)
+    return {'transfer_dtype': transfer_dtype, 'cache_sizes': cache_sizes}
+
 def data_post_process(data, data_sampler_state_dict):
     args = get_args()
     if args.data_efficiency_curriculum_learning:
@@ -204,7 +226,7 @@ def get_batch_pipe(data):
     datatype = torch.int64
 
     # Broadcast data.
-    data_b = mpu.broadcast_data(keys, data, datatype)
+    data_b = broadcast_data(keys, data, datatype)
 
     # Unpack.
     tokens_ = data_b['text'].long()
@@ -217,7 +239,8 @@ def get_batch_pipe(data):
         tokenizer.eod,
         args.reset_position_ids,
         args.reset_attention_mask,
-        args.eod_mask_loss)
+        args.eod_mask_loss,
+        compact_attention_mask=args.compact_document_mask)
     if args.curriculum_learning_legacy and args.curriculum_seqlen < tokens.size()[1]:
         # seqlen-based curriculum learning
         # tokens, position_ids, labels, loss_mask have size [batch size, seqlen]
@@ -275,7 +298,9 @@ def calculate_mos_loss(args, stu_output, teacher_model, tokens, position_ids, at
                 curriculum_seqlen = args.curriculum_seqlen
                 tokens = tokens[:, :curriculum_seqlen].contiguous()
                 position_ids = position_ids[:, :curriculum_seqlen].contiguous()
-                attention_mask = attention_mask[:, :, :curriculum_seqlen, :curriculum_seqlen].contiguous()
+                # No mask with --implicit-causal-mask
+                if attention_mask is not None:
+                    attention_mask = truncate_attention_mask(attention_mask, curriculum_seqlen)
                 # No need to truncate labels as we do not need it for the teacher logits
             tea_output, *tea_other_losses = teacher_model(tokens, position_ids, attention_mask)
             assert stu_output.size() == tea_output.size(), 'teacher and student output should match in size. Student: {}, Teacher: {}, CL seq length {}'.format(stu_output.size(), tea_output.size(), args.curriculum_seqlen)
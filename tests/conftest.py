@@ -0,0 +1,15 @@
+import argparse
+
+import pytest
+
+from megatron import global_vars
+
+
+@pytest.fixture
+def megatron_args(monkeypatch):
+    """Install global args (and timers) for code that calls `get_args()`;
+    tests set the attributes they need."""
+    args = argparse.Namespace(use_timer=False)
+    monkeypatch.setattr(global_vars, '_GLOBAL_ARGS', args)
+    monkeypatch.setattr(global_vars, '_GLOBAL_TIMERS', global_vars.Timers())
+    return args
@@ -0,0 +1,47 @@
+"""Run test code on several CPU ranks with the gloo backend."""
+
+import argparse
+import os
+import tempfile
+import traceback
+
+import torch
+import torch.multiprocessing
+
+from megatron import global_vars
+from megatron import mpu
+
+
+def run_distributed(worker, world_size, args=None,
+                    tensor_model_parallel_size=1,
+                    pipeline_model_parallel_size=1):
+    """Call `worker(rank)` on `world_size` spawned processes with
+    initialized model parallel groups and `args` (a dict) installed as the
+    global args. Fails if any rank raises."""
+    with tempfile.TemporaryDirectory() as directory:
+        torch.multiprocessing.spawn(
+            _run, args=(world_size, directory, worker, args or {},
+                        tensor_model_parallel_size,
+                        pipeline_model_parallel_size),
+            nprocs=world_size)
+
+
+def _run(rank, world_size, directory, worker, args,
+         tensor_model_parallel_size, pipeline_model_parallel_size):
+    global_vars._GLOBAL_ARGS = argparse.Namespace(
+        rank=rank, world_size=world_size, use_timer=False, no_cuda=True,
+        **args)
+    global_vars._GLOBAL_TIMERS = global_vars.Timers()
+    torch.distributed.init_process_group(
+        'gloo', init_method='file://' + os.path.join(directory, 'store'),
+        rank=rank, world_size=world_size)
+    try:
+        mpu.initialize_model_parallel(tensor_model_parallel_size,
+                                      pipeline_model_parallel_size)
+        worker(rank)
+    except Exception:
+        # Exceptions of spawned processes lose their traceback.
+        traceback.print_exc()
+        raise
+    finally:
+        torch.distributed.destroy_process_group()
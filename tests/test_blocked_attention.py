@@ -0,0 +1,84 @@
+import pytest
+import torch
+
+from megatron.model.blocked_attention import blocked_attention
+from megatron.model.utils import get_causal_attention_mask
+from megatron.model.utils import get_document_attention_mask
+
+
+def dense_attention(query, key, value, attention_mask, causal, scale):
+    """Reference: the full score matrix, masked like attention_mask_func."""
+    query_length, key_length = query.size(2), key.size(2)
+    mask = None
+    if attention_mask is not None and attention_mask.dim() == 2:
+        mask = get_document_attention_mask(attention_mask, query_length,
+                                           key_length)
+    elif attention_mask is not None:
+        mask = attention_mask
+    if causal:
+        future = get_causal_attention_mask(query_length, key_length,
+                                           query.device)
+        mask = future if mask is None else mask | future
+    scores = torch.matmul(query, key.transpose(-1, -2)) * scale
+    if mask is not None:
+        scores = scores.masked_fill(mask, -10000.0)
+    return torch.matmul(torch.softmax(scores, dim=-1), value)
+
+
+def make_inputs(query_length, key_length, seed):
+    generator = torch.Generator().manual_seed(seed)
+    query, key, value = [
+        torch.randn(2, 3, length, 8, generator=generator,
+                    dtype=torch.float64, requires_grad=True)
+        for length in (query_length, key_length, key_length)]
+    return query, key, value, generator
+
+
+def check_against_dense(query, key, value, attention_mask, causal,
+                        block_size, generator):
+    scale = 0.3
+    expected = dense_attention(query, key, value, attention_mask, causal,
+                               scale)
+    output = blocked_attention(query, key, value, attention_mask,
+                               causal=causal, scale=scale,
+                               block_size=block_size)
+    torch.testing.assert_close(output, expected, rtol=1e-10, atol=1e-10)
+
+    output_grad = torch.randn(expected.size(), generator=generator,
+                              dtype=expected.dtype)
+    expected_grads = torch.autograd.grad(expected, (query, key, value),
+                                         output_grad)
+    grads = torch.autograd.grad(output, (query, key, value), output_grad)
+    for grad, expected_grad in zip(grads, expected_grads):
+        torch.testing.assert_close(grad, expected_grad, rtol=1e-10,
+                                   atol=1e-10)
+
+
+@pytest.mark.parametrize('causal', [False, True])
+@pytest.mark.parametrize('query_length,key_length', [(13, 13), (4, 13)])
+@pytest.mark.parametrize('block_size', [4, 5, 16])
+def test_blocked_attention_matches_dense(causal, query_length, key_length,
+                                         block_size):
+    query, key, value, generator = make_inputs(query_length, key_length, 0)
+    check_against_dense(query, key, value, None, causal, block_size,
+                        generator)
+
+
+@pytest.mark.parametrize('causal', [False, True])
+@pytest.mark.parametrize('block_size', [4, 16])
+def test_blocked_attention_matches_dense_with_mask(causal, block_size):
+    query, key, value, generator = make_inputs(13, 13, 1)
+    mask = torch.rand(2, 1, 13, 13, generator=generator) < 0.3
+    # Fully masked rows, in the first and in a later query block.
+    mask[0, 0, 1] = True
+    mask[1, 0, 9] = True
+    check_against_dense(query, key, value, mask, causal, block_size,
+                        generator)
+
+
+@pytest.mark.parametrize('query_length', [13, 4])
+def test_blocked_attention_matches_dense_with_document_ids(query_length):
+    query, key, value, generator = make_inputs(query_length, 13, 2)
+    document_ids = torch.tensor([[0] * 5 + [1] * 6 + [2] * 2,
+                                 [0] * 13])
+    check_against_dense(query, key, value, document_ids, True, 4, generator)
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+import torch
+
+from megatron.data.data_samplers import FeistelPermutation
+from megatron.data.data_samplers import MegatronPretrainingRandomSampler
+from megatron.data.data_samplers import ReadaheadBatchSampler
+from megatron.data.data_samplers import collate_zero_copy_samples
+
+from test_gpt_dataset import make_gpt_dataset
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 4, 5, 16, 17, 1000, 4097])
+def test_feistel_permutation_is_bijective(size):
+    for seed in range(3):
+        permutation = FeistelPermutation(size, (seed, 0))
+        values = permutation(np.arange(size))
+        np.testing.assert_array_equal(np.sort(values), np.arange(size))
+        # Positions map independently of each other.
+        positions = np.random.RandomState(seed).randint(0, size, size=20)
+        np.testing.assert_array_equal(permutation(positions),
+                                      values[positions])
+
+
+def test_feistel_permutation_depends_on_seed():
+    values = [FeistelPermutation(1000, (epoch, 0))(np.arange(1000))
+              for epoch in range(2)]
+    assert not np.array_equal(values[0], values[1])
+
+
+def feistel_batches(total_samples, consumed_samples, data_parallel_rank):
+    return list(MegatronPretrainingRandomSampler(
+        total_samples, consumed_samples, micro_batch_size=3,
+        data_parallel_rank=data_parallel_rank, data_parallel_size=2,
+        permutation='feistel'))
+
+
+def test_feistel_sampler_covers_epoch_and_resumes():
+    total_samples = 100
+    epoch = [feistel_batches(total_samples, 0, rank) for rank in range(2)]
+    # The ranks' batches make up every sample of the epoch once, except
+    # for the dropped last partial batch.
+    samples = np.concatenate([np.ravel(batches) for batches in epoch])
+    assert len(samples) == len(np.unique(samples)) == 96
+    assert samples.max() < total_samples
+
+    # Resuming mid-epoch continues with the same batches.
+    for rank in range(2):
+        assert feistel_batches(total_samples, 5 * 6, rank) == epoch[rank][5:]
+
+
+@pytest.mark.parametrize('return_data_index', [False, True])
+def test_zero_copy_collate_matches_default(tmp_path, megatron_args,
+                                           return_data_index):
+    megatron_args.return_data_index = return_data_index
+    dataset = make_gpt_dataset(str(tmp_path / 'data'), seed=1)
+    indices = [3, 0, 17, 5]
+
+    megatron_args.zero_copy_samples = False
+    expected = torch.utils.data.dataloader.default_collate(
+        [dataset[i] for i in indices])
+    megatron_args.zero_copy_samples = True
+    # Separate samples in the storage dtype, and rows of one batch array.
+    for samples in ([dataset[i] for i in indices],
+                    dataset.get_batch(indices)):
+        assert samples[0]['text'].dtype == np.uint16
+        batch = collate_zero_copy_samples(samples)
+        assert sorted(batch) == sorted(expected)
+        for key in expected:
+            assert batch[key].dtype == expected[key].dtype
+            assert torch.equal(batch[key], expected[key])
+
+
+class ResidencyDataset:
+    """Samples of one page each; sample i is resident if `resident[i]`."""
+
+    def __init__(self, resident):
+        self.resident = resident
+        self.advised = []
+
+    def readahead(self, batch, advise=True):
+        if advise:
+            self.advised.append(batch)
+        return sum(self.resident[i] for i in batch), len(batch)
+
+
+def test_readahead_sampler_counts_resident_batches(capsys):
+    batches = [[0, 1], [2, 3], [4, 5], [6, 7], [8]]
+    dataset = ResidencyDataset([1, 1, 1, 0, 0, 0, 1, 1, 1])
+    sampler = ReadaheadBatchSampler(batches, dataset, depth=2,
+                                    report_interval=5)
+    assert list(sampler) == batches
+    sampler._executor.shutdown(wait=True)
+    assert sorted(dataset.advised) == batches
+    assert (sampler.hits, sampler.misses) == (3, 2)
+    assert (sampler.resident_pages, sampler.total_pages) == (6, 9)
+    assert '3 of 5 batches (66.7% of pages) resident' in \
+        capsys.readouterr().out
+
+    # Nothing is counted when residency is unknown.
+    dataset.readahead = lambda batch, advise=True: (None, len(batch))
+    sampler = ReadaheadBatchSampler(batches, dataset, depth=1)
+    assert list(sampler) == batches
+    assert sampler.hits == sampler.misses == sampler.total_pages == 0
@@ -0,0 +1,196 @@
+import functools
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from megatron.data import gpt_dataset
+from megatron.data import indexed_dataset
+from megatron.data.blendable_dataset import BlendableDataset
+from megatron.data.data_samplers import BatchedFetchDataset
+
+from distributed_utils import run_distributed
+from test_indexed_dataset import build_dataset, random_documents
+
+
+SEQ_LENGTH = 16
+
+
+def make_gpt_dataset(prefix, seed):
+    """GPTDataset over `prefix` with index mappings built in memory."""
+    rng = np.random.RandomState(seed)
+    build_dataset(prefix, random_documents(rng, 30))
+    indexed = indexed_dataset.MMapIndexedDataset(prefix, skip_warmup=True)
+    documents = np.arange(len(indexed.doc_idx) - 1, dtype=np.int32)
+    sizes = indexed.sizes
+    tokens_per_epoch = int(sizes[documents].sum())
+    num_epochs = 2
+    doc_idx = gpt_dataset._build_doc_idx(documents, num_epochs, rng, False)
+    sample_idx = gpt_dataset._build_sample_idx(
+        sizes, doc_idx, SEQ_LENGTH, num_epochs, tokens_per_epoch)
+    shuffle_idx = gpt_dataset._build_shuffle_idx(
+        sample_idx.shape[0] - 1, sample_idx.shape[0] - 1, rng)
+
+    dataset = gpt_dataset.GPTDataset.__new__(gpt_dataset.GPTDataset)
+    dataset.name = 'train'
+    dataset.indexed_dataset = indexed
+    dataset.seq_length = SEQ_LENGTH
+    dataset.doc_idx = doc_idx
+    dataset.sample_idx = sample_idx
+    dataset.shuffle_idx = shuffle_idx
+    return dataset
+
+
+@pytest.fixture
+def data_args(megatron_args):
+    megatron_args.zero_copy_samples = False
+    megatron_args.return_data_index = False
+    return megatron_args
+
+
+def assert_same_samples(batch, samples):
+    assert len(batch) == len(samples)
+    for fetched, sample in zip(batch, samples):
+        np.testing.assert_array_equal(fetched['text'], sample['text'])
+        assert fetched['text'].dtype == sample['text'].dtype
+
+
+def test_gpt_get_batch_matches_getitem(tmp_path, data_args):
+    dataset = make_gpt_dataset(str(tmp_path / 'data'), seed=1)
+    indices = np.random.RandomState(2).randint(0, len(dataset), size=40)
+    assert_same_samples(dataset.get_batch(indices.tolist()),
+                        [dataset[i] for i in indices.tolist()])
+
+
+def test_blendable_get_batch_matches_getitem(tmp_path, data_args,
+                                             monkeypatch):
+    monkeypatch.setattr(torch.distributed, 'get_rank', lambda: 0)
+    datasets = [make_gpt_dataset(str(tmp_path / 'data{}'.format(i)), seed=i)
+                for i in range(3)]
+    blended = BlendableDataset(datasets, [0.5, 0.3, 0.2])
+    # Training sizes the datasets by their weights; keep the samples that
+    # exist in these small ones.
+    valid = np.nonzero(blended.dataset_sample_index < np.array(
+        [len(dataset) for dataset in datasets])[blended.dataset_index])[0]
+    indices = np.random.RandomState(3).choice(valid, size=40)
+    assert_same_samples(blended.get_batch(indices.tolist()),
+                        [blended[i] for i in indices.tolist()])
+
+
+def test_default_data_loader_fetches_per_sample(tmp_path, data_args):
+    dataset = make_gpt_dataset(str(tmp_path / 'data'), seed=1)
+    batch_sampler = [[0, 5, 7], [1, 2, 3]]
+    default = torch.utils.data.DataLoader(dataset,
+                                          batch_sampler=batch_sampler)
+    batched = torch.utils.data.DataLoader(BatchedFetchDataset(dataset),
+                                          sampler=batch_sampler,
+                                          batch_size=None)
+    for indices, default_batch, batched_batch in zip(batch_sampler, default,
+                                                     batched):
+        expected = np.stack([dataset[i]['text'] for i in indices])
+        np.testing.assert_array_equal(default_batch['text'].numpy(),
+                                      expected)
+        np.testing.assert_array_equal(
+            np.stack([sample['text'] for sample in batched_batch]), expected)
+    # The DataLoader must not pick up a batched method by itself.
+    assert not hasattr(dataset, '__getitems__')
+
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.parametrize('seq_length', [2, 3, 7, 64])
+def test_parallel_sample_idx_matches_helpers(compact, seq_length):
+    from concurrent.futures import ThreadPoolExecutor
+    from megatron.data import helpers
+
+    rng = np.random.RandomState(seq_length)
+    # Include empty documents and documents longer than a sample.
+    sizes = rng.randint(0, 3 * seq_length + 2, size=200).astype(np.int32)
+    documents = np.arange(len(sizes), dtype=np.int32)
+    num_epochs = 3
+    tokens_per_epoch = int(sizes.sum())
+    doc_idx = gpt_dataset._build_doc_idx(documents, num_epochs, rng, False)
+    expected = helpers.build_sample_idx(sizes, doc_idx, seq_length,
+                                        num_epochs, tokens_per_epoch)
+
+    num_samples = (num_epochs * tokens_per_epoch - 1) // seq_length
+    if compact:
+        sample_idx = np.empty(num_samples + 1,
+                              dtype=gpt_dataset._sample_idx_dtype(
+                                  len(doc_idx), sizes.max()))
+    else:
+        sample_idx = np.empty((num_samples + 1, 2), dtype=np.int32)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        gpt_dataset._parallel_build_sample_idx(sample_idx, sizes, doc_idx,
+                                               seq_length, executor)
+    for column, expected_column in zip(
+            gpt_dataset._sample_idx_columns(sample_idx), expected.T):
+        np.testing.assert_array_equal(column, expected_column)
+
+
+def _check_broadcast_index_mapping(directory, rank):
+    from megatron import get_args
+    mappings = {
+        'doc_idx': np.arange(1000, dtype=np.int32)[::-1].copy(),
+        'sample_idx': np.arange(40, dtype=np.int64).reshape(20, 2),
+        'compact_sample_idx': gpt_dataset._compact_sample_idx(
+            np.arange(40, dtype=np.int64).reshape(20, 2) * 3000, 60000,
+            120000),
+        'shuffle_idx': np.arange(70000, dtype=np.uint32)}
+    for name, expected in mappings.items():
+        filename = os.path.join(directory, name + '.npy')
+        if rank == 0:
+            np.save(filename, expected, allow_pickle=True)
+        # Only rank 0 reads the shared file.
+        get_args().index_mapping_shm_dir = os.path.join(
+            directory, 'node{}'.format(rank // 2))
+        os.makedirs(get_args().index_mapping_shm_dir, exist_ok=True)
+        torch.distributed.barrier()
+        mapping = gpt_dataset._broadcast_index_mapping(filename)
+        assert isinstance(mapping, np.memmap)
+        assert mapping.dtype == expected.dtype
+        np.testing.assert_array_equal(mapping, expected)
+
+
+def test_broadcast_index_mapping(tmp_path):
+    run_distributed(functools.partial(_check_broadcast_index_mapping,
+                                      str(tmp_path)),
+                    world_size=4, args={'tp_local_data': False},
+                    pipeline_model_parallel_size=2)
+    # One copy per "node" (two ranks each).
+    for node in range(2):
+        assert len([name for name in os.listdir(
+            str(tmp_path / 'node{}'.format(node)))
+            if name.endswith('.npy')]) == 4
+
+
+def test_blending_index_cache_is_keyed_by_datasets(tmp_path, megatron_args,
+                                                    monkeypatch):
+    from megatron.data import blendable_dataset
+    megatron_args.use_cached_dataset = True
+    monkeypatch.setattr(torch.distributed, 'get_rank', lambda: 0)
+    builds = []
+    build = blendable_dataset._build_blending_indices
+    monkeypatch.setattr(blendable_dataset, '_build_blending_indices',
+                        lambda *args: builds.append(args) or build(*args))
+    datasets = [list(range(30)), list(range(50))]
+    prefix = str(tmp_path / 'data_train')
+
+    def blend(datasets_key):
+        return BlendableDataset(datasets, [0.4, 0.6],
+                                index_cache_prefix=prefix,
+                                index_cache_key=datasets_key)
+
+    expected = blend('a\nb')
+    assert len(builds) == 1
+    # Same blend: loaded from the cache.
+    cached = blend('a\nb')
+    assert len(builds) == 1
+    np.testing.assert_array_equal(cached.dataset_index,
+                                  expected.dataset_index)
+    np.testing.assert_array_equal(cached.dataset_sample_index,
+                                  expected.dataset_sample_index)
+    # Other datasets with the same first prefix and sizes miss the cache.
+    blend('a\nc')
+    assert len(builds) == 2
+    assert len(os.listdir(str(tmp_path))) == 4
@@ -0,0 +1,141 @@
+import mmap
+import os
+import time
+
+import numpy as np
+import pytest
+import torch
+
+from megatron.data import indexed_dataset
+
+
+def build_dataset(prefix, documents, dtype=np.uint16):
+    builder = indexed_dataset.MMapIndexedDatasetBuilder(
+        indexed_dataset.data_file_path(prefix), dtype=dtype)
+    for document in documents:
+        for sentence in document:
+            builder.add_item(torch.tensor(sentence, dtype=torch.int64))
+        builder.end_document()
+    builder.finalize(indexed_dataset.index_file_path(prefix))
+
+
+def random_documents(rng, num_documents, vocab_size=60000):
+    return [[rng.randint(0, vocab_size, size=rng.randint(0, 20)).tolist()
+             for _ in range(rng.randint(1, 4))]
+            for _ in range(num_documents)]
+
+
+def test_sharded_dataset_matches_merged(tmp_path, megatron_args):
+    rng = np.random.RandomState(0)
+    shards = [str(tmp_path / 'shard{}'.format(i)) for i in range(3)]
+    for shard in shards:
+        build_dataset(shard, random_documents(rng, 20))
+
+    merged = str(tmp_path / 'merged')
+    builder = indexed_dataset.MMapIndexedDatasetBuilder(
+        indexed_dataset.data_file_path(merged), dtype=np.uint16)
+    for shard in shards:
+        builder.merge_file_(shard)
+    builder.finalize(indexed_dataset.index_file_path(merged))
+
+    manifest = str(tmp_path / 'sharded')
+    indexed_dataset.write_manifest(
+        indexed_dataset.manifest_file_path(manifest), shards)
+
+    expected = indexed_dataset.MMapIndexedDataset(merged, skip_warmup=True)
+    sharded = indexed_dataset.ShardedMMapIndexedDataset(manifest,
+                                                        skip_warmup=True)
+    assert len(sharded) == len(expected)
+    np.testing.assert_array_equal(sharded.sizes, expected.sizes)
+    np.testing.assert_array_equal(sharded.doc_idx, expected.doc_idx)
+    for i in range(len(expected)):
+        np.testing.assert_array_equal(sharded[i], expected[i])
+
+    # Spans crossing shard boundaries, in arbitrary order.
+    idxs = rng.randint(0, len(expected), size=50)
+    offsets = np.array([rng.randint(0, size + 1)
+                        for size in expected.sizes[idxs]])
+    lengths = np.array([rng.randint(0, size - offset + 1) for size, offset
+                        in zip(expected.sizes[idxs], offsets)])
+    np.testing.assert_array_equal(
+        sharded.gather(idxs, offsets, lengths),
+        expected.gather(idxs, offsets, lengths))
+
+
+@pytest.mark.parametrize('codec', ['bitpack', 'zstd'])
+@pytest.mark.parametrize('dtype,low,high', [(np.uint16, 0, 65536),
+                                            (np.int32, -2 ** 31, 2 ** 31)])
+def test_compressed_dataset_round_trip(tmp_path, codec, dtype, low, high):
+    if codec == 'zstd' and indexed_dataset.zstandard is None:
+        pytest.skip('zstandard is not installed')
+    rng = np.random.RandomState(0)
+    items = [rng.randint(low, high, size=rng.randint(0, 50), dtype=np.int64)
+             for _ in range(40)]
+    # A constant block and the extremes of the dtype.
+    items[3] = np.full(30, 7)
+    items[4] = np.array([low, high - 1, low, high - 1])
+    prefix = str(tmp_path / 'compressed')
+    builder = indexed_dataset.CompressedIndexedDatasetBuilder(
+        indexed_dataset.data_file_path(prefix), dtype=dtype, codec=codec,
+        block_tokens=16)
+    for i, item in enumerate(items):
+        builder.add_item(torch.tensor(item))
+        if i % 3 == 2:
+            builder.end_document()
+    builder.finalize(indexed_dataset.index_file_path(prefix))
+
+    assert indexed_dataset.CompressedIndexedDataset.exists(prefix)
+    dataset = indexed_dataset.CompressedIndexedDataset(prefix,
+                                                       skip_warmup=True)
+    assert dataset.dtype == dtype
+    assert len(dataset) == len(items)
+    np.testing.assert_array_equal(dataset.sizes, [len(i) for i in items])
+    np.testing.assert_array_equal(dataset.doc_idx, np.arange(0, 40, 3))
+    for i, item in enumerate(items):
+        assert dataset[i].dtype == dtype
+        np.testing.assert_array_equal(dataset[i], item.astype(dtype))
+        offset = rng.randint(0, len(item) + 1)
+        np.testing.assert_array_equal(dataset.get(i, offset),
+                                      item[offset:].astype(dtype))
+
+    idxs = rng.randint(0, len(items), size=30)
+    offsets = np.array([rng.randint(0, len(items[i]) + 1) for i in idxs])
+    lengths = np.array([rng.randint(0, len(items[i]) - offset + 1)
+                        for i, offset in zip(idxs, offsets)])
+    np.testing.assert_array_equal(
+        dataset.gather(idxs, offsets, lengths),
+        np.concatenate([items[i][offset:offset + length] for i, offset, length
+                        in zip(idxs, offsets, lengths)]).astype(dtype))
+
+
+def test_readahead_counts_resident_pages(tmp_path):
+    if indexed_dataset._mincore is None:
+        pytest.skip('mincore is not available')
+    rng = np.random.RandomState(0)
+    prefix = str(tmp_path / 'data')
+    # Items of several pages, so that the spans cover separate page runs.
+    build_dataset(prefix, [[rng.randint(0, 60000, size=20000).tolist()]
+                           for _ in range(6)])
+    with open(indexed_dataset.data_file_path(prefix), 'rb') as f:
+        os.fsync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    dataset = indexed_dataset.MMapIndexedDataset(prefix, skip_warmup=True)
+    idxs, offsets, lengths = [1, 4], [100, 0], [15000, 3000]
+
+    resident, total = dataset.readahead(idxs, offsets, lengths, advise=False)
+    starts = dataset._index._pointers[idxs] + 2 * np.array(offsets)
+    ends = starts + 2 * np.array(lengths)
+    assert total == sum(-(-end // mmap.PAGESIZE) - start // mmap.PAGESIZE
+                        for start, end in zip(starts, ends))
+    if resident == total:
+        pytest.skip('the page cache could not be dropped')
+    assert resident == 0
+    # Counting alone does not page anything in.
+    assert dataset.readahead(idxs, offsets, lengths, advise=False) == \
+        (0, total)
+
+    assert dataset.readahead(idxs, offsets, lengths) == (0, total)
+    deadline = time.time() + 10
+    while dataset.readahead(idxs, offsets, lengths, advise=False)[0] < total:
+        assert time.time() < deadline, 'readahead did not page in the spans'
+        time.sleep(0.01)
@@ -0,0 +1,83 @@
+import itertools
+import json
+
+import numpy as np
+import pytest
+
+from megatron.data import jsonl_dataset
+
+
+class CharTokenizer:
+    eod = 0
+
+    def tokenize(self, text):
+        return [ord(c) for c in text]
+
+
+def write_jsonl(path, texts):
+    with open(path, 'w') as f:
+        for text in texts:
+            f.write(json.dumps({'text': text}) + '\n')
+
+
+def shard_documents(dataset, shard, num_shards, position=(0, 0, 0, 0, 0)):
+    """Documents of one epoch of a shard as `(position, text)`."""
+    documents = []
+    for position, tokens in dataset._documents(shard, num_shards, position):
+        if position[0] > 0:
+            break
+        documents.append((position, ''.join(chr(t) for t in tokens[:-1])))
+    return documents
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    monkeypatch.setattr(jsonl_dataset, 'get_tokenizer', CharTokenizer)
+    rng = np.random.RandomState(0)
+    texts = [''.join(rng.choice(list('abcdefgh'), size=rng.randint(0, 30)))
+             for _ in range(100)]
+    files = [str(tmp_path / 'f{}.jsonl'.format(i)) for i in range(2)]
+    write_jsonl(files[0], texts[:60])
+    write_jsonl(files[1], texts[60:])
+    dataset = jsonl_dataset.StreamingJSONLDataset.__new__(
+        jsonl_dataset.StreamingJSONLDataset)
+    dataset.files = files
+    dataset.json_key = 'text'
+    dataset.texts = texts
+    return dataset
+
+
+@pytest.mark.parametrize('num_shards', [1, 2, 3, 7])
+def test_byte_range_shards_partition_lines(dataset, num_shards):
+    shards = [shard_documents(dataset, shard, num_shards)
+              for shard in range(num_shards)]
+    # Every shard reads a contiguous part of each file, in file order.
+    by_file = [[text for shard in shards for position, text in shard
+                if position[1] == file_index]
+               for file_index in range(len(dataset.files))]
+    assert list(itertools.chain(*by_file)) == dataset.texts
+    for documents in shards:
+        assert [position[3] for position, _ in documents] == \
+            list(range(len(documents)))
+
+
+def test_byte_range_shard_resumes_at_position(dataset):
+    documents = shard_documents(dataset, 1, 3)
+    for i in (1, len(documents) // 2, len(documents) - 1):
+        position = documents[i][0] + (0,)
+        assert shard_documents(dataset, 1, 3, position) == documents[i:]
+
+
+@pytest.mark.parametrize('num_shards', [1, 2, 3])
+def test_blank_lines_are_skipped(dataset, num_shards):
+    with open(dataset.files[0], 'w') as f:
+        f.write('\n' + json.dumps({'text': 'ab'}) + '\n  \n\r\n' +
+                json.dumps({'text': 'cd'}) + '\n\n')
+    dataset.texts = ['ab', 'cd'] + dataset.texts[60:]
+    shards = [shard_documents(dataset, shard, num_shards)
+              for shard in range(num_shards)]
+    documents = sorted(itertools.chain(*shards))
+    assert [text for _, text in documents] == dataset.texts
+    if num_shards == 1:
+        # Line numbers still count the blank lines.
+        assert [position[3] for position, _ in documents[:2]] == [1, 4]
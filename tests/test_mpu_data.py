@@ -0,0 +1,47 @@
+import torch
+
+from megatron import mpu
+
+from distributed_utils import run_distributed
+
+
+def batch(size, high, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return {'text': torch.randint(0, high, size, generator=generator),
+            'index': torch.arange(size[0])}
+
+
+def _check_broadcast_data(rank):
+    # Batches of changing shapes, as of a train and a valid loader, and
+    # values that need every bit of the transfer dtype.
+    sizes = [(2, 5), (2, 5), (3, 4), (3, 4), (2, 5)]
+    options = [({}, 2 ** 40), ({'transfer_dtype': torch.int16}, 2 ** 16),
+               ({'transfer_dtype': torch.int32}, 2 ** 31)]
+    for cache_sizes in (False, True):
+        for transfer_options, high in options:
+            mpu.data._KEY_SIZE_NUMEL_CACHE.clear()
+            for seed, size in enumerate(sizes):
+                expected = batch(size, high, seed)
+                # Only tensor parallel rank 0 reads the data.
+                data = expected if rank == 0 else None
+                output = mpu.broadcast_data(
+                    ['text', 'index'], data, torch.int64,
+                    cache_sizes=cache_sizes, **transfer_options)
+                for key in expected:
+                    assert output[key].dtype == torch.int64
+                    assert torch.equal(output[key], expected[key]), \
+                        (rank, cache_sizes, transfer_options, size, key)
+            assert len(mpu.data._KEY_SIZE_NUMEL_CACHE) == int(cache_sizes)
+    # The extremes of the narrow dtypes.
+    for transfer_dtype, high in ((torch.int16, 2 ** 16),
+                                 (torch.int32, 2 ** 31)):
+        expected = {'text': torch.tensor([[0, 1, high // 2 - 1, high // 2,
+                                           high - 1]])}
+        output = mpu.broadcast_data(['text'], expected if rank == 0 else None,
+                                    torch.int64,
+                                    transfer_dtype=transfer_dtype)
+        assert torch.equal(output['text'], expected['text'])
+
+
+def test_broadcast_data():
+    run_distributed(_check_broadcast_data, 2, tensor_model_parallel_size=2)
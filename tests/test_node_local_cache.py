@@ -0,0 +1,111 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from megatron.data import node_local_cache
+
+
+@pytest.fixture(autouse=True)
+def held(monkeypatch):
+    """Release the copies held by a test."""
+    held = {}
+    monkeypatch.setattr(node_local_cache, '_held', held)
+    yield held
+    for fd in held.values():
+        os.close(fd)
+
+
+def write_files(directory, names, size=100):
+    paths = []
+    for name in names:
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        paths.append(path)
+    return paths
+
+
+def lock_and_exit(lock_path):
+    node_local_cache._lock(lock_path, 0)
+    os._exit(0)
+
+
+def stage_and_wait(paths, local_dir, staged, done):
+    for path in paths:
+        node_local_cache.stage_file(path, local_dir)
+    staged.set()
+    done.wait()
+
+
+def test_build_file_reclaims_lock_of_dead_process(tmp_path):
+    local_path = str(tmp_path / 'megatron_file')
+    context = multiprocessing.get_context('fork')
+    process = context.Process(target=lock_and_exit,
+                              args=(local_path + '.lock',))
+    process.start()
+    process.join()
+    assert node_local_cache._lock_holder(local_path + '.lock') == process.pid
+
+    def build(tmp_path):
+        with open(tmp_path, 'w') as f:
+            f.write('built')
+
+    start_time = time.time()
+    node_local_cache.build_file(local_path, build)
+    assert time.time() - start_time < node_local_cache.STAGING_TIMEOUT / 100
+    with open(local_path) as f:
+        assert f.read() == 'built'
+
+
+def test_build_file_times_out_on_live_holder(tmp_path, monkeypatch):
+    local_path = str(tmp_path / 'megatron_file')
+    lock = node_local_cache._lock(local_path + '.lock', 0)
+    try:
+        # flock() locks are per open file, so build_file waits on this
+        # lock like on one of another process.
+        monkeypatch.setattr(node_local_cache, 'STAGING_TIMEOUT', 0.3)
+        with pytest.raises(RuntimeError, match=str(os.getpid())):
+            node_local_cache.build_file(local_path, None)
+    finally:
+        os.close(lock)
+
+
+def test_evict_keeps_copies_held_by_other_processes(tmp_path, held):
+    source_dir = tmp_path / 'source'
+    local_dir = tmp_path / 'local'
+    source_dir.mkdir()
+    local_dir.mkdir()
+    a, b, c, d = write_files(str(source_dir), 'abcd')
+
+    # Another process stages and holds a and b.
+    context = multiprocessing.get_context('fork')
+    staged, done = context.Event(), context.Event()
+    process = context.Process(target=stage_and_wait,
+                              args=([a, b], str(local_dir), staged, done))
+    process.start()
+    try:
+        assert staged.wait(60)
+        local_a, local_b = [
+            os.path.join(str(local_dir), name)
+            for name in sorted(os.listdir(str(local_dir)), key=lambda name:
+                               name.endswith('_b'))
+            if not name.endswith('.lock')]
+        os.utime(local_a, (1, 1))
+        os.utime(local_b, (2, 2))
+        # Staging c needs to evict, but every other copy is held.
+        local_c = node_local_cache.stage_file(c, str(local_dir),
+                                              max_bytes=250)
+        assert all(os.path.exists(path)
+                   for path in (local_a, local_b, local_c))
+    finally:
+        done.set()
+        process.join()
+
+    # Once the process exited, the least recently used copy is evicted.
+    local_d = node_local_cache.stage_file(d, str(local_dir), max_bytes=350)
+    assert not os.path.exists(local_a)
+    assert not os.path.exists(local_a + '.lock')
+    assert all(os.path.exists(path) for path in (local_b, local_c, local_d))
+    assert sorted(held) == sorted([local_c, local_d])
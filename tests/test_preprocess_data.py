@@ -0,0 +1,154 @@
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from megatron.data import indexed_dataset
+
+from test_tokenizer import write_gpt2_files
+
+pytest.importorskip('nltk')
+
+PREPROCESS_DATA = os.path.join(os.path.dirname(__file__), os.path.pardir,
+                               'tools', 'preprocess_data.py')
+
+
+def write_input(path, num_docs, seed=0):
+    rng = np.random.RandomState(seed)
+    words = ['the', 'theme', 'thesis', 'café', 'über', '東京', 'a\nb', '']
+    with open(path, 'w') as f:
+        for _ in range(num_docs):
+            text = ' '.join(rng.choice(words, size=rng.randint(0, 20)))
+            f.write(json.dumps({'text': text}) + '\n')
+
+
+def preprocess(directory, inputs, output_prefix, *options):
+    vocab_file, merge_file = write_gpt2_files(directory)
+    subprocess.run(
+        [sys.executable, PREPROCESS_DATA, '--input', *inputs,
+         '--output-prefix', output_prefix, '--tokenizer-type',
+         'GPT2BPETokenizer', '--vocab-file', vocab_file, '--merge-file',
+         merge_file, '--append-eod', '--tokenize-batch-size', '4',
+         *options],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return output_prefix + '_text_document'
+
+
+def read_bytes(prefix):
+    return [open(path, 'rb').read()
+            for path in (indexed_dataset.data_file_path(prefix),
+                         indexed_dataset.index_file_path(prefix))]
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    inputs = [str(tmp_path / 'a.jsonl'), str(tmp_path / 'b.jsonl')]
+    write_input(inputs[0], 50, seed=0)
+    write_input(inputs[1], 7, seed=1)
+    return inputs
+
+
+def test_sharded_output_matches_serial(tmp_path, inputs):
+    serial = preprocess(str(tmp_path), inputs, str(tmp_path / 'serial'))
+    merged = preprocess(str(tmp_path), inputs, str(tmp_path / 'merged'),
+                        '--workers', '3', '--shard-writers', '--merge-shards')
+    assert read_bytes(merged) == read_bytes(serial)
+    assert os.path.exists(str(tmp_path / 'merged.shards.json'))
+
+    sharded = preprocess(str(tmp_path), inputs, str(tmp_path / 'sharded'),
+                         '--workers', '3', '--shard-writers')
+    expected = indexed_dataset.MMapIndexedDataset(serial, skip_warmup=True)
+    dataset = indexed_dataset.ShardedMMapIndexedDataset(sharded,
+                                                        skip_warmup=True)
+    assert len(dataset) == len(expected)
+    np.testing.assert_array_equal(dataset.doc_idx, expected.doc_idx)
+    for i in range(len(expected)):
+        np.testing.assert_array_equal(dataset[i], expected[i])
+
+
+def load_preprocess_data():
+    spec = importlib.util.spec_from_file_location('preprocess_data',
+                                                  PREPROCESS_DATA)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_interrupted_shard_resumes(tmp_path, inputs, monkeypatch):
+    preprocess_data = load_preprocess_data()
+    vocab_file, merge_file = write_gpt2_files(str(tmp_path))
+
+    def encode_shard(output_prefix, *options):
+        monkeypatch.setattr(sys, 'argv', [
+            PREPROCESS_DATA, '--input', inputs[0], '--output-prefix',
+            output_prefix, '--tokenizer-type', 'GPT2BPETokenizer',
+            '--vocab-file', vocab_file, '--merge-file', merge_file,
+            '--append-eod', '--tokenize-batch-size', '2', '--shard-writers',
+            *options])
+        args = preprocess_data.get_args()
+        encoder = preprocess_data.Encoder(args)
+        encoder.initializer()
+        shard = (0, inputs[0], 0, os.path.getsize(inputs[0]))
+        return encoder.encode_shard(shard), args
+
+    (num_docs, _), args = encode_shard(str(tmp_path / 'expected'))
+    assert num_docs == 50
+    expected = read_bytes(preprocess_data.shard_prefix(args, 'text', 0))
+
+    output_prefix = str(tmp_path / 'resumed')
+    add_document = preprocess_data.add_document
+    added = []
+
+    def add_document_and_fail(builders, doc):
+        if len(added) == 13:
+            raise Interrupted()
+        added.append(doc)
+        add_document(builders, doc)
+
+    monkeypatch.setattr(preprocess_data, 'add_document',
+                        add_document_and_fail)
+    with pytest.raises(Interrupted):
+        encode_shard(output_prefix, '--checkpoint-interval', '4')
+    monkeypatch.setattr(preprocess_data, 'add_document', add_document)
+    done_file = preprocess_data.shard_done_file(args, 0).replace(
+        args.output_prefix, output_prefix)
+    state_file = preprocess_data.shard_state_file(args, 0).replace(
+        args.output_prefix, output_prefix)
+    assert os.path.exists(state_file) and not os.path.exists(done_file)
+
+    # Interrupted again after the .idx is written, before the marker.
+    write_json_atomic = preprocess_data.write_json_atomic
+
+    def write_json_atomic_and_fail(path, obj):
+        if path == done_file:
+            raise Interrupted()
+        write_json_atomic(path, obj)
+
+    monkeypatch.setattr(preprocess_data, 'write_json_atomic',
+                        write_json_atomic_and_fail)
+    with pytest.raises(Interrupted):
+        encode_shard(output_prefix, '--checkpoint-interval', '4',
+                     '--resume')
+    monkeypatch.setattr(preprocess_data, 'write_json_atomic',
+                        write_json_atomic)
+    (num_docs, num_bytes), args = encode_shard(
+        output_prefix, '--checkpoint-interval', '4', '--resume')
+    # Continued from the last checkpoint of the run interrupted after its
+    # .idx was written, which itself continued after 12 documents.
+    assert 0 < num_docs < 50 - 12
+    assert read_bytes(preprocess_data.shard_prefix(args, 'text', 0)) == \
+        expected
+    assert os.path.exists(done_file) and not os.path.exists(state_file)
+
+    # A finished shard is skipped.
+    (num_docs, num_bytes), _ = encode_shard(
+        output_prefix, '--checkpoint-interval', '4', '--resume')
+    assert (num_docs, num_bytes) == (0, 0)
@@ -0,0 +1,55 @@
+import functools
+import os
+import tempfile
+
+import torch
+
+from megatron import get_args
+from megatron import mpu
+from megatron.data.data_samplers import build_pretraining_batch_sampler
+from megatron.data.shm_data_loader import SharedMemoryDataLoader
+
+from distributed_utils import run_distributed
+from test_gpt_dataset import SEQ_LENGTH
+from test_gpt_dataset import make_gpt_dataset
+
+
+def _check_shm_data_loader(directory, rank):
+    args = get_args()
+    # Every rank reads its own copy of the same data.
+    dataset = make_gpt_dataset(
+        os.path.join(directory, 'data{}'.format(rank)), seed=1)
+    for dataloader_type in ('single', 'cyclic'):
+        args.dataloader_type = dataloader_type
+        for consumed_samples in (0, 12):
+            loader = SharedMemoryDataLoader(dataset, consumed_samples)
+            expected = torch.utils.data.DataLoader(
+                dataset, batch_sampler=build_pretraining_batch_sampler(
+                    len(dataset), consumed_samples,
+                    mpu.get_data_parallel_rank(),
+                    mpu.get_data_parallel_world_size()))
+            expected_batches = list(expected)
+            if dataloader_type == 'cyclic':
+                # The first epoch; the loader cycles on.
+                assert len(loader) == len(expected_batches)
+            batches = 0
+            for batch, expected_batch in zip(loader, expected_batches):
+                assert sorted(batch) == sorted(expected_batch)
+                for key in batch:
+                    assert batch[key].dtype == expected_batch[key].dtype
+                    assert torch.equal(batch[key], expected_batch[key])
+                batches += 1
+            assert batches == len(expected_batches)
+
+
+def test_shm_data_loader_matches_dataloader(tmp_path):
+    # Unix socket paths are short.
+    with tempfile.TemporaryDirectory() as shm_loader_dir:
+        run_distributed(
+            functools.partial(_check_shm_data_loader, str(tmp_path)), 2,
+            args=dict(micro_batch_size=3, seq_length=SEQ_LENGTH,
+                      log_interval=1000, return_data_index=True,
+                      zero_copy_samples=False,
+                      random_sampler_permutation='randperm',
+                      shm_loader_dir=shm_loader_dir, shm_loader_depth=2,
+                      shm_loader_core=None))
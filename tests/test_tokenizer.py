@@ -0,0 +1,233 @@
+import argparse
+import io
+import json
+import os
+
+import numpy as np
+import pytest
+import sentencepiece as spm
+
+from megatron.tokenizer import build_tokenizer
+from megatron.tokenizer.bert_tokenization import TrieWordpieceTokenizer
+from megatron.tokenizer.bert_tokenization import WordpieceTokenizer
+from megatron.tokenizer.gpt2_tokenization import GPT2Tokenizer
+from megatron.tokenizer.gpt2_tokenization import bytes_to_unicode
+
+
+WORDPIECE_VOCAB = [
+    '[UNK]', 'a', 'b', 'ab', 'abc', 'abcd', 'bc', 'c', 'é', 'ü',
+    '##a', '##b', '##c', '##d', '##bc', '##bcd', '##cd', '##é', '##ü',
+    # Literal "##" entries may start a word as well.
+    '##', '###', '##x',
+]
+
+
+def test_trie_wordpiece_matches_greedy():
+    vocab = {piece: i for i, piece in enumerate(WORDPIECE_VOCAB)}
+    greedy = WordpieceTokenizer(vocab, max_input_chars_per_word=12)
+    trie = TrieWordpieceTokenizer(vocab, max_input_chars_per_word=12)
+    rng = np.random.RandomState(0)
+    alphabet = list('abcdéü#x')
+    words = ['', 'abcd', 'abcdabcd', '##', '###', '##x', '##xa', 'x', 'ad',
+             'a' * 12, 'a' * 13]
+    words += [''.join(rng.choice(alphabet, size=rng.randint(1, 15)))
+              for _ in range(5000)]
+    for word in words:
+        assert trie.tokenize(word) == greedy.tokenize(word), word
+    text = ' '.join(words[:200])
+    assert trie.tokenize(text) == greedy.tokenize(text)
+
+
+TEXTS = ['Hello world, the theme is the thesis.', 'café über naïve',
+         '今日は良い天気です。東京と京都', 'a\nb  c', '']
+
+
+def write_gpt2_files(directory):
+    """A byte-level BPE vocabulary with a few merges, some of them inside
+    multi-byte characters."""
+    byte_encoder = bytes_to_unicode()
+    pieces = [byte_encoder[b] for b in range(256)]
+    merges = [('Ġ', 't'), ('h', 'e'), ('Ġt', 'he'), ('Ã', '©'), ('Ã', '¼'),
+              ('æ', 'Ŀ'), ('æĿ', '±')]
+    pieces += [a + b for a, b in merges] + ['<|endoftext|>']
+    vocab_file = os.path.join(directory, 'gpt2-vocab.json')
+    merge_file = os.path.join(directory, 'gpt2-merges.txt')
+    with open(vocab_file, 'w') as f:
+        json.dump({piece: i for i, piece in enumerate(pieces)}, f)
+    with open(merge_file, 'w', encoding='utf-8') as f:
+        f.write('#version: 0.2\n')
+        for merge in merges:
+            f.write(' '.join(merge) + '\n')
+    return vocab_file, merge_file
+
+
+def write_bert_vocab(directory):
+    vocab_file = os.path.join(directory, 'bert-vocab.txt')
+    with open(vocab_file, 'w') as f:
+        f.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]',
+                           'hello', 'world', ',', '.', 'the', '##me', '##sis',
+                           'is', 'ca', '##fe', 'uber', 'na', '##ive']) + '\n')
+    return vocab_file
+
+
+def write_sentencepiece_model(directory):
+    model = io.BytesIO()
+    spm.SentencePieceTrainer.train(
+        sentence_iterator=iter(TEXTS * 20), model_writer=model,
+        vocab_size=60, hard_vocab_limit=False, character_coverage=1.0,
+        minloglevel=2)
+    model_file = os.path.join(directory, 'sp.model')
+    with open(model_file, 'wb') as f:
+        f.write(model.getvalue())
+    return model_file
+
+
+def tokenizer_args(directory, tokenizer_type, cache_dir=None):
+    merge_file = None
+    if tokenizer_type == 'GPT2BPETokenizer':
+        vocab_file, merge_file = write_gpt2_files(directory)
+    elif tokenizer_type == 'JapaneseSentencePiece':
+        vocab_file = write_sentencepiece_model(directory)
+    else:
+        vocab_file = write_bert_vocab(directory)
+    return argparse.Namespace(
+        rank=1, tokenizer_type=tokenizer_type, vocab_file=vocab_file,
+        merge_file=merge_file, vocab_extra_ids=2,
+        tokenizer_cache_dir=cache_dir, make_vocab_size_divisible_by=8,
+        tensor_model_parallel_size=1)
+
+
+@pytest.mark.parametrize('tokenizer_type', [
+    'BertWordPieceLowerCase', 'BertWordPieceCase', 'GPT2BPETokenizer',
+    'JapaneseSentencePiece'])
+def test_tokenizer_artifact_round_trip(tmp_path, tokenizer_type):
+    # The cache directory is created on first use.
+    cache_dir = tmp_path / 'cache'
+    args = tokenizer_args(str(tmp_path), tokenizer_type, str(cache_dir))
+    expected = build_tokenizer(tokenizer_args(str(tmp_path), tokenizer_type))
+    # The first build writes the artifact, the second loads it.
+    built = build_tokenizer(args)
+    artifacts = os.listdir(str(cache_dir))
+    assert len(artifacts) == 1 and artifacts[0].endswith('.bin')
+    # Loading does not read the vocabulary files: blank them, keeping the
+    # size and mtime the artifact is keyed by.
+    for path in (args.vocab_file, args.merge_file):
+        if path is not None:
+            stat = os.stat(path)
+            with open(path, 'wb') as f:
+                f.write(bytes(stat.st_size))
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    loaded = build_tokenizer(args)
+    for tokenizer in (built, loaded):
+        assert type(tokenizer) is type(expected)
+        assert tokenizer.vocab_size == expected.vocab_size
+        for text in TEXTS:
+            ids = expected.tokenize(text)
+            assert tokenizer.tokenize(text) == ids
+            if tokenizer_type.startswith('BertWordPiece'):
+                assert tokenizer.decode_token_ids(ids) == \
+                    expected.decode_token_ids(ids)
+            else:
+                assert tokenizer.detokenize(ids) == expected.detokenize(ids)
+    if tokenizer_type.startswith('BertWordPiece'):
+        assert loaded.vocab == expected.vocab
+        assert loaded.inv_vocab == expected.inv_vocab
+        assert loaded.additional_special_tokens_ids == \
+            expected.additional_special_tokens_ids
+        wordpiece = loaded.tokenizer.wordpiece_tokenizer
+        expected_wordpiece = expected.tokenizer.wordpiece_tokenizer
+        assert wordpiece.prefix_trie == expected_wordpiece.prefix_trie
+        assert wordpiece.suffix_trie == expected_wordpiece.suffix_trie
+    elif tokenizer_type == 'GPT2BPETokenizer':
+        assert loaded.vocab == expected.vocab
+        assert loaded.tokenizer.decoder == expected.tokenizer.decoder
+        assert loaded.tokenizer.bpe_ranks == expected.tokenizer.bpe_ranks
+        assert loaded.eod == expected.eod
+
+
+def test_gpt2_bpe_cache_is_bounded_lru(tmp_path):
+    tokenizer = GPT2Tokenizer(*write_gpt2_files(str(tmp_path)), cache_size=2)
+    expected = [tokenizer.encode(word) for word in (' the', ' them', ' thee')]
+    assert list(tokenizer.cache) == ['Ġthem', 'Ġthee']
+    assert (tokenizer.cache_hits, tokenizer.cache_misses) == (0, 3)
+
+    assert tokenizer.encode(' them') == expected[1]
+    assert (tokenizer.cache_hits, tokenizer.cache_misses) == (1, 3)
+    # ' them' is now the most recently used word and ' thee' is dropped.
+    assert tokenizer.encode(' the') == expected[0]
+    assert list(tokenizer.cache) == ['Ġthem', 'Ġthe']
+    assert (tokenizer.cache_hits, tokenizer.cache_misses) == (1, 4)
+    assert tokenizer.cache_hit_rate == 0.2
+
+    unbounded = GPT2Tokenizer(*write_gpt2_files(str(tmp_path)),
+                              cache_size=None)
+    unbounded.encode(' the them thee')
+    assert len(unbounded.cache) == 3
+    disabled = GPT2Tokenizer(*write_gpt2_files(str(tmp_path)), cache_size=0)
+    disabled.encode(' the the')
+    assert len(disabled.cache) == 0 and disabled.cache_misses == 2
+
+
+def test_gpt2_encode_batch_matches_encode(tmp_path, caplog):
+    tokenizer = GPT2Tokenizer(*write_gpt2_files(str(tmp_path)),
+                              special_tokens=['<|endoftext|>'], max_len=10)
+    texts = TEXTS + [' the the the', 'the' * 20]
+    assert tokenizer.encode_batch(texts) == \
+        [tokenizer.encode(text) for text in texts]
+    # Both warn about the texts longer than max_len.
+    caplog.clear()
+    with caplog.at_level('WARNING'):
+        tokenizer.encode_batch(texts)
+    batch_warnings = [record.getMessage() for record in caplog.records]
+    caplog.clear()
+    with caplog.at_level('WARNING'):
+        for text in texts:
+            tokenizer.encode(text)
+    assert batch_warnings == [record.getMessage()
+                              for record in caplog.records]
+    assert len(batch_warnings) == sum(len(tokenizer.encode(text)) > 10
+                                      for text in texts) > 0
+
+
+@pytest.mark.parametrize('tokenizer_type', [
+    'BertWordPieceLowerCase', 'GPT2BPETokenizer', 'JapaneseSentencePiece'])
+def test_tokenize_batch_matches_tokenize(tmp_path, tokenizer_type):
+    tokenizer = build_tokenizer(tokenizer_args(str(tmp_path),
+                                               tokenizer_type))
+    # Newlines are replaced by the end of line symbol of SentencePiece.
+    texts = TEXTS + ['line\nbreak\r\nand\rreturn\n', '\n\n', ' ']
+    assert tokenizer.tokenize_batch(texts) == \
+        [tokenizer.tokenize(text) for text in texts]
+    assert tokenizer.tokenize_batch(texts[::-1]) == \
+        [tokenizer.tokenize(text) for text in texts[::-1]]
+    assert tokenizer.tokenize_batch([]) == []
+
+
+@pytest.mark.parametrize('tokenizer_type', ['GPT2BPETokenizer',
+                                            'JapaneseSentencePiece'])
+def test_incremental_detokenizer_matches_detokenize(tmp_path,
+                                                    tokenizer_type):
+    tokenizer = build_tokenizer(tokenizer_args(str(tmp_path),
+                                               tokenizer_type))
+    rng = np.random.RandomState(0)
+    ids = tokenizer.tokenize(' '.join(TEXTS))
+    for context_length in (0, 3, 10):
+        context = ids[:context_length]
+        context_text = tokenizer.detokenize(context)
+        if context_text.endswith('\ufffd'):
+            # The context splits a character, whose text is not emitted.
+            continue
+        expected = tokenizer.detokenize(ids)[len(context_text):]
+        for max_chunk in (1, 4):
+            detokenizer = tokenizer.incremental_detokenizer(context)
+            text = ''
+            position = context_length
+            while position < len(ids):
+                chunk = rng.randint(1, max_chunk + 1)
+                new_text = detokenizer.add(ids[position:position + chunk])
+                # Emitted text is final.
+                assert not new_text.endswith('\ufffd')
+                text += new_text
+                position += chunk
+            text += detokenizer.finish()
+            assert text == expected
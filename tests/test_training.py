@@ -0,0 +1,47 @@
+import pytest
+
+from megatron import get_args
+from megatron import mpu
+
+from distributed_utils import run_distributed
+
+training = pytest.importorskip('megatron.training')
+
+
+def provide_datasets(train_val_test_num_samples):
+    return ['train', None, 'test']
+
+
+def _check_data_iterators(rank):
+    args = get_args()
+    training.build_pretraining_data_loader = \
+        lambda dataset, consumed_samples: \
+        None if dataset is None else [dataset]
+    mpu.get_cpus_rng_tracker().add('misc-rng', 1234)
+    for tp_local_data in (False, True):
+        args.tp_local_data = tp_local_data
+        iterators = training.build_train_valid_test_data_iterators(
+            provide_datasets)
+
+        builds = mpu.get_tensor_model_parallel_rank() == 0 or tp_local_data
+        if tp_local_data and not (mpu.is_pipeline_first_stage() or
+                                  mpu.is_pipeline_last_stage()):
+            # The pipeline engine does not read data on the middle stages.
+            builds = False
+        if builds:
+            assert [None if iterator is None else list(iterator)
+                    for iterator in iterators] == [['train'], None, ['test']]
+        else:
+            assert iterators == (None, None, None)
+        assert (args.do_train, args.do_valid, args.do_test) == (1, 0, 1)
+
+
+def test_data_iterators_skip_middle_stages():
+    run_distributed(
+        _check_data_iterators, 6,
+        args=dict(iteration=0, consumed_train_samples=0,
+                  consumed_valid_samples=0, train_samples=None,
+                  train_iters=10, global_batch_size=2, eval_interval=5,
+                  eval_iters=2, deepspeed=True, ds_pipeline_enabled=True,
+                  dataloader_type='single'),
+        tensor_model_parallel_size=2, pipeline_model_parallel_size=3)
@@ -0,0 +1,92 @@
+import itertools
+
+import pytest
+import torch
+
+from megatron.model.utils import get_document_attention_mask
+from megatron.model.utils import truncate_attention_mask
+from megatron.utils import get_ltor_masks_and_position_ids
+
+
+EOD = 0
+
+
+def loop_ltor_masks_and_position_ids(data, eod_token, reset_position_ids,
+                                     reset_attention_mask, eod_mask_loss):
+    """The original per-sample, per-EOD loop."""
+    micro_batch_size, seq_length = data.size()
+    if reset_attention_mask:
+        att_mask_batch = micro_batch_size
+    else:
+        att_mask_batch = 1
+    attention_mask = torch.tril(torch.ones(
+        (att_mask_batch, seq_length, seq_length), device=data.device)).view(
+            att_mask_batch, 1, seq_length, seq_length)
+    loss_mask = torch.ones(data.size(), dtype=torch.float, device=data.device)
+    if eod_mask_loss:
+        loss_mask[data == eod_token] = 0.0
+    position_ids = torch.arange(seq_length, dtype=torch.long,
+                                device=data.device)
+    position_ids = position_ids.unsqueeze(0).expand_as(data)
+    if reset_position_ids:
+        position_ids = position_ids.clone()
+    if reset_position_ids or reset_attention_mask:
+        for b in range(micro_batch_size):
+            eod_index = position_ids[b, data[b] == eod_token]
+            if reset_position_ids:
+                eod_index = eod_index.clone()
+            prev_index = 0
+            for j in range(eod_index.size()[0]):
+                i = eod_index[j]
+                if reset_attention_mask:
+                    attention_mask[b, 0, (i + 1):, :(i + 1)] = 0
+                if reset_position_ids:
+                    position_ids[b, (i + 1):] -= (i + 1 - prev_index)
+                    prev_index = i + 1
+    attention_mask = (attention_mask < 0.5)
+    return attention_mask, loss_mask, position_ids
+
+
+def make_tokens(seed):
+    generator = torch.Generator().manual_seed(seed)
+    data = torch.randint(1, 50, (4, 33), generator=generator)
+    # Random EODs, plus EODs at the first and last positions and back to
+    # back.
+    data[torch.rand(data.size(), generator=generator) < 0.15] = EOD
+    data[0, 0] = data[1, -1] = data[2, 5] = data[2, 6] = EOD
+    return data
+
+
+@pytest.mark.parametrize('reset_position_ids,reset_attention_mask,'
+                         'eod_mask_loss',
+                         list(itertools.product([False, True], repeat=3)))
+def test_ltor_masks_match_loop(reset_position_ids, reset_attention_mask,
+                               eod_mask_loss):
+    data = make_tokens(0)
+    expected = loop_ltor_masks_and_position_ids(
+        data, EOD, reset_position_ids, reset_attention_mask, eod_mask_loss)
+    for compact in (False, True):
+        attention_mask, loss_mask, position_ids = \
+            get_ltor_masks_and_position_ids(
+                data, EOD, reset_position_ids, reset_attention_mask,
+                eod_mask_loss, compact_attention_mask=compact)
+        if attention_mask.dim() == 2:
+            assert compact and reset_attention_mask
+            attention_mask = get_document_attention_mask(attention_mask)
+        attention_mask = attention_mask.expand_as(expected[0])
+        assert torch.equal(attention_mask, expected[0])
+        assert torch.equal(loss_mask, expected[1])
+        assert torch.equal(position_ids, expected[2])
+
+
+def test_truncate_compact_attention_mask():
+    data = make_tokens(1)
+    full_mask = get_ltor_masks_and_position_ids(data, EOD, False, True,
+                                                False)[0]
+    document_ids = get_ltor_masks_and_position_ids(
+        data, EOD, False, True, False, compact_attention_mask=True)[0]
+    for seq_length in (1, 8, 33):
+        assert torch.equal(
+            get_document_attention_mask(
+                truncate_attention_mask(document_ids, seq_length)),
+            truncate_attention_mask(full_mask, seq_length))
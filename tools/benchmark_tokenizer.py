@@ -0,0 +1,139 @@
+# coding=utf-8
+# Copyright (c) 2023, Tokyo Institute of Technology.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure tokenizer throughput on a sample of a jsonl corpus.
+
+Compares tokenizing one document per call with `tokenize_batch` on chunks
+of documents and checks that both give the same ids. For the BERT
+tokenizers the substring and trie WordPiece implementations are compared
+as well."""
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import time
+
+from megatron.tokenizer import build_tokenizer
+from megatron.tokenizer.bert_tokenization import TrieWordpieceTokenizer
+from megatron.tokenizer.bert_tokenization import WordpieceTokenizer
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    group = parser.add_argument_group(title="input data")
+    group.add_argument("--input", type=str, required=True, help="Path to input JSON")
+    group.add_argument("--json-key", type=str, default="text", help="Key of the text to tokenize")
+    group.add_argument(
+        "--max-documents", type=int, default=10000, help="Documents read from the input"
+    )
+
+    group = parser.add_argument_group(title="tokenizer")
+    group.add_argument(
+        "--tokenizer-type",
+        type=str,
+        required=True,
+        choices=[
+            "BertWordPieceLowerCase",
+            "BertWordPieceCase",
+            "GPT2BPETokenizer",
+            "JapaneseSentencePiece",
+        ],
+        help="What type of tokenizer to use.",
+    )
+    group.add_argument("--vocab-file", type=str, default=None, help="Path to the vocab file")
+    group.add_argument(
+        "--merge-file", type=str, default=None, help="Path to the BPE merge file (if necessary)."
+    )
+    group.add_argument(
+        "--batch-size", type=int, default=64, help="Documents per tokenize_batch call"
+    )
+    args = parser.parse_args()
+
+    # some default/dummy values for the tokenizer
+    args.rank = 0
+    args.make_vocab_size_divisible_by = 128
+    args.tensor_model_parallel_size = 1
+    args.vocab_extra_ids = 0
+    args.tokenizer_cache_dir = None
+
+    return args
+
+
+def report(name, tokenizer, texts, num_bytes, elapsed):
+    line = "{:>20}: {:10.1f} docs/s, {:8.2f} MB/s".format(
+        name, len(texts) / elapsed, num_bytes / elapsed / 1024 / 1024
+    )
+    bpe = getattr(tokenizer, "tokenizer", None)
+    if hasattr(bpe, "cache_hit_rate"):
+        line += ", BPE cache hit rate {:.3f} ({} words cached)".format(
+            bpe.cache_hit_rate, len(bpe.cache)
+        )
+    print(line)
+
+
+def main():
+    args = get_args()
+    texts = []
+    with open(args.input, encoding="utf-8") as f:
+        for line in f:
+            texts.append(json.loads(line)[args.json_key])
+            if len(texts) == args.max_documents:
+                break
+    num_bytes = sum(len(text.encode("utf-8")) for text in texts)
+    print("{} documents, {} bytes".format(len(texts), num_bytes))
+
+    # Fresh tokenizers, so that neither run starts from a warm cache.
+    tokenizer = build_tokenizer(args)
+    start_time = time.time()
+    expected = [tokenizer.tokenize(text) for text in texts]
+    report("tokenize", tokenizer, texts, num_bytes, time.time() - start_time)
+
+    tokenizer = build_tokenizer(args)
+    start_time = time.time()
+    result = []
+    for i in range(0, len(texts), args.batch_size):
+        result.extend(tokenizer.tokenize_batch(texts[i:i + args.batch_size]))
+    report("tokenize_batch", tokenizer, texts, num_bytes, time.time() - start_time)
+    assert [list(ids) for ids in result] == [list(ids) for ids in expected], \
+        "tokenize_batch returned other ids"
+
+    if args.tokenizer_type.startswith("BertWordPiece"):
+        benchmark_wordpiece(tokenizer.tokenizer, texts, num_bytes)
+
+
+def benchmark_wordpiece(tokenizer, texts, num_bytes):
+    """Time only the WordPiece step on the basic tokenized words."""
+    words = [tokenizer.basic_tokenizer.tokenize(text) for text in texts]
+    results = []
+    for name, cls in (("substring", WordpieceTokenizer), ("trie", TrieWordpieceTokenizer)):
+        wordpiece = cls(vocab=tokenizer.vocab)
+        start_time = time.time()
+        results.append(
+            [[piece for word in doc for piece in wordpiece.tokenize(word)] for doc in words]
+        )
+        elapsed = time.time() - start_time
+        print(
+            "{:>20}: {:10.1f} docs/s, {:8.2f} MB/s".format(
+                "wordpiece " + name, len(texts) / elapsed, num_bytes / elapsed / 1024 / 1024
+            )
+        )
+    assert results[0] == results[1], "trie WordPiece returned other pieces"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# coding=utf-8
+# Copyright (c) 2023, Tokyo Institute of Technology.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Convert an mmap indexed dataset to the block compressed format and
+compare how fast GPT style samples are read from both."""
+
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import time
+
+import numpy as np
+
+from megatron.data import indexed_dataset
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    group = parser.add_argument_group(title="conversion")
+    group.add_argument("--input", type=str, required=True, help="Prefix of the mmap dataset")
+    group.add_argument(
+        "--output-prefix", type=str, required=True, help="Prefix of the compressed dataset"
+    )
+    group.add_argument(
+        "--codec",
+        type=str,
+        default="bitpack",
+        choices=["bitpack", "zstd"],
+        help="bitpack stores each block in the bits its token range needs; zstd needs "
+        "the zstandard package.",
+    )
+    group.add_argument(
+        "--block-tokens", type=int, default=8192, help="Tokens per compressed block"
+    )
+    group.add_argument(
+        "--skip-conversion", action="store_true", help="Only benchmark an existing output"
+    )
+
+    group = parser.add_argument_group(title="benchmark")
+    group.add_argument(
+        "--benchmark-samples",
+        type=int,
+        default=0,
+        help="Number of samples to read from both datasets; 0 skips the benchmark.",
+    )
+    group.add_argument("--seq-length", type=int, default=2048)
+    group.add_argument(
+        "--benchmark-order",
+        type=str,
+        default="random",
+        choices=["random", "sequential"],
+        help="Read samples at random token positions (shuffled training) or one after "
+        "the other.",
+    )
+    group.add_argument("--seed", type=int, default=1234)
+    return parser.parse_args()
+
+
+def convert(args):
+    source = indexed_dataset.MMapIndexedDataset(args.input, skip_warmup=True)
+    builder = indexed_dataset.CompressedIndexedDatasetBuilder(
+        indexed_dataset.data_file_path(args.output_prefix),
+        dtype=source.dtype,
+        codec=args.codec,
+        block_tokens=args.block_tokens,
+    )
+    start_time = time.time()
+    builder.merge_file_(args.input)
+    builder.finalize(indexed_dataset.index_file_path(args.output_prefix))
+    print(f"Converted {len(source)} items in {time.time() - start_time:.2f} s")
+
+
+def sample_spans(dataset, sample_starts, seq_length):
+    """(idxs, offsets, lengths) of the `seq_length + 1` tokens starting at
+    each token position, like the samples of GPTDataset."""
+    sizes = dataset.sizes.astype(np.int64)
+    pointers = np.cumsum(sizes) - sizes
+    samples = []
+    for start in sample_starts.tolist():
+        idx = int(np.searchsorted(pointers, start, side="right")) - 1
+        offset = start - int(pointers[idx])
+        remaining = seq_length + 1
+        idxs, offsets, lengths = [], [], []
+        while remaining > 0:
+            length = min(int(sizes[idx]) - offset, remaining)
+            idxs.append(idx)
+            offsets.append(offset)
+            lengths.append(length)
+            remaining -= length
+            idx += 1
+            offset = 0
+        samples.append((np.array(idxs), np.array(offsets), np.array(lengths)))
+    return samples
+
+
+def benchmark(name, dataset, samples, bytes_read):
+    start_time = time.time()
+    for idxs, offsets, lengths in samples:
+        dataset.gather(idxs, offsets, lengths)
+    elapsed = time.time() - start_time
+    print(
+        f"{name:>10}: {len(samples) / elapsed:10.1f} samples/s, "
+        f"{bytes_read(dataset) / len(samples) / 1024:8.1f} KiB read per sample"
+    )
+
+
+def main():
+    args = get_args()
+    if not args.skip_conversion:
+        convert(args)
+
+    source = indexed_dataset.MMapIndexedDataset(args.input, skip_warmup=True)
+    compressed = indexed_dataset.CompressedIndexedDataset(args.output_prefix, skip_warmup=True)
+    source_bytes = os.path.getsize(indexed_dataset.data_file_path(args.input))
+    compressed_bytes = os.path.getsize(indexed_dataset.data_file_path(args.output_prefix))
+    print(
+        f"Data size: {source_bytes} -> {compressed_bytes} bytes "
+        f"({compressed_bytes / max(source_bytes, 1):.3f})"
+    )
+    if args.benchmark_samples <= 0:
+        return
+
+    num_tokens = int(source.sizes.astype(np.int64).sum())
+    assert num_tokens > args.seq_length + 1, "dataset is shorter than one sample"
+    rng = np.random.RandomState(args.seed)
+    if args.benchmark_order == "random":
+        starts = rng.randint(0, num_tokens - args.seq_length - 1, args.benchmark_samples)
+    else:
+        starts = np.arange(args.benchmark_samples) * args.seq_length % (
+            num_tokens - args.seq_length - 1
+        )
+    samples = sample_spans(source, starts, args.seq_length)
+
+    # The mmap dataset reads the spans themselves, the compressed one whole
+    # blocks on cache misses.
+    itemsize = np.dtype(source.dtype).itemsize
+    mmap_bytes = sum(int(lengths.sum()) for _, _, lengths in samples) * itemsize
+    benchmark("mmap", source, samples, lambda dataset: mmap_bytes)
+    benchmark("compressed", compressed, samples, lambda dataset: dataset.bytes_read)
+    for idxs, offsets, lengths in samples:
+        assert np.array_equal(
+            source.gather(idxs, offsets, lengths), compressed.gather(idxs, offsets, lengths)
+        ), "compressed dataset returned other tokens"
+
+
+if __name__ == "__main__":
+    main()
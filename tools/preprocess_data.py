@@ -17,6 +17,9 @@
 """Processing data for pretraining."""
 
 import argparse
+import fileinput
+import glob
+import itertools
 import json
 import multiprocessing
 import os
@@ -80,25 +83,218 @@ class Encoder(object):
             Encoder.splitter = IdentitySplitter()
 
     def encode(self, json_line):
-        data = json.loads(json_line)
-        ids = {}
-        for key in self.args.json_keys:
-            text = data[key]
-            doc_ids = []
-            for sentence in Encoder.splitter.tokenize(text):
-                sentence_ids = Encoder.tokenizer.tokenize(sentence)
-                if len(sentence_ids) > 0:
-                    doc_ids.append(sentence_ids)
-            if len(doc_ids) > 0 and self.args.append_eod:
-                doc_ids[-1].append(Encoder.tokenizer.eod)
-            ids[key] = doc_ids
-        return ids, len(json_line)
+        return self.encode_batch([json_line])[0]
+
+    def encode_batch(self, json_lines):
+        """Encode a chunk of documents with one `tokenize_batch` call for all
+        of their sentences."""
+        docs = []
+        sentences = []
+        for json_line in json_lines:
+            data = json.loads(json_line)
+            doc = {}
+            for key in self.args.json_keys:
+                doc[key] = list(Encoder.splitter.tokenize(data[key]))
+                sentences.extend(doc[key])
+            docs.append(doc)
+        sentence_ids = iter(Encoder.tokenizer.tokenize_batch(sentences))
+
+        results = []
+        for json_line, doc in zip(json_lines, docs):
+            ids = {}
+            for key in self.args.json_keys:
+                doc_ids = []
+                for _ in doc[key]:
+                    ids_ = next(sentence_ids)
+                    if len(ids_) > 0:
+                        doc_ids.append(ids_)
+                if len(doc_ids) > 0 and self.args.append_eod:
+                    doc_ids[-1].append(Encoder.tokenizer.eod)
+                ids[key] = doc_ids
+            results.append((ids, len(json_line)))
+        return results
+
+    def encode_shard(self, shard):
+        """Encode the lines of `shard` into its own mmap dataset files and
+        return the number of documents and bytes processed.
+
+        With --checkpoint-interval the shard is made durable every that many
+        documents, together with the input offset it continues from; with
+        --resume an interrupted shard continues from its last checkpoint and
+        a finished one is skipped. A shard is finished once its marker file
+        is written, after its .bin and .idx files are durable.
+        """
+        index, path, start, end = shard
+        state_file = shard_state_file(self.args, index)
+        done_file = shard_done_file(self.args, index)
+        prefixes = {key: shard_prefix(self.args, key, index) for key in self.args.json_keys}
+        if self.args.resume and os.path.exists(done_file):
+            with open(done_file) as f:
+                assert tuple(json.load(f)) == tuple(shard), \
+                    "{} was written for another shard".format(done_file)
+            return 0, 0
+        if os.path.exists(done_file):
+            os.remove(done_file)
+        if self.args.resume and os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+            builders = {
+                key: indexed_dataset.MMapIndexedDatasetBuilder.resume(
+                    indexed_dataset.data_file_path(prefix), prefix, state["builders"][key])
+                for key, prefix in prefixes.items()}
+            offset = state["offset"]
+            print(f"Resuming shard {index} at byte {offset} of {path}", file=sys.stderr)
+        else:
+            if os.path.exists(state_file):
+                os.remove(state_file)
+            builders = {
+                key: indexed_dataset.make_builder(
+                    indexed_dataset.data_file_path(prefix), impl="mmap",
+                    vocab_size=Encoder.tokenizer.vocab_size)
+                for key, prefix in prefixes.items()}
+            offset = start
+        resume_offset = offset
+
+        num_docs = 0
+        num_checkpoints = 0
+        with open(path, "rb") as fin:
+            fin.seek(offset)
+            while offset < end:
+                lines = []
+                while offset < end and len(lines) < self.args.tokenize_batch_size:
+                    lines.append(fin.readline())
+                    offset += len(lines[-1])
+                for doc, _ in self.encode_batch([line.decode("utf-8") for line in lines]):
+                    add_document(builders, doc)
+                num_docs += len(lines)
+                if self.args.checkpoint_interval and \
+                        num_docs // self.args.checkpoint_interval > num_checkpoints:
+                    num_checkpoints = num_docs // self.args.checkpoint_interval
+                    state = {"offset": offset,
+                             "builders": {key: builders[key].checkpoint(prefix)
+                                          for key, prefix in prefixes.items()}}
+                    write_json_atomic(state_file, state)
+        for key, prefix in prefixes.items():
+            builders[key].finalize(indexed_dataset.index_file_path(prefix))
+            for output_file in (indexed_dataset.data_file_path(prefix),
+                                indexed_dataset.index_file_path(prefix)):
+                fsync_file(output_file)
+        write_json_atomic(done_file, shard)
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        for prefix in prefixes.values():
+            indexed_dataset.MMapIndexedDatasetBuilder.remove_checkpoint(prefix)
+        return num_docs, end - resume_offset
+
+
+def batched(iterable, n):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, n))
+        if not batch:
+            return
+        yield batch
+
+
+def add_document(builders, doc):
+    for key, sentences in doc.items():
+        if len(sentences) == 0:
+            continue
+        for sentence in sentences:
+            builders[key].add_item(torch.IntTensor(sentence))
+        builders[key].end_document()
+
+
+def output_prefix(args, key):
+    level = "sentence" if args.split_sentences else "document"
+    return "{}_{}_{}".format(args.output_prefix, key, level)
+
+
+def shard_prefix(args, key, index):
+    return "{}_shard{:05d}".format(output_prefix(args, key), index)
+
+
+def shard_state_file(args, index):
+    return "{}_shard{:05d}.ckpt".format(args.output_prefix, index)
+
+
+def shard_done_file(args, index):
+    return "{}_shard{:05d}.done".format(args.output_prefix, index)
+
+
+def shard_layout_file(args):
+    return "{}.shards.json".format(args.output_prefix)
+
+
+def fsync_file(path):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def write_json_atomic(path, obj):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def expand_inputs(patterns):
+    """Input files in command line order, each glob sorted."""
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        assert matches, "no input matches {}".format(pattern)
+        files.extend(matches)
+    return files
+
+
+def build_shards(args):
+    """Split the inputs into line-aligned shards, about `--workers` of them
+    in total. A resumed run reuses the recorded layout."""
+    layout_file = shard_layout_file(args)
+    if args.resume and os.path.exists(layout_file):
+        with open(layout_file) as f:
+            layout = json.load(f)
+        assert layout["inputs"] == args.input, \
+            "{} was written for other inputs".format(layout_file)
+        return [tuple(shard) for shard in layout["shards"]]
+    shards_per_input = -(-args.workers // len(args.input))
+    shards = []
+    for path in args.input:
+        for _, _, start, end in split_input(path, shards_per_input):
+            if end > start:
+                shards.append((len(shards), path, start, end))
+    write_json_atomic(layout_file, {"inputs": args.input, "shards": shards})
+    return shards
+
+
+def split_input(path, num_shards):
+    """Split a file into `num_shards` byte ranges that start at lines."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as f:
+        for i in range(1, num_shards):
+            f.seek(max(size * i // num_shards, bounds[-1]))
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(i, path, bounds[i], bounds[i + 1]) for i in range(num_shards)]
 
 
 def get_args():
     parser = argparse.ArgumentParser()
     group = parser.add_argument_group(title="input data")
-    group.add_argument("--input", type=str, required=True, help="Path to input JSON")
+    group.add_argument(
+        "--input",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Paths or glob patterns of the input JSON files, processed in the given order.",
+    )
     group.add_argument(
         "--json-keys",
         nargs="+",
@@ -119,16 +315,32 @@ def get_args():
         "--tokenizer-type",
         type=str,
         required=True,
-        choices=["BertWordPieceLowerCase", "BertWordPieceCase", "GPT2BPETokenizer"],
+        choices=[
+            "BertWordPieceLowerCase",
+            "BertWordPieceCase",
+            "GPT2BPETokenizer",
+            "JapaneseSentencePiece",
+        ],
         help="What type of tokenizer to use.",
     )
-    group.add_argument("--vocab-file", type=str, default=None, help="Path to the vocab file")
+    group.add_argument(
+        "--vocab-file",
+        type=str,
+        default=None,
+        help="Path to the vocab file (the SentencePiece model for JapaneseSentencePiece)",
+    )
     group.add_argument(
         "--merge-file", type=str, default=None, help="Path to the BPE merge file (if necessary)."
     )
     group.add_argument(
         "--append-eod", action="store_true", help="Append an <eod> token to the end of a document."
     )
+    group.add_argument(
+        "--tokenizer-cache-dir",
+        type=str,
+        default=None,
+        help="Directory for a precompiled tokenizer built once and loaded by every worker.",
+    )
 
     group = parser.add_argument_group(title="output data")
     group.add_argument(
@@ -138,7 +350,23 @@ def get_args():
         help="Path to binary output file without suffix",
     )
     group.add_argument(
-        "--dataset-impl", type=str, default="mmap", choices=["lazy", "cached", "mmap"]
+        "--dataset-impl",
+        type=str,
+        default="mmap",
+        choices=["lazy", "cached", "mmap", "compressed"],
+    )
+    group.add_argument(
+        "--shard-writers",
+        action="store_true",
+        help="Split the input into one line-aligned range per worker; every worker "
+        "writes its own mmap .bin/.idx shard and a manifest lists the shards in input "
+        "order (read it with --data-impl sharded).",
+    )
+    group.add_argument(
+        "--merge-shards",
+        action="store_true",
+        help="With --shard-writers, concatenate the shards into a single .bin/.idx "
+        "identical to the serial output instead of writing a manifest.",
     )
 
     group = parser.add_argument_group(title="runtime")
@@ -148,9 +376,37 @@ def get_args():
     group.add_argument(
         "--log-interval", type=int, default=100, help="Interval between progress updates"
     )
+    group.add_argument(
+        "--tokenize-batch-size",
+        type=int,
+        default=64,
+        help="Documents a worker tokenizes per call; the sentences of a chunk are "
+        "passed to the tokenizer as one batch.",
+    )
+    group.add_argument(
+        "--checkpoint-interval",
+        type=int,
+        default=0,
+        help="With --shard-writers, make every shard durable (data, partial index and "
+        "input offset) each this many documents. 0 disables checkpoints.",
+    )
+    group.add_argument(
+        "--resume",
+        action="store_true",
+        help="With --shard-writers, continue an interrupted run with the same arguments: "
+        "finished shards are kept and the others continue from their last checkpoint.",
+    )
     args = parser.parse_args()
     args.keep_empty = False
 
+    if args.shard_writers:
+        assert args.dataset_impl == "mmap", "--shard-writers writes mmap shards"
+    for name in ("merge_shards", "checkpoint_interval", "resume"):
+        if getattr(args, name):
+            assert args.shard_writers, "--{} requires --shard-writers".format(
+                name.replace("_", "-"))
+    args.input = expand_inputs(args.input)
+
     if args.tokenizer_type.lower().startswith("bert"):
         if not args.split_sentences:
             print("Bert tokenizer detected, are you sure you don't want to split sentences?")
@@ -164,12 +420,69 @@ def get_args():
     return args
 
 
+def main_sharded(args):
+    startup_start = time.time()
+    if nltk_available and args.split_sentences:
+        nltk.download("punkt", quiet=True)
+
+    encoder = Encoder(args)
+    shards = build_shards(args)
+    pool = multiprocessing.Pool(args.workers, initializer=encoder.initializer)
+    print("Time to startup:", time.time() - startup_start)
+
+    proc_start = time.time()
+    total_docs = 0
+    total_bytes_processed = 0
+    for num_docs, bytes_processed in pool.imap_unordered(encoder.encode_shard, shards):
+        total_docs += num_docs
+        total_bytes_processed += bytes_processed
+        elapsed = time.time() - proc_start
+        mbs = total_bytes_processed / elapsed / 1024 / 1024
+        print(
+            f"Processed {total_docs} documents",
+            f"({total_docs/elapsed} docs/s, {mbs} MB/s).",
+            file=sys.stderr,
+        )
+    pool.close()
+    pool.join()
+
+    print("processing is done", file=sys.stderr)
+    for key in args.json_keys:
+        prefix = output_prefix(args, key)
+        shard_prefixes = [shard_prefix(args, key, shard[0]) for shard in shards]
+        if args.merge_shards:
+            dtype = indexed_dataset.MMapIndexedDataset.Index(
+                indexed_dataset.index_file_path(shard_prefixes[0])).dtype
+            builder = indexed_dataset.MMapIndexedDatasetBuilder(
+                indexed_dataset.data_file_path(prefix), dtype=dtype)
+            for path in shard_prefixes:
+                builder.merge_file_(path)
+            builder.finalize(indexed_dataset.index_file_path(prefix))
+        else:
+            indexed_dataset.write_manifest(
+                indexed_dataset.manifest_file_path(prefix), shard_prefixes)
+        print(f"Saved {key}", file=sys.stderr)
+    # Until here a resumed run skips the finished shards and merges again.
+    # The layout stays: it records the byte ranges of the shards on disk,
+    # which a later --resume run must not split differently.
+    if args.merge_shards:
+        for key in args.json_keys:
+            for shard in shards:
+                path = shard_prefix(args, key, shard[0])
+                os.remove(indexed_dataset.data_file_path(path))
+                os.remove(indexed_dataset.index_file_path(path))
+        for shard in shards:
+            os.remove(shard_done_file(args, shard[0]))
+
+
 def main():
     args = get_args()
+    if args.shard_writers:
+        return main_sharded(args)
     startup_start = time.time()
 
-    print("Opening", args.input)
-    fin = open(args.input, "r", encoding="utf-8")
+    print("Opening", *args.input)
+    fin = fileinput.input(args.input, openhook=fileinput.hook_encoded("utf-8"))
 
     if nltk_available and args.split_sentences:
         nltk.download("punkt", quiet=True)
@@ -177,7 +490,8 @@ def main():
     encoder = Encoder(args)
     tokenizer = build_tokenizer(args)
     pool = multiprocessing.Pool(args.workers, initializer=encoder.initializer)
-    encoded_docs = pool.imap(encoder.encode, fin, 25)
+    encoded_docs = itertools.chain.from_iterable(
+        pool.imap(encoder.encode_batch, batched(fin, args.tokenize_batch_size)))
     # encoded_docs = map(encoder.encode, fin)
 
     level = "document"
@@ -203,12 +517,7 @@ def main():
 
     for i, (doc, bytes_processed) in enumerate(encoded_docs, start=1):
         total_bytes_processed += bytes_processed
-        for key, sentences in doc.items():
-            if len(sentences) == 0:
-                continue
-            for sentence in sentences:
-                builders[key].add_item(torch.IntTensor(sentence))
-            builders[key].end_document()
+        add_document(builders, doc)
         if i % args.log_interval == 0:
             current = time.time()
             elapsed = current - proc_start